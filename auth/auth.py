@@ -1,10 +1,11 @@
 import os
-import json
-from flask import request, abort
+import time
+from flask import g, request, abort
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
 from dotenv import load_dotenv
+from .jwks import JWKSStore, JWKSFetchError
+from .token_cache import TokenCache
 
 # Load Environments
 load_dotenv()
@@ -14,6 +15,23 @@ ALGORITHMS = [os.getenv('ALGORITHMS', '')]
 API_AUDIENCE = os.getenv('API_AUDIENCE', '')
 AUTH_STATUS = int(os.getenv('AUTH_STATUS', 0))
 IS_PRODUCTION = int(os.getenv('ENV', 0))
+# Where to fetch the signing keys from | a local file or stub server in tests
+JWKS_URL = os.getenv(
+    'JWKS_URL', 'https://' + AUTH0_DOMAIN + '/.well-known/jwks.json')
+JWKS_TTL = int(os.getenv('JWKS_TTL', 600))
+JWKS_MIN_REFRESH_INTERVAL = int(os.getenv('JWKS_MIN_REFRESH_INTERVAL', 30))
+# How many verified tokens to remember | 0 => disable the cache
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 1024))
+
+# Signing keys, shared by every request handled by this process
+jwks_store = JWKSStore(
+    JWKS_URL,
+    ttl=JWKS_TTL,
+    min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL
+)
+
+# Verified payloads, so a reused token skips the RS256 verification
+token_cache = TokenCache(TOKEN_CACHE_SIZE)
 
 
 # AuthError Exception
@@ -102,8 +120,11 @@ verify_decode_jwt(token) method
         token: a json web token (string)
     it should be an Auth0 token with key id (kid)
     it should verify the token using Auth0 /.well-known/jwks.json
+    served from the in-process jwks_store instead of fetching it every time
     it should decode the payload from the token
     it should validate the claims
+    it should return the cached payload if the token was already verified
+    and has not expired yet
     return the decoded payload
     !!NOTE urlopen has a common certificate error described here:
     https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
@@ -111,22 +132,22 @@ verify_decode_jwt(token) method
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen("https://" + AUTH0_DOMAIN + "/.well-known/jwks.json")
-    jwks = json.loads(jsonurl.read())
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
     try:
         unverified_header = jwt.get_unverified_header(token)
     except Exception:
         abort(401)
-    rsa_key = {}
-    for key in jwks["keys"]:
-        if key["kid"] == unverified_header["kid"]:
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"]
-            }
+    if 'kid' not in unverified_header:
+        raise AuthError({"code": "invalid_header",
+                         "description": "Authorization malformed."}, 401)
+    try:
+        rsa_key = jwks_store.get_key(unverified_header["kid"])
+    except JWKSFetchError:
+        raise AuthError({"code": "jwks_unavailable",
+                         "description":
+                             "Unable to fetch the signing keys"}, 401)
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -136,6 +157,7 @@ def verify_decode_jwt(token):
                 audience=API_AUDIENCE,
                 issuer="https://" + AUTH0_DOMAIN + "/"
             )
+            token_cache.set(token, payload)
             # return payload
             return payload
 
@@ -160,6 +182,8 @@ def verify_decode_jwt(token):
 @requires_auth(permission) decorator method
     @INPUTS
         permission: string permission (i.e. 'post:actors')
+            or a tuple of them when the route needs all of them
+            (i.e. ('get:actors', 'get:movies'))
     it should use the get_token_auth_header method to get the token
     it should use the verify_decode_jwt method to decode the jwt
     it should use the check_permissions method validate claims
@@ -171,8 +195,18 @@ def verify_decode_jwt(token):
 
 def is_authenticated(permission):
     token = get_token_auth_header()
-    payload = verify_decode_jwt(token)
-    check_permissions(permission, payload)
+    start = time.perf_counter()
+    try:
+        payload = verify_decode_jwt(token)
+    finally:
+        # Time spent verifying tokens in this request | for the metrics
+        g.auth_seconds = g.get('auth_seconds', 0.0) + (
+            time.perf_counter() - start)
+    # The token is verified once | then every permission is checked
+    permissions = (
+        (permission,) if isinstance(permission, str) else permission)
+    for permission in permissions:
+        check_permissions(permission, payload)
 
 
 def requires_auth(permission=''):
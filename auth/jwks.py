@@ -0,0 +1,108 @@
+import json
+import threading
+import time
+from urllib.parse import urlparse
+from urllib.request import urlopen
+
+
+'''
+JWKSFetchError Exception
+Raised when the key set cannot be fetched and there is no stale copy to serve
+'''
+
+
+class JWKSFetchError(Exception):
+    pass
+
+
+'''
+JWKSStore
+    An in-process cache of the JSON Web Key Set, keyed by key id (kid)
+    @INPUTS
+        url: where to fetch the key set from. An http(s) url, a file:// url
+             or a plain path to a local json file (handy for tests)
+        ttl: seconds before the cached key set is considered expired
+        min_refresh_interval: minimum seconds between two refreshes that
+             are triggered by an unknown kid or by a failed fetch
+        timeout: seconds to wait for the key set endpoint
+    it should fetch the key set lazily on the first lookup
+    it should refresh once when a kid is not in the cached set
+    it should let only one thread refresh at a time (single flight),
+    the others wait and reuse the result
+    it should keep serving the stale key set if a refresh fails
+'''
+
+
+class JWKSStore:
+    def __init__(self, url, ttl=600, min_refresh_interval=30, timeout=5):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._keys = {}
+        self._expires_at = 0
+        self._last_attempt = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get_key(self, kid):
+        if self._keys and time.monotonic() < self._expires_at:
+            key = self._keys.get(kid)
+            if key is not None:
+                return key
+            # Unknown kid | Auth0 may have rotated its signing keys
+            return self._refresh(force=True).get(kid)
+        return self._refresh().get(kid)
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._expires_at = 0
+            self._last_attempt = None
+            self._generation += 1
+
+    def _refresh(self, force=False):
+        generation = self._generation
+        with self._lock:
+            # Another thread refreshed while we were waiting for the lock
+            if self._generation != generation:
+                return self._keys
+
+            now = time.monotonic()
+            # Don't let unknown kids hammer the key set endpoint
+            if force and self._last_attempt is not None and (
+                    now - self._last_attempt < self.min_refresh_interval):
+                return self._keys
+            self._last_attempt = now
+
+            try:
+                self._keys = self._fetch()
+                self._expires_at = now + self.ttl
+            except Exception as e:
+                if not self._keys:
+                    raise JWKSFetchError(e)
+                # Serve the stale key set and retry a bit later
+                self._expires_at = now + self.min_refresh_interval
+
+            self._generation += 1
+            return self._keys
+
+    def _fetch(self):
+        if urlparse(self.url).scheme in ('http', 'https', 'file'):
+            with urlopen(self.url, timeout=self.timeout) as response:
+                jwks = json.loads(response.read())
+        else:
+            with open(self.url) as jwks_file:
+                jwks = json.load(jwks_file)
+
+        return {
+            key['kid']: {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use', 'sig'),
+                'n': key['n'],
+                'e': key['e']
+            }
+            for key in jwks['keys']
+            if 'kid' in key
+        }
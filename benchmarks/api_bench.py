@@ -0,0 +1,391 @@
+'''
+Throughput, latency percentiles and SQL statements per request of every
+route, through the Flask test client and through a real HTTP server
+
+    python -m benchmarks.api_bench --actors 1000 --movies 1000 --cast 5 \\
+        --requests 200 --output results.json --baseline previous.json
+
+A synthetic catalogue is seeded in a database of its own and requests
+carry RS256 tokens checked against a local key set, so nothing goes to
+the network. The response cache is off unless --response-cache is set,
+so the GET routes measure the database path. Metrics are off unless
+--metrics is set, which also adds GET /metrics.
+--output saves the results as JSON, --baseline prints the change of
+throughput and p99 against a file saved before (e.g. on another commit).
+'''
+import argparse
+import datetime
+import http.client
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+
+from benchmarks.support import (
+    SigningKey, auth_environment, percentile, seed_catalogue)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PERMISSIONS = [
+    'get:actors', 'post:actors', 'patch:actors', 'delete:actors',
+    'get:movies', 'post:movies', 'patch:movies', 'delete:movies',
+]
+
+
+class Scenario:
+    '''
+    One route under test
+        path(i, ids) and body(i, ids) build the i-th request, ids being
+        the rows made by prepare(count) before the timing starts.
+        share is the part of --requests that this route gets
+    '''
+
+    def __init__(self, name, method, path, body=None, prepare=None,
+                 content_type='application/json', share=1.0):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.prepare = prepare
+        self.content_type = content_type
+        self.share = share
+
+
+def scenarios(catalogue, tag):
+    '''
+    Every route of flaskr | tag keeps the names created by a run apart
+    from the ones of the other runs
+    '''
+    from flaskr.metrics import metrics
+    from models import db, gender_cache, Actor, Movie
+
+    actor_ids, movie_ids = catalogue
+    cast = actor_ids[:5]
+
+    def pick(ids, i):
+        return ids[i % len(ids)]
+
+    # Throwaway rows for the DELETE routes
+    def new_actors(count):
+        actors = [
+            Actor('{} delete actor {}'.format(tag, n), 30)
+            for n in range(count)
+        ]
+        for actor in actors:
+            actor.gender_id = gender_cache.get_id('male')
+        db.session.add_all(actors)
+        db.session.commit()
+        return [actor.id for actor in actors]
+
+    def new_movies(count):
+        movies = [
+            Movie('{} delete movie {}'.format(tag, n),
+                  datetime.datetime(2000, 1, 1))
+            for n in range(count)
+        ]
+        db.session.add_all(movies)
+        db.session.commit()
+        return [movie.id for movie in movies]
+
+    # 100 throwaway rows per batch DELETE
+    def new_actor_batches(count):
+        ids = new_actors(count * 100)
+        return [ids[n:n + 100] for n in range(0, len(ids), 100)]
+
+    def new_movie_batches(count):
+        ids = new_movies(count * 100)
+        return [ids[n:n + 100] for n in range(0, len(ids), 100)]
+
+    def batch_patch_actors(i, ids):
+        return {'actors': [
+            {'id': pick(actor_ids, i * 100 + n), 'age': 20 + (i + n) % 40}
+            for n in range(100)
+        ]}
+
+    def batch_patch(i, ids):
+        return {'movies': [
+            {'id': pick(movie_ids, i * 100 + n), 'release_date': '01/01/2005',
+             'actors': [pick(actor_ids, i + n), pick(actor_ids, i + n + 1)]}
+            for n in range(100)
+        ]}
+
+    def bulk_rows(i, ids):
+        return ''.join(json.dumps({
+            'type': 'actor', 'name': '{} bulk actor {}-{}'.format(tag, i, n),
+            'age': 40, 'gender': 'male',
+        }) + '\n' for n in range(100))
+
+    routes = [
+        Scenario('GET /', 'GET', lambda i, ids: '/'),
+        Scenario('GET /actors', 'GET',
+                 lambda i, ids: '/actors?limit=100'),
+        Scenario('GET /actors filtered', 'GET',
+                 lambda i, ids: '/actors?gender=female&min_age=30'
+                 '&max_age=50&limit=100'),
+        Scenario('GET /actors after', 'GET',
+                 lambda i, ids: '/actors?limit=100&after={}'.format(
+                     pick(actor_ids, i))),
+        Scenario('GET /movies', 'GET',
+                 lambda i, ids: '/movies?limit=100'),
+        Scenario('GET /movies title', 'GET',
+                 lambda i, ids: '/movies?title=Bench+movie+1&limit=100'),
+        Scenario('GET /movies fields', 'GET',
+                 lambda i, ids: '/movies?fields=id,title&limit=1000'),
+        Scenario('GET /search', 'GET',
+                 lambda i, ids: '/search?q=movie+{}&limit=20'.format(
+                     i % 100)),
+        Scenario('GET /actors/<id>/costars', 'GET',
+                 lambda i, ids: '/actors/{}/costars?limit=20'.format(
+                     pick(actor_ids, i))),
+        Scenario('GET /actors/<a>/path/<b>', 'GET',
+                 lambda i, ids: '/actors/{}/path/{}'.format(
+                     pick(actor_ids, i), pick(actor_ids, i * 7919 + 1))),
+        Scenario('GET /stats', 'GET', lambda i, ids: '/stats'),
+        Scenario('GET /stats/genders', 'GET',
+                 lambda i, ids: '/stats/genders'),
+        Scenario('GET /stats/cast-size', 'GET',
+                 lambda i, ids: '/stats/cast-size'),
+        Scenario('GET /stats/release-years', 'GET',
+                 lambda i, ids: '/stats/release-years'),
+        Scenario('GET /stats/top-actors', 'GET',
+                 lambda i, ids: '/stats/top-actors?limit={}'.format(
+                     1 + i % 20)),
+        Scenario('POST /actors', 'POST', lambda i, ids: '/actors',
+                 lambda i, ids: {'name': '{} actor {}'.format(tag, i),
+                                 'age': 30, 'gender': 'female'}),
+        Scenario('PATCH /actors/<id>', 'PATCH',
+                 lambda i, ids: '/actors/{}'.format(pick(actor_ids, i)),
+                 lambda i, ids: {'age': 20 + i % 40}),
+        Scenario('DELETE /actors/<id>', 'DELETE',
+                 lambda i, ids: '/actors/{}'.format(ids[i]),
+                 prepare=new_actors),
+        Scenario('POST /movies', 'POST', lambda i, ids: '/movies',
+                 lambda i, ids: {'title': '{} movie {}'.format(tag, i),
+                                 'release_date': '01/01/2010',
+                                 'actors': cast}),
+        Scenario('PATCH /movies/<id>', 'PATCH',
+                 lambda i, ids: '/movies/{}'.format(pick(movie_ids, i)),
+                 lambda i, ids: {'actors': [
+                     pick(actor_ids, i + n) for n in range(5)]}),
+        Scenario('DELETE /movies/<id>', 'DELETE',
+                 lambda i, ids: '/movies/{}'.format(ids[i]),
+                 prepare=new_movies),
+        Scenario('PATCH /movies batch', 'PATCH', lambda i, ids: '/movies',
+                 batch_patch, share=0.1),
+        Scenario('PATCH /actors batch', 'PATCH', lambda i, ids: '/actors',
+                 batch_patch_actors, share=0.1),
+        Scenario('DELETE /actors batch', 'DELETE',
+                 lambda i, ids: '/actors', lambda i, ids: {'ids': ids[i]},
+                 prepare=new_actor_batches, share=0.1),
+        Scenario('DELETE /movies batch', 'DELETE',
+                 lambda i, ids: '/movies', lambda i, ids: {'ids': ids[i]},
+                 prepare=new_movie_batches, share=0.1),
+        Scenario('POST /bulk', 'POST', lambda i, ids: '/bulk', bulk_rows,
+                 content_type='application/x-ndjson', share=0.1),
+        Scenario('GET /export/actors', 'GET',
+                 lambda i, ids: '/export/actors', share=0.05),
+        Scenario('GET /export/movies', 'GET',
+                 lambda i, ids: '/export/movies?format=csv', share=0.05),
+    ]
+    # Only registered with --metrics
+    if metrics.enabled:
+        routes.append(Scenario('GET /metrics', 'GET',
+                               lambda i, ids: '/metrics', share=0.1))
+    return routes
+
+
+def encode(scenario, i, ids):
+    if scenario.body is None:
+        return None
+    body = scenario.body(i, ids)
+    return body if isinstance(body, str) else json.dumps(body)
+
+
+def test_client_sender(app):
+    client = app.test_client()
+
+    def send(method, path, body, headers):
+        response = client.open(
+            path, method=method, data=body, headers=headers)
+        response.get_data()
+        return response.status_code
+
+    return send
+
+
+def http_sender(port):
+    def send(method, path, body, headers):
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        finally:
+            connection.close()
+
+    return send
+
+
+def run(app, send, scenario, requests, token, statements):
+    count = max(1, int(requests * scenario.share))
+    ids = []
+    if scenario.prepare:
+        with app.app_context():
+            ids = scenario.prepare(count)
+
+    headers = {
+        'Authorization': 'Bearer ' + token,
+        'Content-Type': scenario.content_type,
+    }
+    latencies, statuses = [], {}
+    first_statement = len(statements)
+    start = time.perf_counter()
+    for i in range(count):
+        path, body = scenario.path(i, ids), encode(scenario, i, ids)
+        sent = time.perf_counter()
+        status = send(scenario.method, path, body, headers)
+        latencies.append(time.perf_counter() - sent)
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    elapsed = time.perf_counter() - start
+
+    return {
+        'requests': count,
+        'throughput': count / elapsed,
+        'mean_ms': sum(latencies) / count * 1000,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p90_ms': percentile(latencies, 0.90) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'statements': (len(statements) - first_statement) / count,
+        'statuses': statuses,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(mode, results, baseline):
+    print('\n{}'.format(mode))
+    print('{:<26} {:>9} {:>9} {:>9} {:>9} {:>13}  {}'.format(
+        'route', 'req/s', 'p50 ms', 'p99 ms', 'queries',
+        'vs baseline' if baseline else '', 'statuses'))
+    for name, result in results.items():
+        # Change of req/s and p99 since the baseline run
+        change = ''
+        previous = (baseline or {}).get(mode, {}).get(name)
+        if previous:
+            change = '{:+.0f}% {:+.0f}%'.format(
+                (result['throughput'] / previous['throughput'] - 1) * 100,
+                (result['p99_ms'] / previous['p99_ms'] - 1) * 100)
+        print('{:<26} {:>9.0f} {:>9.2f} {:>9.2f} {:>9.1f} {:>13}  {}'.format(
+            name, result['throughput'], result['p50_ms'], result['p99_ms'],
+            result['statements'], change, result['statuses']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--movies', type=int, default=1000)
+    parser.add_argument('--cast', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument(
+        '--mode', nargs='+', choices=['client', 'http'],
+        default=['client', 'http'])
+    parser.add_argument(
+        '--only', nargs='+', default=None,
+        help='run only the routes whose name contains one of these')
+    parser.add_argument('--response-cache', action='store_true')
+    parser.add_argument('--metrics', action='store_true')
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument(
+        '--database', default='sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'api_bench.db'))
+    args = parser.parse_args()
+
+    key = SigningKey()
+    jwks_path = key.write_jwks(
+        os.path.join(tempfile.mkdtemp(), 'jwks.json'))
+    # Before flaskr is imported | its app reads them at import
+    os.environ.update(auth_environment(jwks_path))
+    os.environ.update(ENV='0', DATABASE_URI=args.database)
+    if not args.response_cache:
+        os.environ['RESPONSE_CACHE'] = 'none'
+    os.environ['METRICS_ENABLED'] = '1' if args.metrics else '0'
+
+    from sqlalchemy import event
+    from werkzeug.serving import make_server
+    from flaskr import app
+    from models import db
+
+    app.test_cli_runner().invoke(args=['create-schema'])
+    with app.app_context():
+        catalogue = seed_catalogue(args.actors, args.movies, args.cast)
+    # The seed is written behind the ORM | build its read model documents
+    app.test_cli_runner().invoke(args=['read-model', 'rebuild'])
+    with app.app_context():
+        dialect = db.engine.dialect.name
+        statements = []
+        event.listen(
+            db.engine, 'before_cursor_execute',
+            lambda *event_args: statements.append(1))
+
+    token = key.mint_token(PERMISSIONS)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = {}
+    try:
+        for mode in args.mode:
+            send = test_client_sender(app) if mode == 'client' else (
+                http_sender(server.server_port))
+            results[mode] = {}
+            for scenario in scenarios(catalogue, 'Bench {}'.format(mode)):
+                if args.only and not any(
+                        part in scenario.name for part in args.only):
+                    continue
+                results[mode][scenario.name] = run(
+                    app, send, scenario, args.requests, token, statements)
+            report(mode, results[mode], baseline)
+    finally:
+        server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'commit': git_commit(),
+                'date': datetime.datetime.utcnow().isoformat() + 'Z',
+                'python': platform.python_version(),
+                'database': dialect,
+                'catalogue': {
+                    'actors': args.actors,
+                    'movies': args.movies,
+                    'cast': args.cast,
+                },
+                'response_cache': args.response_cache,
+                'metrics': args.metrics,
+                'results': results,
+            }, output, indent=2)
+        print('\nsaved to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+'''
+Per-request authentication cost, with and without the verified-token cache
+
+    python -m benchmarks.auth_bench --requests 2000
+'''
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks.support import SigningKey, auth_environment, percentile
+
+
+def run(verify, token, requests):
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        verify(token)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def report(name, samples):
+    total = sum(samples)
+    print('{:<12} mean {:>9.1f}us  p50 {:>9.1f}us  p99 {:>9.1f}us  '
+          '{:>10.0f} req/s'.format(
+              name,
+              total / len(samples) * 1e6,
+              percentile(samples, 0.50) * 1e6,
+              percentile(samples, 0.99) * 1e6,
+              len(samples) / total))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    key = SigningKey()
+    jwks_path = key.write_jwks(
+        os.path.join(tempfile.mkdtemp(), 'jwks.json'))
+    os.environ.update(auth_environment(jwks_path))
+
+    from auth import auth
+
+    token = key.mint_token(['get:actors'])
+    # Warm up the key store, so only verification is measured
+    auth.verify_decode_jwt(token)
+
+    def uncached(token):
+        auth.token_cache.clear()
+        payload = auth.verify_decode_jwt(token)
+        auth.check_permissions('get:actors', payload)
+
+    def cached(token):
+        payload = auth.verify_decode_jwt(token)
+        auth.check_permissions('get:actors', payload)
+
+    report('uncached', run(uncached, token, args.requests))
+    auth.token_cache.clear()
+    report('cached', run(cached, token, args.requests))
+    print('token cache', auth.token_cache.stats())
+
+
+if __name__ == '__main__':
+    main()
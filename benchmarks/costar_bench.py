@@ -0,0 +1,78 @@
+'''
+Build time, memory and query latency of the co-star graph on a synthetic
+casting table with millions of edges
+
+    python -m benchmarks.costar_bench --actors 500000 --movies 200000 \\
+        --cast 10 --queries 200
+
+Movies cast mostly actors of their own era plus a few popular ones, so
+the graph has both long chains and hubs, like a real catalogue. The
+pairs are generated in memory, no database is needed.
+'''
+import argparse
+import random
+import time
+
+from benchmarks.support import percentile
+
+
+def synthetic_pairs(actors, movies, cast, seed=1):
+    rng = random.Random(seed)
+    popular = max(1, actors // 1000)
+    pairs = set()
+    for movie in range(1, movies + 1):
+        era = movie * actors // movies
+        for _ in range(cast):
+            if rng.random() < 0.1:
+                actor = rng.randint(1, popular)
+            else:
+                actor = min(actors, max(1, era + rng.randint(-500, 500)))
+            pairs.add((actor, movie))
+    return list(pairs)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--actors', type=int, default=500000)
+    parser.add_argument('--movies', type=int, default=200000)
+    parser.add_argument('--cast', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--max-degrees', type=int, default=6)
+    args = parser.parse_args()
+
+    from flaskr.costars import CostarGraph
+
+    pairs = synthetic_pairs(args.actors, args.movies, args.cast)
+    graph = CostarGraph()
+    start = time.perf_counter()
+    graph.build(pairs)
+    build = time.perf_counter() - start
+    size = sum(
+        len(values) * values.itemsize for values in (
+            graph._actor_offsets, graph._actor_movies,
+            graph._movie_offsets, graph._movie_actors))
+    print('{} edges  build {:.2f} s  {:.1f} MB'.format(
+        len(pairs), build, size / 1e6))
+
+    # Queries on actors that have a movie | the graph is already built
+    graph.refresh = lambda: None
+    rng = random.Random(2)
+    actors = sorted({actor for actor, _ in pairs})
+    for name, query in (
+            ('costars', lambda: graph.costars(rng.choice(actors))),
+            ('path', lambda: graph.path(
+                rng.choice(actors), rng.choice(actors), args.max_degrees))):
+        latencies, found = [], 0
+        for _ in range(args.queries):
+            start = time.perf_counter()
+            result = query()
+            latencies.append(time.perf_counter() - start)
+            found += bool(result)
+        print('{:<8} p50 {:>8.2f} ms  p99 {:>8.2f} ms  {}/{} found'.format(
+            name, percentile(latencies, 0.50) * 1000,
+            percentile(latencies, 0.99) * 1000, found, args.queries))
+
+
+if __name__ == '__main__':
+    main()
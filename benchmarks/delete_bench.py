@@ -0,0 +1,93 @@
+'''
+Time and SQL statements to delete an actor with 10, 1k and 10k castings,
+comparing the ORM deleting the casting rows itself (the old behaviour:
+it loads every movie of the actor, then deletes the rows one by one)
+with ON DELETE CASCADE and passive_deletes
+
+    python -m benchmarks.delete_bench --castings 10 1000 10000
+'''
+import argparse
+import os
+import tempfile
+import time
+
+# Use the development database settings | the path below
+os.environ['ENV'] = '0'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--castings', type=int, nargs='+', default=[10, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--database', default='sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'delete_bench.db'))
+    args = parser.parse_args()
+
+    from flask import Flask
+    from sqlalchemy import event
+    import models
+    from models import db, casting, gender_cache, Actor
+    from benchmarks.support import seed_catalogue
+
+    app = Flask(__name__)
+    models.setup_db(app, args.database)
+    statements = []
+    event.listen(
+        db.engine, 'before_cursor_execute',
+        lambda *event_args: statements.append(1))
+
+    # A movie for every casting of the biggest actor
+    with app.app_context():
+        db.create_all()
+        _, movie_ids = seed_catalogue(0, max(args.castings), 0)
+
+    # A new actor cast in the first `castings` movies | Return its id
+    def new_actor(castings, number):
+        actor = Actor('Bench prolific actor {}'.format(number), 40)
+        actor.gender_id = gender_cache.get_id('male')
+        db.session.add(actor)
+        db.session.flush()
+        db.session.execute(casting.insert(), [
+            {'movie_id': movie_id, 'actor_id': actor.id}
+            for movie_id in movie_ids[:castings]
+        ])
+        db.session.commit()
+        return actor.id
+
+    # The ORM loads the movies and deletes each casting row
+    def orm_delete(actor):
+        actor.movies.clear()
+        db.session.delete(actor)
+        models.stage()
+
+    # The database deletes the casting rows
+    def cascade_delete(actor):
+        actor.delete()
+
+    number = 0
+    for castings in args.castings:
+        for name, delete in (('orm', orm_delete),
+                             ('cascade', cascade_delete)):
+            timings = []
+            for _ in range(args.repeat):
+                number += 1
+                with app.app_context():
+                    actor_id = new_actor(castings, number)
+                    db.session.remove()
+                    start = time.perf_counter()
+                    first_statement = len(statements)
+                    delete(Actor.query.get(actor_id))
+                    models.commit()
+                    timings.append(time.perf_counter() - start)
+                    count = len(statements) - first_statement
+                    assert not db.session.execute(
+                        casting.select().where(
+                            casting.c.actor_id == actor_id)).first()
+            print('{:>6} castings  {:<8} {:>9.2f} ms  {:>3} statements'.format(
+                castings, name, min(timings) * 1000, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+'''
+Requests per second and latency of the app under gunicorn with many
+concurrent clients, for each worker class of gunicorn.conf.py
+
+    python -m benchmarks.loadtest --clients 500 --duration 10 \\
+        --worker-class sync gthread gevent
+
+Every client keeps a connection open (reconnecting when the worker
+closes it) and sends the next request as soon as it has the response.
+The app verifies a real RS256 token against a local key set and the
+response cache is off, so every request reaches the database.
+Point --database at PostgreSQL to see what gevent buys: SQLite queries
+never wait on a socket, so there is nothing for the other greenlets to
+run in meanwhile.
+'''
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.support import SigningKey, auth_environment, percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# gunicorn with this interpreter | it has no python -m entry point
+GUNICORN = 'from gunicorn.app.wsgiapp import run; run()'
+
+SEED = '''
+from benchmarks.support import seed_catalogue
+from flaskr import app
+from models import Actor
+
+app.test_cli_runner().invoke(args=['create-schema'])
+with app.app_context():
+    if not Actor.query.count():
+        seed_catalogue(1000, 1000, 5, prefix='Load')
+app.test_cli_runner().invoke(args=['read-model', 'rebuild'])
+'''
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_listening(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited with {}'.format(
+                process.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('gunicorn did not start in {}s'.format(timeout))
+
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed')
+    status = int(status_line.split()[1])
+    length, close = 0, False
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        name = name.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'connection' and value.strip().lower() == 'close':
+            close = True
+    await reader.readexactly(length)
+    return status, close
+
+
+async def client(port, request, deadline, latencies, errors):
+    reader = writer = None
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(
+                    '127.0.0.1', port)
+            writer.write(request)
+            status, close = await read_response(reader)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError):
+            errors.append('connection')
+            close = True
+        else:
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors.append(status)
+        if close and writer is not None:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def load(port, request, clients, duration):
+    latencies, errors = [], []
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*[
+        client(port, request, deadline, latencies, errors)
+        for _ in range(clients)
+    ])
+    return latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--worker-class', nargs='+', default=['sync', 'gthread', 'gevent'])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--path', default='/movies?limit=20')
+    parser.add_argument(
+        '--database', default='sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'loadtest.db'))
+    args = parser.parse_args()
+
+    key = SigningKey()
+    jwks_path = key.write_jwks(
+        os.path.join(tempfile.mkdtemp(), 'jwks.json'))
+    token = key.mint_token(['get:actors', 'get:movies'])
+    env = dict(os.environ, ENV='0', DATABASE_URI=args.database,
+               RESPONSE_CACHE='none', WEB_CONCURRENCY=str(args.workers),
+               **auth_environment(jwks_path))
+    # The pool has to cover every thread or greenlet of a worker
+    env.setdefault('DB_POOL_SIZE', '20')
+    subprocess.run(
+        [sys.executable, '-c', SEED], cwd=ROOT, env=env, check=True)
+
+    request = (
+        'GET {} HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+        'Authorization: Bearer {}\r\n\r\n'.format(args.path, token)
+    ).encode()
+
+    print('{} clients for {:.0f}s on {} ({} workers)'.format(
+        args.clients, args.duration, args.path, args.workers))
+    for worker_class in args.worker_class:
+        port = free_port()
+        server = subprocess.Popen(
+            [sys.executable, '-c', GUNICORN, '--config', 'gunicorn.conf.py',
+             '--bind', '127.0.0.1:{}'.format(port), '--log-level', 'warning',
+             'flaskr:app'],
+            cwd=ROOT, env=dict(env, WEB_WORKER_CLASS=worker_class))
+        try:
+            wait_until_listening(port, server)
+            latencies, errors = asyncio.run(
+                load(port, request, args.clients, args.duration))
+        finally:
+            server.terminate()
+            server.wait()
+
+        print('{:<8} {:>8.0f} req/s  p50 {:>8.1f}ms  p99 {:>8.1f}ms  '
+              '{} errors'.format(
+                  worker_class, len(latencies) / args.duration,
+                  percentile(latencies, 0.50) * 1000,
+                  percentile(latencies, 0.99) * 1000, len(errors)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+'''
+Time to build and serialise a list response of movies with their actors,
+comparing ORM objects with format() and jsonify (the old path) with rows
+from column tuples and the JSON provider (orjson when it is installed)
+
+    python -m benchmarks.serialization_bench --rows 10000 100000 --cast 3
+'''
+import argparse
+import datetime
+import os
+import tempfile
+import time
+
+# Use the development database settings | the path below
+os.environ['ENV'] = '0'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--rows', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--cast', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--database', default='sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'serialization_bench.db'))
+    args = parser.parse_args()
+
+    from flask import Flask, jsonify
+    from sqlalchemy.orm import selectinload
+    import models
+    from models import db, casting, Actor, Gender, Movie
+    from flaskr.json_provider import json_provider, stdlib_dumps
+
+    app = Flask(__name__)
+    models.setup_db(app, args.database)
+    json_provider.init_app(app)
+
+    # Enough movies for the biggest page | a small pool of actors
+    size = max(args.rows)
+    actors = max(size // 10, args.cast)
+    with app.app_context():
+        db.create_all()
+        db.session.add(Gender('male'))
+        db.session.flush()
+        db.session.execute(Actor.__table__.insert(), [
+            {'name': 'Bench actor {}'.format(number), 'age': 30,
+             'gender_id': 1}
+            for number in range(actors)
+        ])
+        db.session.execute(Movie.__table__.insert(), [
+            {'title': 'Bench movie {}'.format(number),
+             'release_date': datetime.datetime(2000 + number % 20, 1, 1)}
+            for number in range(size)
+        ])
+        db.session.execute(casting.insert(), [
+            {'movie_id': movie, 'actor_id': (movie + offset) % actors + 1}
+            for movie in range(1, size + 1) for offset in range(args.cast)
+        ])
+        db.session.commit()
+
+    fields = list(Movie.formatters)
+
+    def orm_jsonify(limit):
+        movies = Movie.query.options(selectinload(Movie.actors)).order_by(
+            Movie.id).limit(limit).all()
+        return jsonify({'movies': [movie.format() for movie in movies]})
+
+    def rows_json(limit):
+        movies, _ = Movie.page(fields, limit=limit)
+        return app.response_class(
+            stdlib_dumps({'movies': movies}), mimetype='application/json')
+
+    def rows_provider(limit):
+        movies, _ = Movie.page(fields, limit=limit)
+        return json_provider.response({'movies': movies})
+
+    print('json provider: {}'.format(json_provider.backend))
+    for limit in args.rows:
+        for name, build in (('orm+jsonify', orm_jsonify),
+                            ('rows+json', rows_json),
+                            ('rows+' + json_provider.backend, rows_provider)):
+            timings = []
+            for _ in range(args.repeat):
+                with app.test_request_context():
+                    start = time.perf_counter()
+                    body = build(limit).get_data()
+                    timings.append(time.perf_counter() - start)
+                    db.session.remove()
+            print('{:>7} rows  {:<14} {:>9.1f} ms  {:>6.1f} MB'.format(
+                limit, name, min(timings) * 1000, len(body) / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+'''
+Cold start: time from importing the app to its first response, each run
+in a fresh interpreter like a new gunicorn worker. Exits with an error if
+the median is over --max-ms, so it can guard against regressions
+
+    python -m benchmarks.startup_bench --runs 5 --max-ms 2000
+'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCHEMA = '''
+from flaskr import app
+app.test_cli_runner().invoke(args=['create-schema'])
+'''
+
+COLD_START = '''
+import time
+start = time.perf_counter()
+from flaskr import app
+imported = time.perf_counter()
+response = app.test_client().get('/actors?limit=1')
+assert response.status_code == 200, response.data
+print(imported - start, time.perf_counter() - start)
+'''
+
+
+def run(code, env):
+    return subprocess.run(
+        [sys.executable, '-c', code], cwd=ROOT, env=env, check=True,
+        stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-ms', type=float, default=None)
+    parser.add_argument(
+        '--database', default='sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'startup_bench.db'))
+    args = parser.parse_args()
+
+    env = dict(os.environ, ENV='0', AUTH_STATUS='0',
+               DATABASE_URI=args.database)
+    run(SCHEMA, env)
+
+    imports, totals = [], []
+    for _ in range(args.runs):
+        imported, total = run(COLD_START, env).split()
+        imports.append(float(imported) * 1000)
+        totals.append(float(total) * 1000)
+
+    median = statistics.median(totals)
+    print('import {:.0f}ms  import to first response {:.0f}ms '
+          '(median of {} runs)'.format(
+              statistics.median(imports), median, args.runs))
+    if args.max_ms is not None and median > args.max_ms:
+        sys.exit('Cold start regressed: {:.0f}ms > {:.0f}ms'.format(
+            median, args.max_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import base64
+import json
+import time
+import rsa
+from jose import jwt
+
+
+'''
+Local stand-ins for Auth0, so the benchmarks run without network access
+'''
+
+BENCH_DOMAIN = 'bench.local'
+BENCH_AUDIENCE = 'capstone'
+BENCH_KID = 'bench-key'
+
+
+def _b64(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+'''
+SigningKey
+    An RSA key pair that can publish its public half as a JWKS document
+    and mint RS256 access tokens the way Auth0 does
+'''
+
+
+class SigningKey:
+    def __init__(self, kid=BENCH_KID, bits=2048):
+        self.kid = kid
+        self.public_key, self.private_key = rsa.newkeys(bits)
+
+    def jwks(self):
+        return {'keys': [{
+            'kty': 'RSA',
+            'kid': self.kid,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': _b64(self.public_key.n),
+            'e': _b64(self.public_key.e),
+        }]}
+
+    def write_jwks(self, path):
+        with open(path, 'w') as jwks_file:
+            json.dump(self.jwks(), jwks_file)
+        return path
+
+    def mint_token(self, permissions, expires_in=3600, subject='bench|1'):
+        now = int(time.time())
+        claims = {
+            'iss': 'https://' + BENCH_DOMAIN + '/',
+            'sub': subject,
+            'aud': BENCH_AUDIENCE,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions),
+        }
+        return jwt.encode(
+            claims,
+            self.private_key.save_pkcs1().decode(),
+            algorithm='RS256',
+            headers={'kid': self.kid}
+        )
+
+
+def auth_environment(jwks_path):
+    '''
+    Environment variables that point auth.auth at the local key set.
+    They have to be set before auth.auth is imported.
+    '''
+    return {
+        'AUTH0_DOMAIN': BENCH_DOMAIN,
+        'API_AUDIENCE': BENCH_AUDIENCE,
+        'ALGORITHMS': 'RS256',
+        'JWKS_URL': jwks_path,
+        'AUTH_STATUS': '1',
+    }
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def seed_catalogue(actors, movies, cast, prefix='Bench'):
+    '''
+    Insert a synthetic catalogue in a few executemany statements:
+    actors of both genders and movies with `cast` actors each.
+    Needs an app context and the schema | Return the actor ids and the
+    movie ids, in the order of their names
+    '''
+    import datetime
+    from models import db, casting, Actor, Gender, Movie
+
+    for gender in ('male', 'female'):
+        if not Gender.query.filter_by(gender=gender).count():
+            db.session.add(Gender(gender))
+    db.session.flush()
+    genders = [
+        Gender.query.filter_by(gender=gender).one().id
+        for gender in ('male', 'female')
+    ]
+
+    actor_names = ['{} actor {}'.format(prefix, n) for n in range(actors)]
+    movie_titles = ['{} movie {}'.format(prefix, n) for n in range(movies)]
+    if actors:
+        db.session.execute(Actor.__table__.insert(), [
+            {'name': name, 'age': 18 + n % 60, 'gender_id': genders[n % 2]}
+            for n, name in enumerate(actor_names)
+        ])
+    if movies:
+        db.session.execute(Movie.__table__.insert(), [
+            {'title': title,
+             'release_date': datetime.datetime(1990 + n % 30, 1, 1)}
+            for n, title in enumerate(movie_titles)
+        ])
+
+    # The ids come from the database | no explicit ids, the sequences
+    # of PostgreSQL would not move past them
+    actor_ids = dict(db.session.query(Actor.name, Actor.id).filter(
+        Actor.name.like(prefix + ' actor %')))
+    movie_ids = dict(db.session.query(Movie.title, Movie.id).filter(
+        Movie.title.like(prefix + ' movie %')))
+    actor_ids = [actor_ids[name] for name in actor_names]
+    movie_ids = [movie_ids[title] for title in movie_titles]
+
+    if actors and movies and cast:
+        db.session.execute(casting.insert(), [
+            {'movie_id': movie_id,
+             'actor_id': actor_ids[(n + offset) % actors]}
+            for n, movie_id in enumerate(movie_ids)
+            for offset in range(min(cast, actors))
+        ])
+    db.session.commit()
+    return actor_ids, movie_ids
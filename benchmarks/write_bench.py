@@ -0,0 +1,81 @@
+'''
+Commits per request and write throughput of movie creation, comparing a
+commit after every model call (the old behaviour) with one commit per
+request through the unit of work
+
+    python -m benchmarks.write_bench --movies 500 --cast 5
+'''
+import argparse
+import datetime
+import os
+import tempfile
+import time
+
+# Use the development database settings | the path below
+os.environ['ENV'] = '0'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--movies', type=int, default=500)
+    parser.add_argument('--cast', type=int, default=5)
+    parser.add_argument(
+        '--database', default='sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'write_bench.db'))
+    args = parser.parse_args()
+
+    from flask import Flask
+    from sqlalchemy import event
+    import models
+    from models import db, Actor, Gender, Movie
+
+    app = Flask(__name__)
+    models.setup_db(app, args.database)
+    commits = []
+    event.listen(db.engine, 'commit', lambda connection: commits.append(1))
+
+    with app.app_context():
+        db.create_all()
+        gender = Gender('male')
+        db.session.add(gender)
+        db.session.flush()
+        actors = []
+        for number in range(args.cast):
+            actor = Actor('Bench actor {}'.format(number), 30)
+            actor.gender_id = gender.id
+            actors.append(actor)
+        db.session.add_all(actors)
+        db.session.commit()
+        actor_ids = [actor.id for actor in actors]
+
+    # One POST /movies, committing after each model call like before
+    def per_call(title):
+        movie = Movie(title, datetime.datetime(2020, 1, 1))
+        movie.insert()
+        models.commit()
+        movie.insert_actors(Actor.query.filter(
+            Actor.id.in_(actor_ids)).all())
+        models.commit()
+
+    # One POST /movies, committed once at the request boundary
+    def unit_of_work(title):
+        movie = Movie(title, datetime.datetime(2020, 1, 1))
+        movie.insert()
+        movie.insert_actors(Actor.query.filter(
+            Actor.id.in_(actor_ids)).all())
+        models.commit()
+
+    for name, create in (('per-call', per_call),
+                         ('unit-of-work', unit_of_work)):
+        del commits[:]
+        start = time.perf_counter()
+        for number in range(args.movies):
+            with app.test_request_context():
+                create('{} movie {}'.format(name, number))
+        elapsed = time.perf_counter() - start
+        print('{:<14} {:.2f} commits/request  {:>8.0f} movies/s'.format(
+            name, len(commits) / args.movies, args.movies / elapsed))
+
+
+if __name__ == '__main__':
+    main()
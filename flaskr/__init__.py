@@ -1,16 +1,56 @@
+import io
 import os
 import datetime
-from flask import Flask, jsonify, request, abort
-from sqlalchemy import event
-from models import setup_db, Actor, Movie, Gender
+import click
+from flask import (
+    Flask, Response, jsonify, request, abort, stream_with_context)
+from sqlalchemy import event, false
+from models import (
+    db, setup_db, count_rows, commit, existing_ids, gender_cache, Actor,
+    Movie)
 from auth.auth import requires_auth
+from .batch import BatchWriter
+from .bulk import CatalogueImporter, read_rows
+from .costars import costar_graph, DEGREES, MAX_DEGREES
+from .export import export
+from .json_provider import json_provider
+from .metrics import metrics
+from .query_audit import query_audit
+from .read_model import read_model
+from .response_cache import response_cache
+from .search import search_hits, MIN_QUERY_LENGTH, TARGETS
+from .stats import stats_cache
+
+# Default and maximum number of rows in a page of /actors or /movies
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', 100))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 1000))
+# Most items in one batch PATCH or DELETE
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', 1000))
 
 
 def create_app(test_config=None):
     app = Flask(__name__)
 
-    # Setup Database
-    setup_db(app)
+    # Setup Database | nothing connects to it until the first request
+    test_config = test_config or {}
+    setup_db(
+        app, test_config.get('SQLALCHEMY_DATABASE_URI', ''),
+        test_config.get('DATABASE_REPLICA_URIS', ''))
+    app.config.update(test_config)
+    # Cache of the GET responses | invalidated by every committed write
+    response_cache.init_app(app)
+    # Serialiser of the list responses | orjson when it is installed
+    json_provider.init_app(app)
+    # Latency, SQL and auth timings | when METRICS_ENABLED is 1
+    metrics.init_app(app)
+    # N+1, slow statement and query budget checks | when QUERY_AUDIT is 1
+    query_audit.init_app(app)
+    # Precomputed movie and actor documents | when READ_MODEL_ENABLED is 1
+    read_model.init_app(app)
+    # Aggregates of /stats | dropped by the writes to their tables
+    stats_cache.init_app(app)
+    # Co-star graph | built on the first query, then kept up to date
+    costar_graph.init_app(app)
 
     '''
 
@@ -22,15 +62,98 @@ def create_app(test_config=None):
     def index():
         return 'Hello, Reference: https://github.com/YoHaNoMe/capstone_udacity'
 
+    # Get an optional integer query parameter | Bad Request if it is not int
+    def get_int_arg(name, default=None):
+        value = request.args.get(name)
+        if value is None:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            abort(400)
+
+    # Get limit, after and fields of a list endpoint
+    def get_page_args(model):
+        limit = get_int_arg('limit', PAGE_SIZE)
+        after = get_int_arg('after')
+
+        # Check that the page size is in range
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            abort(400)
+
+        # Projection | only the requested fields, in the model order
+        fields = None
+        if request.args.get('fields'):
+            fields = [
+                field.strip() for field in request.args['fields'].split(',')
+            ]
+            if not set(fields) <= set(model.formatters):
+                abort(400)
+            fields = [field for field in model.formatters if field in fields]
+
+        return limit, after, fields or list(model.formatters)
+
+    # Prefix match that uses the index | escape LIKE wildcards
+    def starts_with(column, prefix):
+        prefix = prefix.replace('\\', '\\\\').replace(
+            '%', '\\%').replace('_', '\\_')
+        return column.like(prefix + '%', escape='\\')
+
+    # Get the list of a batch request | e.g. {"ids": [1, 2]}
+    def get_batch(key):
+        body = request.get_json()
+        items = body.get(key) if isinstance(body, dict) else None
+        if not isinstance(items, list) or not items or (
+                len(items) > MAX_BATCH_SIZE):
+            abort(400)
+        return items
+
+    # Apply a batch in one transaction | per item status in results
+    def write_batch(model, action, items):
+        try:
+            report = getattr(BatchWriter(model), action)(items)
+        except Exception as e:
+            app.logger.exception(
+                'Cannot %s %s', action, model.__tablename__)
+            abort(422)
+        report.update({'success': True, 'status_code': 200})
+        return jsonify(report)
+
     @app.route('/actors')
     @requires_auth(permission='get:actors')
+    @response_cache.cached
     def get_actors():
-        # Get all actors | if no id provided
-        actors = [actor.format() for actor in Actor.query.all()]
-
-        return jsonify({
+        limit, after, fields = get_page_args(Actor)
+
+        # Filters | compiled to SQL
+        filters = []
+        min_age = get_int_arg('min_age')
+        max_age = get_int_arg('max_age')
+        if min_age is not None:
+            filters.append(Actor.age >= min_age)
+        if max_age is not None:
+            filters.append(Actor.age <= max_age)
+        if request.args.get('gender'):
+            gender_id = gender_cache.get_id(request.args['gender'])
+            filters.append(
+                Actor.gender_id == gender_id if gender_id else false())
+        if request.args.get('name'):
+            filters.append(starts_with(Actor.name, request.args['name']))
+
+        # Documents of the read model when it is on | else rows from
+        # column tuples and the movies in one more query
+        if read_model.enabled:
+            actors, next_cursor = read_model.page(
+                Actor, fields, filters, after, limit)
+        else:
+            actors, next_cursor = Actor.page(fields, filters, after, limit)
+
+        total, estimated = count_rows(Actor, *filters)
+        return json_provider.response({
             'actors': actors,
-            'total_actors': len(actors),
+            'total_actors': total,
+            'total_estimated': estimated,
+            'next_cursor': next_cursor,
             'success': True,
             'status_code': 200,
         })
@@ -67,16 +190,15 @@ def create_app(test_config=None):
             age,
         )
 
-        # Gender for actor
-        actor_gender = Gender.query.filter_by(
-                gender=gender.replace(' ', '').lower()).first()
+        # Gender for actor | from the gender cache
+        gender_id = gender_cache.get_id(gender)
 
         # Check if the gender is wrong | Not in database
-        if not actor_gender:
+        if not gender_id:
             abort(400)
 
         # Add Gender , Actor relationship
-        actor_gender.actors.append(actor)
+        actor.gender_id = gender_id
 
         # Insert actor to database
         try:
@@ -87,7 +209,7 @@ def create_app(test_config=None):
                 'actor_id': actor.id,
             })
         except Exception as e:
-            print(e)
+            app.logger.exception('Cannot insert actor')
             abort(422)
 
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
@@ -103,6 +225,7 @@ def create_app(test_config=None):
                 'actor_id': actor.id,
             })
         except Exception as e:
+            app.logger.exception('Cannot delete actor %s', actor_id)
             abort(422)
 
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
@@ -133,22 +256,15 @@ def create_app(test_config=None):
 
         # Check if there is gender
         if gender:
-            # Get the new gender | if there is a new one
-            actor_gender_new = Gender.query.filter_by(
-                gender=gender.replace(' ', '').lower()
-                ).first()
+            # Get the new gender | from the gender cache
+            gender_id = gender_cache.get_id(gender)
 
             # Check if the gender passed from user is right
-            if not actor_gender_new:
+            if not gender_id:
                 abort(400)
 
-            # Get the old gender
-            actor_gender_old = Gender.query.get(actor.gender_id)
-
-            # Check that new Actor gender differrent than the old Actor gender
-            if actor_gender_new.gender != actor_gender_old.gender:
-                # Add the actor to the new gender
-                actor_gender_new.actors.append(actor)
+            # Move the actor to the new gender | no-op if it is the same
+            actor.gender_id = gender_id
 
         try:
             actor.update()
@@ -158,8 +274,81 @@ def create_app(test_config=None):
                 'status_code': 200,
             })
         except Exception as e:
+            app.logger.exception('Cannot update actor %s', actor_id)
             abort(422)
 
+    @app.route('/actors', methods=['PATCH'])
+    @requires_auth(permission='patch:actors')
+    def update_actors():
+        return write_batch(Actor, 'update', get_batch('actors'))
+
+    @app.route('/actors', methods=['DELETE'])
+    @requires_auth(permission='delete:actors')
+    def delete_actors():
+        return write_batch(Actor, 'delete', get_batch('ids'))
+
+    # Names of the ids | id => name
+    def get_names(model, column, ids):
+        return dict(db.session.query(model.id, column).filter(
+            model.id.in_(list(ids)))) if ids else {}
+
+    @app.route('/actors/<int:actor_id>/costars')
+    @requires_auth(permission='get:actors')
+    def get_costars(actor_id):
+        limit = get_int_arg('limit', PAGE_SIZE)
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            abort(400)
+        if not existing_ids(Actor, [actor_id]):
+            abort(404)
+
+        # Most shared movies first
+        shared = costar_graph.costars(actor_id)
+        top = sorted(shared, key=lambda costar: (-shared[costar], costar))
+        names = get_names(Actor, Actor.name, top[:limit])
+        return json_provider.response({
+            'costars': [
+                {'id': costar, 'name': names[costar],
+                 'shared_movies': shared[costar]}
+                for costar in top[:limit] if costar in names
+            ],
+            'total_costars': len(shared),
+            'success': True,
+            'status_code': 200,
+        })
+
+    @app.route('/actors/<int:actor_id>/path/<int:other_id>')
+    @requires_auth(permission=('get:actors', 'get:movies'))
+    def get_costar_path(actor_id, other_id):
+        max_degrees = get_int_arg('max_degrees', DEGREES)
+        if max_degrees < 1 or max_degrees > MAX_DEGREES:
+            abort(400)
+        if len(existing_ids(Actor, {actor_id, other_id})) < len(
+                {actor_id, other_id}):
+            abort(404)
+
+        # Actor, movie, actor ... other | none when they aren't connected
+        path = costar_graph.path(actor_id, other_id, max_degrees)
+        if path is None:
+            return json_provider.response({
+                'path': None,
+                'degrees': None,
+                'success': True,
+                'status_code': 200,
+            })
+        actors = get_names(Actor, Actor.name, path[::2])
+        movies = get_names(Movie, Movie.title, path[1::2])
+        return json_provider.response({
+            'path': [
+                {'type': 'movie', 'id': key, 'title': movies.get(key)}
+                if position % 2 else
+                {'type': 'actor', 'id': key, 'name': actors.get(key)}
+                for position, key in enumerate(path)
+            ],
+            'degrees': len(path) // 2,
+            'success': True,
+            'status_code': 200,
+        })
+
     '''
 
     Movie Route
@@ -180,18 +369,68 @@ def create_app(test_config=None):
 
         return day, month, year
 
+    # Convert date from Str (d/m/y) to a datetime object
+    def convert_datetime(release_date):
+        try:
+            day, month, year = convert_date(release_date)
+            return datetime.datetime(year, month, day)
+        except ValueError:
+            abort(400)
+
     @app.route('/movies')
     @requires_auth(permission='get:movies')
+    @response_cache.cached
     def get_movies():
-        movies = [movie.format() for movie in Movie.query.all()]
-
-        return jsonify({
+        limit, after, fields = get_page_args(Movie)
+
+        # Filters | compiled to SQL
+        filters = []
+        if request.args.get('released_after'):
+            filters.append(Movie.release_date >= convert_datetime(
+                request.args['released_after']))
+        if request.args.get('released_before'):
+            filters.append(Movie.release_date <= convert_datetime(
+                request.args['released_before']))
+        if request.args.get('title'):
+            filters.append(starts_with(Movie.title, request.args['title']))
+
+        # Documents of the read model when it is on | else rows from
+        # column tuples and the actors in one more query
+        if read_model.enabled:
+            movies, next_cursor = read_model.page(
+                Movie, fields, filters, after, limit)
+        else:
+            movies, next_cursor = Movie.page(fields, filters, after, limit)
+
+        total, estimated = count_rows(Movie, *filters)
+        return json_provider.response({
             'movies': movies,
-            'total_movies': len(movies),
+            'total_movies': total,
+            'total_estimated': estimated,
+            'next_cursor': next_cursor,
             'success': True,
             'status_code': 200,
         })
 
+    # Get actors by id in one query | Return actors, missing ids
+    def get_actors_by_ids(actor_ids):
+        # Check that the ids are integers
+        if not all(isinstance(actor_id, int) and not isinstance(
+                actor_id, bool) for actor_id in actor_ids):
+            abort(400)
+
+        # Collapse duplicate ids | keep the request order
+        actor_ids = list(dict.fromkeys(actor_ids))
+        found = {
+            actor.id: actor
+            for actor in Actor.query.filter(Actor.id.in_(actor_ids)).all()
+        } if actor_ids else {}
+
+        return (
+            [found[actor_id] for actor_id in actor_ids if actor_id in found],
+            [actor_id for actor_id in actor_ids if actor_id not in found]
+        )
+
     @app.route('/movies', methods=['POST'])
     @requires_auth(permission='post:movies')
     def add_movie():
@@ -217,11 +456,7 @@ def create_app(test_config=None):
             abort(400)
 
         # Setup actors objects
-        actors_obj = [
-            Actor.query.get(actor)
-            for actor in actors
-            if Actor.query.get(actor) is not None
-        ]
+        actors_obj, missing_actors = get_actors_by_ids(actors)
 
         # Check that there is at least one actor exists
         if not actors_obj:
@@ -244,11 +479,12 @@ def create_app(test_config=None):
             movie.insert_actors(actors_obj)
             return jsonify({
                 'movie_id': movie.id,
+                'missing_actors': missing_actors,
                 'success': True,
                 'status_code': 201
             })
         except Exception as e:
-            print(e)
+            app.logger.exception('Cannot insert movie')
             abort(422)
 
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
@@ -264,6 +500,7 @@ def create_app(test_config=None):
                 'status_code': 200
             })
         except Exception as e:
+            app.logger.exception('Cannot delete movie %s', movie_id)
             abort(422)
 
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
@@ -302,24 +539,191 @@ def create_app(test_config=None):
             except Exception as e:
                 abort(400)
 
+        # Setup actors objects
+        actors_obj, missing_actors = get_actors_by_ids(actors)
+
+        # None of the actors exist | the cast would be emptied
+        if actors and not actors_obj:
+            abort(422)
+
         try:
             movie.update()
             # Update Actors
             if actors:
-                actors_obj = [
-                    Actor.query.get(actor)
-                    for actor in actors
-                    if Actor.query.get(actor) is not None
-                ]
                 movie.update_actors(actors_obj)
             return jsonify({
                 'movie': movie.format(),
+                'missing_actors': missing_actors,
                 'success': True,
                 'status_code': 200,
             })
         except Exception as e:
+            app.logger.exception('Cannot update movie %s', movie_id)
             abort(422)
 
+    @app.route('/movies', methods=['PATCH'])
+    @requires_auth(permission='patch:movies')
+    def update_movies():
+        return write_batch(Movie, 'update', get_batch('movies'))
+
+    @app.route('/movies', methods=['DELETE'])
+    @requires_auth(permission='delete:movies')
+    def delete_movies():
+        return write_batch(Movie, 'delete', get_batch('ids'))
+
+    '''
+
+    Search Route
+
+    '''
+
+    @app.route('/search')
+    @requires_auth(permission=('get:actors', 'get:movies'))
+    def search_catalogue():
+        q = request.args.get('q', '').strip()
+        limit = get_int_arg('limit', 10)
+        offset = get_int_arg('offset', 0)
+        types = request.args.get('type', 'movie,actor').split(',')
+
+        # Check the query and the page
+        if len(q) < MIN_QUERY_LENGTH or not set(types) <= set(TARGETS) or (
+                limit < 1 or limit > MAX_PAGE_SIZE or offset < 0):
+            abort(400)
+
+        hits, more = search_hits(q, types, limit, offset)
+        return json_provider.response({
+            'hits': [
+                {'type': kind, 'id': key, 'name': name, 'score': score}
+                for kind, key, name, score in hits
+            ],
+            'next_offset': offset + limit if more else None,
+            'success': True,
+            'status_code': 200,
+        })
+
+    '''
+
+    Stats Route
+
+    '''
+
+    # Most cast actors | limit from the query, 10 by default
+    def get_top_actors():
+        limit = get_int_arg('limit', 10)
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            abort(400)
+        return stats_cache.get('top_actors', limit)
+
+    @app.route('/stats')
+    @requires_auth(permission=('get:actors', 'get:movies'))
+    def get_stats():
+        return json_provider.response({
+            'genders': stats_cache.get('genders'),
+            'cast_size': stats_cache.get('cast_size'),
+            'release_years': stats_cache.get('release_years'),
+            'top_actors': get_top_actors(),
+            'success': True,
+            'status_code': 200,
+        })
+
+    @app.route('/stats/genders')
+    @requires_auth(permission='get:actors')
+    def get_gender_stats():
+        return json_provider.response({
+            'genders': stats_cache.get('genders'),
+            'success': True,
+            'status_code': 200,
+        })
+
+    @app.route('/stats/cast-size')
+    @requires_auth(permission='get:movies')
+    def get_cast_size_stats():
+        return json_provider.response({
+            'cast_size': stats_cache.get('cast_size'),
+            'success': True,
+            'status_code': 200,
+        })
+
+    @app.route('/stats/release-years')
+    @requires_auth(permission='get:movies')
+    def get_release_year_stats():
+        return json_provider.response({
+            'release_years': stats_cache.get('release_years'),
+            'success': True,
+            'status_code': 200,
+        })
+
+    @app.route('/stats/top-actors')
+    @requires_auth(permission=('get:actors', 'get:movies'))
+    def get_top_actor_stats():
+        return json_provider.response({
+            'top_actors': get_top_actors(),
+            'success': True,
+            'status_code': 200,
+        })
+
+    '''
+
+    Bulk Route
+
+    '''
+
+    @app.route('/bulk', methods=['POST'])
+    @requires_auth(permission=('post:actors', 'post:movies'))
+    def bulk_import():
+        # NDJSON by default | CSV with ?format=csv or a text/csv body
+        fmt = request.args.get('format') or (
+            'csv' if request.mimetype == 'text/csv' else 'ndjson')
+        if fmt not in ('ndjson', 'csv'):
+            abort(400)
+
+        lines = io.TextIOWrapper(request.stream, encoding='utf-8')
+        try:
+            report = CatalogueImporter().run(read_rows(lines, fmt))
+        except UnicodeDecodeError:
+            abort(400)
+
+        report.update({'success': True, 'status_code': 200})
+        return jsonify(report)
+
+    @app.cli.command('import-catalogue')
+    @click.argument('file', type=click.File('r', encoding='utf-8'))
+    @click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']),
+                  default='ndjson')
+    def import_catalogue(file, fmt):
+        """Import actors, movies and castings from an NDJSON or CSV file."""
+        report = CatalogueImporter().run(read_rows(file, fmt))
+        commit()
+        for error in report['errors']:
+            click.echo('line {line}: {error}'.format(**error), err=True)
+        click.echo('inserted {inserted}, skipped {skipped}, '
+                   '{total_errors} errors'.format(**report))
+
+    '''
+
+    Export Route
+
+    '''
+
+    # Stream the whole table | rows are sent while the query still runs
+    def stream_export(resource):
+        fmt = request.args.get('format', 'ndjson')
+        if fmt not in ('ndjson', 'csv'):
+            abort(400)
+
+        chunks, mimetype = export(resource, fmt)
+        return Response(stream_with_context(chunks), mimetype=mimetype)
+
+    @app.route('/export/actors')
+    @requires_auth(permission='get:actors')
+    def export_actors():
+        return stream_export('actors')
+
+    @app.route('/export/movies')
+    @requires_auth(permission='get:movies')
+    def export_movies():
+        return stream_export('movies')
+
     def get_error_msg(status_code, msg):
         return jsonify({
             'message': msg,
@@ -344,6 +748,10 @@ def create_app(test_config=None):
         return (get_error_msg(
             401, 'You don\'t have Authorization to access this endpoint'), 401)
 
+    @app.errorhandler(500)
+    def internal_error(e):
+        return (get_error_msg(500, 'Internal Server Error'), 500)
+
     return app
 
 
@@ -0,0 +1,181 @@
+import datetime
+from models import (
+    db, gender_cache, existing_ids, delete_rows, update_rows, replace_casts,
+    Actor, Movie)
+from .validation import is_id, get_text
+
+
+class BatchWriter:
+    '''
+    Apply many PATCH or DELETE items of movies or actors in one transaction
+
+    Every item gets a status in results, in the order of the request:
+        200: updated or deleted
+        400: the item is wrong (its error says why)
+        404: no row has its id
+        409: its title or name is taken by another row
+    The items that passed are then written with set-based statements
+    (see the batch writes of models): ids, titles, names and actors are
+    checked in one query each, not one per item.
+    '''
+
+    def __init__(self, model):
+        self.model = model
+        # The column that must be unique | title or name
+        self.unique = 'title' if model is Movie else 'name'
+        self.results = []
+
+    def report(self):
+        errors = sum(result['status'] != 200 for result in self.results)
+        return {
+            'results': sorted(
+                self.results, key=lambda result: result['index']),
+            'total_errors': errors,
+        }
+
+    def fail(self, index, row_id, status, error):
+        self.results.append({
+            'index': index, 'id': row_id, 'status': status, 'error': error})
+
+    # Ids that are not ints or that come twice | index => id of the others
+    def check_ids(self, ids):
+        checked, seen = {}, set()
+        for index, row_id in enumerate(ids):
+            if not is_id(row_id):
+                self.fail(index, None, 400, 'id must be an integer')
+            elif row_id in seen:
+                self.fail(index, row_id, 400, 'duplicate id in batch')
+            else:
+                seen.add(row_id)
+                checked[index] = row_id
+        return checked
+
+    def check_existing(self, checked):
+        found = existing_ids(self.model, checked.values())
+        for index, row_id in list(checked.items()):
+            if row_id not in found:
+                self.fail(index, row_id, 404, 'not found')
+                del checked[index]
+        return checked
+
+    def delete(self, ids):
+        checked = self.check_existing(self.check_ids(ids))
+        if checked:
+            delete_rows(self.model, set(checked.values()))
+        self.results.extend(
+            {'index': index, 'id': row_id, 'status': 200}
+            for index, row_id in checked.items())
+        return dict(self.report(), deleted=len(checked))
+
+    def update(self, items):
+        validate = (
+            self._validate_movie if self.model is Movie
+            else self._validate_actor)
+        checked = self.check_ids([
+            item.get('id') if isinstance(item, dict) else None
+            for item in items
+        ])
+        changes = {}
+        for index, row_id in checked.items():
+            try:
+                changes[index] = validate(items[index])
+            except ValueError as e:
+                self.fail(index, row_id, 400, str(e))
+        checked = self.check_existing({
+            index: row_id for index, row_id in checked.items()
+            if index in changes
+        })
+        self._check_unique(checked, changes)
+
+        values = {
+            checked[index]: changes[index][0] for index in checked
+            if changes[index][0]
+        }
+        casts = {
+            checked[index]: changes[index][1] for index in checked
+            if changes[index][1] is not None
+        }
+        missing = self._check_actors(casts) if casts else {}
+        if values:
+            update_rows(self.model, values)
+        if casts:
+            replace_casts(casts)
+
+        for index, row_id in checked.items():
+            result = {'index': index, 'id': row_id, 'status': 200}
+            if row_id in missing:
+                result['missing_actors'] = missing[row_id]
+            self.results.append(result)
+        return dict(self.report(), updated=len(checked))
+
+    # A new title or name must not be taken, in the database or by an
+    # earlier item of the batch
+    def _check_unique(self, checked, changes):
+        column = getattr(self.model, self.unique)
+        wanted = {
+            index: changes[index][0][self.unique] for index in checked
+            if self.unique in changes[index][0]
+        }
+        owners = dict(db.session.query(column, self.model.id).filter(
+            column.in_(list(set(wanted.values()))))) if wanted else {}
+
+        for index, value in sorted(wanted.items()):
+            row_id = checked[index]
+            if owners.get(value, row_id) != row_id:
+                self.fail(index, row_id, 409, '{} {} is taken'.format(
+                    self.unique, value))
+                del checked[index]
+            else:
+                owners[value] = row_id
+
+    # Cast the actors that exist | movie id => ids of the missing ones
+    def _check_actors(self, casts):
+        found = existing_ids(Actor, {
+            actor_id for actor_ids in casts.values()
+            for actor_id in actor_ids
+        })
+        missing = {}
+        for movie_id, actor_ids in casts.items():
+            missing[movie_id] = [
+                actor_id for actor_id in actor_ids if actor_id not in found]
+            casts[movie_id] = [
+                actor_id for actor_id in actor_ids if actor_id in found]
+        return missing
+
+    # Return the column values, actor ids (None when not given)
+    def _validate_movie(self, item):
+        values, actors = {}, None
+        if 'title' in item:
+            values['title'] = get_text(item, 'title')
+        if 'release_date' in item:
+            try:
+                values['release_date'] = datetime.datetime.strptime(
+                    get_text(item, 'release_date'), '%d/%m/%Y')
+            except ValueError:
+                raise ValueError('release_date must be d/m/y')
+        if 'actors' in item:
+            actors = item['actors']
+            if not isinstance(actors, list) or not all(
+                    is_id(actor_id) for actor_id in actors):
+                raise ValueError('actors must be a list of ids')
+            actors = list(dict.fromkeys(actors))
+        if not values and actors is None:
+            raise ValueError('nothing to change')
+        return values, actors
+
+    def _validate_actor(self, item):
+        values = {}
+        if 'name' in item:
+            values['name'] = get_text(item, 'name')
+        if 'age' in item:
+            if not is_id(item['age']):
+                raise ValueError('age must be an integer')
+            values['age'] = item['age']
+        if 'gender' in item:
+            gender = get_text(item, 'gender')
+            values['gender_id'] = gender_cache.get_id(gender)
+            if not values['gender_id']:
+                raise ValueError('unknown gender {}'.format(gender))
+        if not values:
+            raise ValueError('nothing to change')
+        return values, None
@@ -0,0 +1,254 @@
+import csv
+import datetime
+import io
+import json
+from sqlalchemy.dialects import postgresql
+from models import (
+    db, stage, record_change, gender_cache, casting, Actor, Movie)
+from .validation import is_id, get_text
+
+# Rows validated and written together
+CHUNK_SIZE = 1000
+
+
+# Read NDJSON or CSV lines | yield line number, row (or None), error
+def read_rows(lines, fmt='ndjson'):
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row, None
+        return
+
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_number, None, 'invalid json'
+            continue
+        if not isinstance(row, dict):
+            yield line_number, None, 'row must be an object'
+            continue
+        yield line_number, row, None
+
+
+# INSERT that skips rows which would break a unique constraint
+def insert_ignore(table):
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    return table.insert()
+
+
+# A list of names in a CSV field | ; separated, and quoted like CSV
+# fields when a name has a ; or a quote
+def join_names(names):
+    buffer = io.StringIO()
+    csv.writer(buffer, delimiter=';', lineterminator='').writerow(names)
+    return buffer.getvalue()
+
+
+def split_names(value):
+    return next(csv.reader([value], delimiter=';'), [])
+
+
+# Names are a list in NDJSON and a join_names string in CSV
+def get_names(row, key):
+    value = row.get(key) or []
+    if isinstance(value, str):
+        value = split_names(value)
+    if not isinstance(value, list) or not all(
+            isinstance(name, str) for name in value):
+        raise ValueError('{} must be a list of names'.format(key))
+    return [name.strip() for name in value if name.strip()]
+
+
+class CatalogueImporter:
+    '''
+    Import actors, movies and castings from a stream of rows
+
+    Every row has a type (actor, movie or casting):
+        actor: name, age, gender
+        movie: title, release_date (d/m/y), actors (optional names)
+        casting: movie (title), actor (name)
+
+    Genders (from the gender cache), actor names and movie titles are
+    resolved from maps that are loaded once, so a row costs no lookup
+    query. Rows are validated and written in chunks with multi-row
+    INSERT ... ON CONFLICT DO NOTHING.
+    A bad row is reported in errors and the rest of the batch goes on.
+    '''
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.actors = dict(db.session.query(Actor.name, Actor.id))
+        self.movies = dict(db.session.query(Movie.title, Movie.id))
+        self.inserted = {'actors': 0, 'movies': 0, 'castings': 0}
+        self.skipped = {'actors': 0, 'movies': 0, 'castings': 0}
+        self.errors = []
+
+    def run(self, rows):
+        chunk = []
+        for line_number, row, error in rows:
+            if error:
+                self.errors.append({'line': line_number, 'error': error})
+                continue
+            chunk.append((line_number, row))
+            if len(chunk) >= self.chunk_size:
+                self._import_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._import_chunk(chunk)
+
+        stage()
+        return self.report()
+
+    def report(self):
+        return {
+            'inserted': self.inserted,
+            'skipped': self.skipped,
+            'errors': sorted(self.errors, key=lambda error: error['line']),
+            'total_errors': len(self.errors),
+        }
+
+    def _import_chunk(self, chunk):
+        actors, movies, castings = [], [], []
+        # Names and titles that this chunk will create
+        new_actors, new_movies = set(), set()
+
+        # Lines that failed validation | they get no second error
+        failed = set()
+
+        for line_number, row in chunk:
+            try:
+                row_type = row.get('type')
+                if row_type == 'actor':
+                    actor = self._validate_actor(row)
+                    if actor['name'] in new_actors:
+                        raise ValueError('duplicate actor in batch')
+                    new_actors.add(actor['name'])
+                    actors.append(actor)
+                elif row_type == 'movie':
+                    movie, cast = self._validate_movie(row, new_actors)
+                    if movie['title'] in new_movies:
+                        raise ValueError('duplicate movie in batch')
+                    new_movies.add(movie['title'])
+                    movies.append(movie)
+                    castings.extend(
+                        (movie['title'], name) for name in cast)
+                elif row_type == 'casting':
+                    castings.append(
+                        self._validate_casting(row, new_actors, new_movies))
+                else:
+                    raise ValueError('type must be actor, movie or casting')
+            except ValueError as e:
+                failed.add(line_number)
+                self.errors.append({'line': line_number, 'error': str(e)})
+
+        # A chunk that fails in the database is rolled back on its own |
+        # its ids and counts are only kept once its savepoint is released
+        savepoint = db.session.begin_nested()
+        try:
+            actor_ids, actor_counts = self._write(
+                Actor, 'name', actors, self.actors)
+            movie_ids, movie_counts = self._write(
+                Movie, 'title', movies, self.movies)
+            pairs, casting_counts = self._write_castings(
+                castings, actor_ids, movie_ids)
+            savepoint.commit()
+        except Exception as e:
+            savepoint.rollback()
+            self.errors.extend(
+                {'line': line_number, 'error': 'not imported: {}'.format(e)}
+                for line_number, _ in chunk if line_number not in failed)
+            return
+
+        self.actors.update(actor_ids)
+        self.movies.update(movie_ids)
+        record_change('actors', *actor_ids.values())
+        record_change('movies', *movie_ids.values())
+        record_change('casting', *pairs)
+        for key, (inserted, skipped) in (('actors', actor_counts),
+                                         ('movies', movie_counts),
+                                         ('castings', casting_counts)):
+            self.inserted[key] += inserted
+            self.skipped[key] += skipped
+
+    def _validate_actor(self, row):
+        age = row.get('age')
+        # CSV fields are text | NDJSON ages must be JSON integers
+        if isinstance(age, str):
+            try:
+                age = int(age)
+            except ValueError:
+                pass
+        if not is_id(age):
+            raise ValueError('age must be an integer')
+        gender = get_text(row, 'gender')
+        gender_id = gender_cache.get_id(gender)
+        if not gender_id:
+            raise ValueError('unknown gender {}'.format(gender))
+        return {
+            'name': get_text(row, 'name'),
+            'age': age,
+            'gender_id': gender_id,
+        }
+
+    def _validate_movie(self, row, new_actors):
+        try:
+            release_date = datetime.datetime.strptime(
+                get_text(row, 'release_date'), '%d/%m/%Y')
+        except ValueError:
+            raise ValueError('release_date must be d/m/y')
+        cast = get_names(row, 'actors')
+        for name in cast:
+            if name not in self.actors and name not in new_actors:
+                raise ValueError('unknown actor {}'.format(name))
+        return {
+            'title': get_text(row, 'title'),
+            'release_date': release_date,
+        }, cast
+
+    def _validate_casting(self, row, new_actors, new_movies):
+        title = get_text(row, 'movie')
+        name = get_text(row, 'actor')
+        if title not in self.movies and title not in new_movies:
+            raise ValueError('unknown movie {}'.format(title))
+        if name not in self.actors and name not in new_actors:
+            raise ValueError('unknown actor {}'.format(name))
+        return title, name
+
+    # Multi-row insert | then resolve the ids of the new rows.
+    # Return name => id of the new rows, (inserted, skipped)
+    def _write(self, model, column, rows, existing):
+        new_rows = [row for row in rows if row[column] not in existing]
+        skipped = len(rows) - len(new_rows)
+        if not new_rows:
+            return {}, (0, skipped)
+
+        result = db.session.execute(
+            insert_ignore(model.__table__).values(new_rows))
+        names = [row[column] for row in new_rows]
+        ids = dict(db.session.query(
+            getattr(model, column), model.id).filter(
+                getattr(model, column).in_(names)))
+        # Rows inserted by someone else meanwhile were skipped
+        inserted = result.rowcount if result.rowcount >= 0 else len(new_rows)
+        return ids, (inserted, skipped + len(new_rows) - inserted)
+
+    # Return the (movie_id, actor_id) pairs, (inserted, skipped)
+    def _write_castings(self, castings, actor_ids, movie_ids):
+        rows = [
+            {'movie_id': movie_ids.get(title) or self.movies[title],
+             'actor_id': actor_ids.get(name) or self.actors[name]}
+            for title, name in set(castings)
+        ]
+        if not rows:
+            return [], (0, 0)
+        result = db.session.execute(insert_ignore(casting).values(rows))
+        inserted = result.rowcount if result.rowcount >= 0 else len(rows)
+        return [(row['movie_id'], row['actor_id']) for row in rows], (
+            inserted, len(rows) - inserted)
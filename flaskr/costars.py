@@ -0,0 +1,303 @@
+import bisect
+import os
+import threading
+import time
+from array import array
+from collections import Counter
+from sqlalchemy import select
+from models import (
+    db, on_commit, reads_from_replica, replica_staleness, casting,
+    casting_pairs)
+
+# Shortest connection searched by default, and the longest one allowed
+DEGREES = 6
+MAX_DEGREES = 12
+
+
+# Compressed sparse rows of sorted (source, target) pairs | the targets of
+# source are targets[offsets[source]:offsets[source + 1]]
+def build_csr(pairs):
+    offsets, targets = array('i'), array('i')
+    for source, target in pairs:
+        # Sources without targets get an empty slice
+        while len(offsets) <= source:
+            offsets.append(len(targets))
+        targets.append(target)
+    offsets.append(len(targets))
+    return offsets, targets
+
+
+# The casting pairs ordered by one side then the other | the database
+# sorts them, along the primary key or ix_casting_actor_id
+def ordered_casting(source, target):
+    return db.session.execute(
+        select([source, target]).order_by(source, target).execution_options(
+            stream_results=True))
+
+
+class CostarGraph:
+    '''
+    In-memory actor <=> movie graph of the casting table
+
+    Both sides are compressed sparse rows of int arrays, indexed by id:
+    the movies of every actor and the actors of every movie, 4 bytes an
+    edge on each side. Committed casting changes (recorded as movie, actor
+    pairs) are checked against the table on the next query and kept in
+    a small overlay of added and removed pairs. Read from a replica, the
+    pairs wait until it has had the time to replay them (see
+    models.replica_staleness). The graph is rebuilt
+    when the overlay grows past COSTAR_GRAPH_MAX_CHANGES pairs, and
+    every COSTAR_GRAPH_TTL seconds for the writes of other processes.
+    A rebuild runs in one request while the others keep querying the
+    current graph | only the first build makes them wait.
+    '''
+
+    def __init__(self):
+        self.ttl = 300
+        self.max_changes = 10000
+        self.builds = 0
+        self._built_at = None
+        self._actor_offsets = self._actor_movies = array('i')
+        self._movie_offsets = self._movie_actors = array('i')
+        # Changes since the build | actor => movies, movie => actors and
+        # the removed (movie, actor) pairs
+        self._extra_movies = {}
+        self._extra_actors = {}
+        self._removed = set()
+        # Committed pairs that still have to be checked => time.time()
+        # of their commit
+        self._pending = {}
+        self._lock = threading.Lock()
+        # Held by the request that rebuilds the graph
+        self._build_lock = threading.Lock()
+
+    def init_app(self, app):
+        config = app.config
+        self.ttl = float(config.setdefault(
+            'COSTAR_GRAPH_TTL', os.getenv('COSTAR_GRAPH_TTL', 300)))
+        self.max_changes = int(config.setdefault(
+            'COSTAR_GRAPH_MAX_CHANGES',
+            os.getenv('COSTAR_GRAPH_MAX_CHANGES', 10000)))
+
+    def invalidate(self, changes=None):
+        if changes is None:
+            self._built_at = None
+        elif changes.get('casting'):
+            now = time.time()
+            with self._lock:
+                self._pending.update(
+                    (pair, now) for pair in changes['casting'])
+
+    # Build from (actor, movie) pairs | from the casting table by default
+    def build(self, pairs=None):
+        # The build reads the changes committed so far | the ones
+        # committed meanwhile are checked after it
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        try:
+            if pairs is None:
+                # A replica may miss the latest pairs | they are checked
+                # again once it has had the time to replay them
+                if reads_from_replica():
+                    self._pending_later(pending)
+                actor_offsets, actor_movies = build_csr(ordered_casting(
+                    casting.c.actor_id, casting.c.movie_id))
+                movie_offsets, movie_actors = build_csr(ordered_casting(
+                    casting.c.movie_id, casting.c.actor_id))
+            else:
+                actor_offsets, actor_movies = build_csr(sorted(pairs))
+                movie_offsets, movie_actors = build_csr(sorted(
+                    (movie, actor) for actor, movie in pairs))
+        except Exception:
+            with self._lock:
+                self._pending.update(pending)
+            raise
+
+        with self._lock:
+            self._actor_offsets, self._actor_movies = (
+                actor_offsets, actor_movies)
+            self._movie_offsets, self._movie_actors = (
+                movie_offsets, movie_actors)
+            self._extra_movies, self._extra_actors = {}, {}
+            self._removed = set()
+            self._built_at = time.monotonic()
+            self.builds += 1
+
+    # Build or catch up with the committed changes before a query
+    def refresh(self):
+        if self._stale():
+            # One request rebuilds | the others go on with the current
+            # graph, unless there is none yet
+            if self._build_lock.acquire(blocking=self._built_at is None):
+                try:
+                    if self._stale():
+                        self.build()
+                finally:
+                    self._build_lock.release()
+        # The changes committed during a rebuild are checked after it
+        if not self._pending or self._build_lock.locked():
+            return
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        # A replica may not have the latest pairs yet | they wait
+        if reads_from_replica():
+            pending = self._pending_later(pending)
+            if not pending:
+                return
+        current = casting_pairs(
+            casting.c.movie_id, {movie for movie, _ in pending})
+        with self._lock:
+            for movie, actor in pending:
+                self._apply(movie, actor, (movie, actor) in current)
+
+    # Put back the pairs a replica may still miss | Return the others
+    def _pending_later(self, pending):
+        since = time.time() - replica_staleness()
+        with self._lock:
+            for pair, committed_at in pending.items():
+                if committed_at > since:
+                    self._pending.setdefault(pair, committed_at)
+        return {
+            pair: committed_at for pair, committed_at in pending.items()
+            if committed_at <= since
+        }
+
+    def _stale(self):
+        return self._built_at is None or (
+            time.monotonic() - self._built_at >= self.ttl) or (
+            len(self._pending) + len(self._removed) > self.max_changes)
+
+    def _apply(self, movie, actor, exists):
+        in_build = self._in_build(movie, actor)
+        if exists and in_build:
+            self._removed.discard((movie, actor))
+        elif not exists and in_build:
+            self._removed.add((movie, actor))
+        elif exists:
+            self._extra_movies.setdefault(actor, set()).add(movie)
+            self._extra_actors.setdefault(movie, set()).add(actor)
+        else:
+            self._extra_movies.get(actor, set()).discard(movie)
+            self._extra_actors.get(movie, set()).discard(actor)
+
+    def _in_build(self, movie, actor):
+        if movie + 1 >= len(self._movie_offsets):
+            return False
+        start, end = self._movie_offsets[movie], self._movie_offsets[
+            movie + 1]
+        index = bisect.bisect_left(self._movie_actors, actor, start, end)
+        return index < end and self._movie_actors[index] == actor
+
+    def movies_of(self, actor):
+        movies = []
+        if actor + 1 < len(self._actor_offsets):
+            movies = self._actor_movies[
+                self._actor_offsets[actor]:self._actor_offsets[actor + 1]]
+        if self._removed:
+            movies = [
+                movie for movie in movies
+                if (movie, actor) not in self._removed
+            ]
+        extra = self._extra_movies.get(actor)
+        return list(movies) + list(extra) if extra else movies
+
+    def actors_of(self, movie):
+        actors = []
+        if movie + 1 < len(self._movie_offsets):
+            actors = self._movie_actors[
+                self._movie_offsets[movie]:self._movie_offsets[movie + 1]]
+        if self._removed:
+            actors = [
+                actor for actor in actors
+                if (movie, actor) not in self._removed
+            ]
+        extra = self._extra_actors.get(movie)
+        return list(actors) + list(extra) if extra else actors
+
+    # Actors who share a movie with actor | costar => shared movies
+    def costars(self, actor):
+        self.refresh()
+        with self._lock:
+            shared = Counter()
+            for movie in self.movies_of(actor):
+                shared.update(self.actors_of(movie))
+        shared.pop(actor, None)
+        return shared
+
+    def path(self, source, target, max_degrees=DEGREES):
+        '''
+        Shortest chain of shared movies from source to target | a list
+        of ids, actor, movie, actor ... target, or None when they are
+        not connected in max_degrees movies
+        '''
+        self.refresh()
+        with self._lock:
+            return self._search(source, target, max_degrees)
+
+    # Bidirectional BFS | each step expands the smaller frontier by one
+    # movie, so both searches only go half of the way
+    def _search(self, source, target, max_degrees):
+        if source == target:
+            return [source]
+        # actor => previous actor, movie, degrees from the side's start
+        parents = ({source: None}, {target: None})
+        frontiers = [[source], [target]]
+        seen_movies = (set(), set())
+        depths = [0, 0]
+
+        while frontiers[0] and frontiers[1] and (
+                depths[0] + depths[1] < max_degrees):
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            mine, other = parents[side], parents[1 - side]
+            depths[side] += 1
+            frontier, meeting = [], None
+            for actor in frontiers[side]:
+                for movie in self.movies_of(actor):
+                    if movie in seen_movies[side]:
+                        continue
+                    seen_movies[side].add(movie)
+                    for costar in self.actors_of(movie):
+                        if costar in mine:
+                            continue
+                        mine[costar] = (actor, movie, depths[side])
+                        frontier.append(costar)
+                        if costar in other and (
+                                meeting is None or depth(other, costar) <
+                                depth(other, meeting)):
+                            meeting = costar
+            if meeting is not None:
+                return join(parents, meeting)
+            frontiers[side] = frontier
+        return None
+
+    def stats(self):
+        return {
+            'edges': len(self._actor_movies),
+            'changes': len(self._removed) + sum(
+                len(movies) for movies in self._extra_movies.values()),
+            'builds': self.builds,
+        }
+
+
+def depth(parents, actor):
+    return parents[actor][2] if parents[actor] else 0
+
+
+# The path through the actor where both searches met
+def join(parents, meeting):
+    path = [meeting]
+    actor = meeting
+    while parents[0][actor] is not None:
+        actor, movie, _ = parents[0][actor]
+        path[:0] = [actor, movie]
+    actor = meeting
+    while parents[1][actor] is not None:
+        actor, movie, _ = parents[1][actor]
+        path.extend([movie, actor])
+    return path
+
+
+costar_graph = CostarGraph()
+# Committed casting changes | checked on the next query
+on_commit(costar_graph.invalidate)
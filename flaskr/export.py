@@ -0,0 +1,105 @@
+import csv
+import io
+import json
+from sqlalchemy import func
+from models import db, format_date, casting, Actor, Movie, Gender
+from .bulk import join_names
+
+# Rows fetched from the server-side cursor at a time
+YIELD_PER = 1000
+# Separator of group_concat on databases without array_agg
+SEPARATOR = '\x1f'
+
+
+# Aggregate the related names in SQL | a list per row
+def aggregate(column):
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return func.array_agg(column)
+    return func.group_concat(column, SEPARATOR)
+
+
+def split(names):
+    if names is None:
+        return []
+    if isinstance(names, list):
+        return names
+    return names.split(SEPARATOR)
+
+
+def actor_rows():
+    movies = db.session.query(aggregate(Movie.title)).join(
+        casting, casting.c.movie_id == Movie.id).filter(
+            casting.c.actor_id == Actor.id).as_scalar()
+    query = db.session.query(
+        Actor.id, Actor.name, Actor.age, Gender.gender, movies).join(
+            Gender, Gender.id == Actor.gender_id).order_by(Actor.id)
+
+    for actor_id, name, age, gender, titles in query.yield_per(YIELD_PER):
+        yield {
+            'type': 'actor',
+            'id': actor_id,
+            'name': name,
+            'age': age,
+            'gender': gender,
+            'movies': split(titles),
+        }
+
+
+def movie_rows():
+    actors = db.session.query(aggregate(Actor.name)).join(
+        casting, casting.c.actor_id == Actor.id).filter(
+            casting.c.movie_id == Movie.id).as_scalar()
+    query = db.session.query(
+        Movie.id, Movie.title, Movie.release_date, actors).order_by(Movie.id)
+
+    for movie_id, title, release_date, names in query.yield_per(YIELD_PER):
+        yield {
+            'type': 'movie',
+            'id': movie_id,
+            'title': title,
+            'release_date': format_date(release_date),
+            'actors': split(names),
+        }
+
+
+# Send the lines in batches of YIELD_PER rows
+def to_ndjson(rows):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(row) + '\n')
+        if len(lines) == YIELD_PER:
+            yield ''.join(lines)
+            lines = []
+    yield ''.join(lines)
+
+
+# Lists are written by join_names | the format POST /bulk reads back
+def to_csv(rows, fields):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fields)
+    writer.writeheader()
+    for number, row in enumerate(rows, 1):
+        writer.writerow({
+            key: join_names(value) if isinstance(value, list) else value
+            for key, value in row.items()
+        })
+        # Send the buffered lines every YIELD_PER rows
+        if number % YIELD_PER == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+EXPORTS = {
+    'actors': (actor_rows, ['type', 'id', 'name', 'age', 'gender', 'movies']),
+    'movies': (movie_rows, ['type', 'id', 'title', 'release_date', 'actors']),
+}
+
+
+# Return the chunks of the export and its mimetype
+def export(resource, fmt):
+    rows, fields = EXPORTS[resource]
+    if fmt == 'csv':
+        return to_csv(rows(), fields), 'text/csv'
+    return to_ndjson(rows()), 'application/x-ndjson'
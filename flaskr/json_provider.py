@@ -0,0 +1,52 @@
+import json
+import os
+from flask import current_app
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Same output as orjson | sorted keys, no spaces, UTF-8 bytes with the
+# non-ASCII characters unescaped
+def stdlib_dumps(payload):
+    return json.dumps(
+        payload, sort_keys=True, separators=(',', ':'),
+        ensure_ascii=False).encode('utf-8')
+
+
+def orjson_dumps(payload):
+    return orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+
+
+class JSONProvider:
+    '''
+    Serialiser of the API responses
+
+    JSON_BACKEND picks it: orjson, json (the standard library) or auto,
+    which uses orjson when it is installed. Both sort the keys and write
+    UTF-8 without escaping it, so the body (and its ETag) doesn't depend
+    on the backend.
+    '''
+
+    def __init__(self):
+        self.backend = 'json'
+        self.dumps = stdlib_dumps
+
+    def init_app(self, app):
+        backend = app.config.setdefault(
+            'JSON_BACKEND', os.getenv('JSON_BACKEND', 'auto'))
+        if backend == 'orjson' and orjson is None:
+            raise RuntimeError('JSON_BACKEND is orjson, it is not installed')
+        if backend in ('auto', 'orjson') and orjson is not None:
+            self.backend, self.dumps = 'orjson', orjson_dumps
+        else:
+            self.backend, self.dumps = 'json', stdlib_dumps
+
+    def response(self, payload, status=200):
+        return current_app.response_class(
+            self.dumps(payload), status=status, mimetype='application/json')
+
+
+json_provider = JSONProvider()
@@ -0,0 +1,221 @@
+import bisect
+import os
+import threading
+import time
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from models import pool_stats, gender_cache, replicas
+from auth.auth import token_cache
+from .response_cache import response_cache
+from .stats import stats_cache
+
+# Upper bounds of the latency buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # One count per bucket | the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Prometheus buckets are cumulative | le is "less or equal"
+    def lines(self, name, labels):
+        cumulative = 0
+        bounds = [repr(bound) for bound in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, self.counts):
+            cumulative += count
+            yield '{}_bucket{} {}'.format(
+                name, format_labels(labels, le=bound), cumulative)
+        yield '{}_sum{} {!r}'.format(name, format_labels(labels), self.sum)
+        yield '{}_count{} {}'.format(name, format_labels(labels), self.count)
+
+
+def format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"')) for key, value in sorted(labels.items())) + '}'
+
+
+class Metrics:
+    '''
+    Per-route latency, SQL statements and DB time, and auth time
+
+    METRICS_ENABLED=1 turns it on. Every response then gets a
+    Server-Timing header and /metrics serves the totals of this process
+    in the Prometheus text format. When it is off no hook is registered,
+    so a request costs nothing more.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.requests = {}
+        self.statements = {}
+        self.auth = Histogram()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.enabled = str(app.config.setdefault(
+            'METRICS_ENABLED', os.getenv('METRICS_ENABLED', '0'))) == '1'
+        if not self.enabled:
+            return
+
+        listen_to_statements()
+        app.before_request(self.start_request)
+        # The after_request hooks run in the reverse order | put this one
+        # first, so it runs last and times the commit of the request too
+        app.after_request_funcs.setdefault(None, []).insert(
+            0, self.finish_request)
+        app.add_url_rule('/metrics', 'metrics', self.serve)
+
+    def start_request(self):
+        g.metrics_start = time.perf_counter()
+        g.db_statements = 0
+        g.db_seconds = 0.0
+
+    def finish_request(self, response):
+        if 'metrics_start' not in g:
+            return response
+        elapsed = time.perf_counter() - g.metrics_start
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        auth_seconds = g.get('auth_seconds')
+
+        with self._lock:
+            key = (request.method, route, response.status_code)
+            self.requests.setdefault(key, Histogram()).observe(elapsed)
+            totals = self.statements.setdefault(
+                (request.method, route), [0, 0.0])
+            totals[0] += g.db_statements
+            totals[1] += g.db_seconds
+            if auth_seconds is not None:
+                self.auth.observe(auth_seconds)
+
+        timings = [
+            'app;dur={:.2f}'.format(elapsed * 1000),
+            'db;dur={:.2f};desc="{} queries"'.format(
+                g.db_seconds * 1000, g.db_statements),
+        ]
+        if auth_seconds is not None:
+            timings.append('auth;dur={:.2f}'.format(auth_seconds * 1000))
+        response.headers.add('Server-Timing', ', '.join(timings))
+        return response
+
+    def serve(self):
+        return Response(
+            '\n'.join(self.lines()) + '\n',
+            mimetype='text/plain; version=0.0.4')
+
+    def lines(self):
+        with self._lock:
+            requests = sorted(self.requests.items())
+            statements = sorted(self.statements.items())
+            auth = list(self.auth.lines('casting_auth_seconds', {}))
+
+        yield '# HELP casting_request_seconds Time to serve a request'
+        yield '# TYPE casting_request_seconds histogram'
+        for (method, route, status), histogram in requests:
+            yield from histogram.lines('casting_request_seconds', {
+                'method': method, 'route': route, 'status': status})
+
+        yield '# HELP casting_db_statements_total SQL statements run'
+        yield '# TYPE casting_db_statements_total counter'
+        for (method, route), (count, _) in statements:
+            yield 'casting_db_statements_total{} {}'.format(
+                format_labels({'method': method, 'route': route}), count)
+        yield '# HELP casting_db_seconds_total Time spent running SQL'
+        yield '# TYPE casting_db_seconds_total counter'
+        for (method, route), (_, seconds) in statements:
+            yield 'casting_db_seconds_total{} {!r}'.format(
+                format_labels({'method': method, 'route': route}), seconds)
+
+        yield '# HELP casting_auth_seconds Time to verify the bearer tokens'
+        yield '# TYPE casting_auth_seconds histogram'
+        yield from auth
+
+        pool = pool_stats()
+        yield '# TYPE casting_db_pool_checkouts_total counter'
+        yield 'casting_db_pool_checkouts_total {}'.format(pool['checkouts'])
+        yield '# TYPE casting_db_pool_wait_seconds_total counter'
+        yield 'casting_db_pool_wait_seconds_total {!r}'.format(
+            pool['wait_seconds_total'])
+        yield '# TYPE casting_db_pool_wait_seconds_max gauge'
+        yield 'casting_db_pool_wait_seconds_max {!r}'.format(
+            pool['wait_seconds_max'])
+        for key in ('size', 'in_use', 'overflow'):
+            if key in pool:
+                yield '# TYPE casting_db_pool_{} gauge'.format(key)
+                yield 'casting_db_pool_{} {}'.format(key, pool[key])
+
+        replica_health = sorted(replicas.stats().items())
+        if replica_health:
+            yield '# TYPE casting_db_replica_healthy gauge'
+        for name, healthy in replica_health:
+            yield 'casting_db_replica_healthy{} {}'.format(
+                format_labels({'replica': name}), int(healthy))
+
+        caches = {
+            'gender': gender_cache.stats(),
+            'token': token_cache.stats(),
+            'response': response_cache.stats(),
+            'stats': stats_cache.stats(),
+        }
+        for counter in ('hits', 'misses'):
+            yield '# TYPE casting_cache_{}_total counter'.format(counter)
+            for cache, stats in caches.items():
+                yield 'casting_cache_{}_total{} {}'.format(
+                    counter, format_labels({'cache': cache}), stats[counter])
+        yield '# TYPE casting_cache_size gauge'
+        for cache, stats in caches.items():
+            if 'size' in stats:
+                yield 'casting_cache_size{} {}'.format(
+                    format_labels({'cache': cache}), stats['size'])
+
+
+# Count and time the statements of the current request | on every engine
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('metrics_query_start', []).append(
+        time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    finish_statement(conn)
+
+
+# A failed statement never gets to after_cursor_execute
+def failed_statement(context):
+    if context.connection is not None:
+        finish_statement(context.connection)
+
+
+def finish_statement(conn):
+    starts = conn.info.get('metrics_query_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    if has_request_context() and 'db_statements' in g:
+        g.db_statements += 1
+        g.db_seconds += elapsed
+
+
+def listen_to_statements():
+    if not event.contains(
+            Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(Engine, 'handle_error', failed_statement)
+
+
+metrics = Metrics()
@@ -0,0 +1,195 @@
+import os
+import re
+import time
+from collections import Counter
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Most statements a route may run | "METHOD rule" => statements.
+# QUERY_BUDGETS="GET /movies=3,POST /movies=4" overrides them
+BUDGETS = {
+    'GET /actors': 4,
+    'POST /actors': 2,
+    'PATCH /actors/<int:actor_id>': 4,
+    'DELETE /actors/<int:actor_id>': 4,
+    'PATCH /actors': 6,
+    'DELETE /actors': 4,
+    'GET /actors/<int:actor_id>/costars': 5,
+    'GET /actors/<int:actor_id>/path/<int:other_id>': 6,
+    'GET /movies': 4,
+    'POST /movies': 4,
+    'PATCH /movies/<int:movie_id>': 5,
+    'DELETE /movies/<int:movie_id>': 4,
+    'PATCH /movies': 8,
+    'DELETE /movies': 4,
+    'GET /search': 3,
+    'GET /stats': 4,
+    'GET /stats/genders': 1,
+    'GET /stats/cast-size': 1,
+    'GET /stats/release-years': 1,
+    'GET /stats/top-actors': 1,
+}
+
+# Placeholders of a statement | ?, :name, %s and %(name)s
+PLACEHOLDER = re.compile(r'\?|:\w+|%s|%\(\w+\)s')
+PLACEHOLDER_LIST = re.compile(r'\(\s*\?(\s*,\s*\?)*\s*\)')
+
+
+class QueryAuditError(Exception):
+    pass
+
+
+# The statement without its parameters | IN lists of any size are one shape
+def shape(statement):
+    statement = PLACEHOLDER.sub('?', ' '.join(statement.split()))
+    return PLACEHOLDER_LIST.sub('(?)', statement)
+
+
+def parse_budgets(value):
+    budgets = {}
+    for item in (value or '').split(','):
+        if item.strip():
+            route, _, budget = item.rpartition('=')
+            budgets[route.strip()] = int(budget)
+    return budgets
+
+
+class QueryAudit:
+    '''
+    Development check of the SQL that each request runs
+
+    QUERY_AUDIT=1 turns it on. It records the statements of every request
+    and logs a warning when:
+        the same statement shape (parameters aside) runs
+            QUERY_AUDIT_REPEAT times or more | an N+1 pattern
+        a statement takes longer than QUERY_AUDIT_SLOW_MS | with its
+            plan, EXPLAIN ANALYZE on PostgreSQL (SELECTs only, the others
+            would run twice) and EXPLAIN QUERY PLAN on SQLite
+        a route runs more statements than its budget (BUDGETS)
+    With QUERY_AUDIT_STRICT=1 an N+1 or a budget overrun raises
+    QueryAuditError instead, so a test client request fails.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.repeat = 5
+        self.slow_seconds = 0.1
+        self.strict = False
+        self.budgets = dict(BUDGETS)
+        self.logger = None
+
+    def init_app(self, app):
+        config = app.config
+        self.enabled = str(config.setdefault(
+            'QUERY_AUDIT', os.getenv('QUERY_AUDIT', '0'))) == '1'
+        if not self.enabled:
+            return
+
+        self.repeat = int(config.setdefault(
+            'QUERY_AUDIT_REPEAT', os.getenv('QUERY_AUDIT_REPEAT', 5)))
+        self.slow_seconds = int(config.setdefault(
+            'QUERY_AUDIT_SLOW_MS', os.getenv('QUERY_AUDIT_SLOW_MS', 100))
+        ) / 1000
+        self.strict = str(config.setdefault(
+            'QUERY_AUDIT_STRICT', os.getenv('QUERY_AUDIT_STRICT', '0'))
+        ) == '1'
+        self.budgets = dict(BUDGETS, **parse_budgets(
+            os.getenv('QUERY_BUDGETS')))
+        self.budgets.update(config.get('QUERY_BUDGETS', {}))
+        self.logger = app.logger
+
+        if not event.contains(
+                Engine, 'before_cursor_execute', self.before_execute):
+            event.listen(Engine, 'before_cursor_execute', self.before_execute)
+            event.listen(Engine, 'after_cursor_execute', self.after_execute)
+        app.before_request(self.start_request)
+        # The after_request hooks run in the reverse order | put this one
+        # first, so it runs last and sees the statements of the commit
+        app.after_request_funcs.setdefault(None, []).insert(
+            0, self.check_request)
+
+    def start_request(self):
+        g.audited_statements = []
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        conn.info.setdefault('audit_query_start', []).append(
+            time.perf_counter())
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        starts = conn.info.get('audit_query_start')
+        if not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        if not has_request_context() or 'audited_statements' not in g:
+            return
+
+        g.audited_statements.append((statement, elapsed))
+        if elapsed >= self.slow_seconds and not executemany:
+            self.logger.warning(
+                'Slow statement (%.1f ms) in %s %s:\n%s\n%s',
+                elapsed * 1000, request.method, request.path, statement,
+                explain(conn, statement, parameters))
+
+    def check_request(self, response):
+        statements = g.pop('audited_statements', None)
+        if statements is None:
+            return response
+
+        route = '{} {}'.format(
+            request.method,
+            request.url_rule.rule if request.url_rule else request.path)
+        problems = []
+        shapes = Counter(shape(statement) for statement, _ in statements)
+        for statement, count in shapes.most_common():
+            if count < self.repeat:
+                break
+            problems.append('N+1: {} runs {} times: {}'.format(
+                route, count, statement))
+        budget = self.budgets.get(route)
+        if budget is not None and len(statements) > budget:
+            problems.append('{} ran {} statements, its budget is {}'.format(
+                route, len(statements), budget))
+
+        for problem in problems:
+            self.logger.warning(problem)
+        if problems and self.strict:
+            raise QueryAuditError('\n'.join(problems))
+        return response
+
+
+# The plan of a statement | on the raw connection, so it isn't audited
+def explain(conn, statement, parameters):
+    dialect = conn.dialect.name
+    if dialect == 'postgresql':
+        is_select = statement.lstrip().lower().startswith(('select', 'with'))
+        prefix = 'EXPLAIN ANALYZE ' if is_select else 'EXPLAIN '
+    elif dialect == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        return ''
+
+    # A failed EXPLAIN must not abort the transaction of the request
+    savepoint = dialect == 'postgresql'
+    cursor = conn.connection.cursor()
+    try:
+        if savepoint:
+            cursor.execute('SAVEPOINT query_audit')
+        cursor.execute(prefix + statement, parameters)
+        plan = '\n'.join(
+            ' '.join(str(column) for column in row)
+            for row in cursor.fetchall())
+        if savepoint:
+            cursor.execute('RELEASE SAVEPOINT query_audit')
+        return plan
+    except Exception as e:
+        if savepoint:
+            cursor.execute('ROLLBACK TO SAVEPOINT query_audit')
+        return 'no plan: {}'.format(e)
+    finally:
+        cursor.close()
+
+
+query_audit = QueryAudit()
@@ -0,0 +1,231 @@
+import os
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event, select
+from models import (
+    db, casting, movie_documents, actor_documents, Actor, Movie)
+
+# Rows built or compared at a time
+CHUNK_SIZE = 1000
+
+# model => document table, its key column
+DOCUMENTS = {
+    Movie: (movie_documents, movie_documents.c.movie_id),
+    Actor: (actor_documents, actor_documents.c.actor_id),
+}
+
+
+def chunks(ids):
+    ids = sorted(ids)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        yield ids[start:start + CHUNK_SIZE]
+
+
+# The documents of the rows, formatted like the list endpoints | id =>
+# document. Rows that don't exist anymore have none
+def build_documents(model, ids):
+    documents = {}
+    for chunk in chunks(ids):
+        rows, _ = model.page(
+            list(model.formatters), [model.id.in_(chunk)], None, len(chunk))
+        documents.update((row['id'], row) for row in rows)
+    return documents
+
+
+def write_documents(model, ids):
+    table, key = DOCUMENTS[model]
+    documents = build_documents(model, ids)
+    for chunk in chunks(ids):
+        db.session.execute(table.delete().where(key.in_(chunk)))
+    if documents:
+        db.session.execute(table.insert(), [
+            {key.name: row_id, 'document': document}
+            for row_id, document in documents.items()
+        ])
+    return len(documents)
+
+
+# Ids on the other side of casting | e.g. the actors of some movies
+def linked(wanted, known, ids):
+    return {
+        row_id for row_id, in db.session.execute(
+            select([wanted]).where(known.in_(list(ids))))
+    }
+
+
+class ReadModel:
+    '''
+    Denormalised read model of the list endpoints
+
+    Every movie and actor has its formatted document (the one GET /movies
+    and GET /actors return, with the names of the other side of casting)
+    in movie_documents and actor_documents. A page is then read from
+    them in one query, instead of a query per related table.
+
+    READ_MODEL_ENABLED=1 turns it on. Before a transaction commits, the
+    documents of the rows it wrote (the change tracking of models) and
+    of the rows linked to them are rebuilt in the same transaction.
+    Run flask read-model rebuild when turning it on, and flask
+    read-model check to compare the stored documents with fresh ones.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+
+    def init_app(self, app):
+        self.enabled = str(app.config.setdefault(
+            'READ_MODEL_ENABLED', os.getenv('READ_MODEL_ENABLED', '0'))
+        ) == '1'
+        app.cli.add_command(read_model_cli)
+        # The session is shared by every app | an app with the read
+        # model off stops the refreshes of one created before it
+        if self.enabled != event.contains(
+                db.session, 'before_commit', refresh_documents):
+            for name, listener in (
+                    ('before_flush', remember_related),
+                    ('before_commit', refresh_documents),
+                    ('after_transaction_end', forget_related)):
+                if self.enabled:
+                    event.listen(db.session, name, listener)
+                else:
+                    event.remove(db.session, name, listener)
+
+    # Keyset page of documents | Return the documents, next cursor
+    def page(self, model, fields, criteria=(), after=None, limit=100):
+        table, key = DOCUMENTS[model]
+        query = db.session.query(model.id, table.c.document).outerjoin(
+            table, key == model.id).filter(*criteria)
+        if after is not None:
+            query = query.filter(model.id > after)
+        rows = query.order_by(model.id).limit(limit + 1).all()
+
+        # The extra row only tells that there is a next page
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        rows = rows[:limit]
+
+        # Rows written while the read model was off have no document yet
+        missing = build_documents(model, [
+            row_id for row_id, document in rows if document is None])
+        return [
+            {
+                field: (document or missing[row_id])[field]
+                for field in fields
+            } for row_id, document in rows
+        ], next_cursor
+
+
+# The casting of deleted movies and actors is gone once the delete is
+# flushed | remember who was linked to them before
+def remember_related(session, flush_context, instances):
+    movie_ids = [row.id for row in session.deleted if isinstance(row, Movie)]
+    actor_ids = [row.id for row in session.deleted if isinstance(row, Actor)]
+    if not movie_ids and not actor_ids:
+        return
+    related = session.info.setdefault(
+        'read_model_related', {'movies': set(), 'actors': set()})
+    if movie_ids:
+        related['actors'].update(
+            linked(casting.c.actor_id, casting.c.movie_id, movie_ids))
+    if actor_ids:
+        related['movies'].update(
+            linked(casting.c.movie_id, casting.c.actor_id, actor_ids))
+
+
+def refresh_documents(session):
+    # A savepoint | the outer commit refreshes everything at once
+    if session.transaction.nested:
+        return
+    session.flush()
+    changes = session.info.get('changes') or {}
+    related = session.info.pop('read_model_related', {})
+
+    castings = changes.get('casting', ())
+    movie_ids = set(changes.get('movies', ())) | related.get('movies', set())
+    actor_ids = set(changes.get('actors', ())) | related.get('actors', set())
+    movie_ids.update(movie_id for movie_id, _ in castings)
+    actor_ids.update(actor_id for _, actor_id in castings)
+
+    # Titles and names are in the documents of the other side too
+    if changes.get('movies'):
+        actor_ids |= linked(
+            casting.c.actor_id, casting.c.movie_id, changes['movies'])
+    if changes.get('actors'):
+        movie_ids |= linked(
+            casting.c.movie_id, casting.c.actor_id, changes['actors'])
+    if changes.get('gender'):
+        actor_ids |= {
+            actor_id for actor_id, in db.session.query(Actor.id).filter(
+                Actor.gender_id.in_(list(changes['gender'])))
+        }
+
+    if movie_ids:
+        write_documents(Movie, movie_ids)
+    if actor_ids:
+        write_documents(Actor, actor_ids)
+
+
+def forget_related(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('read_model_related', None)
+
+
+# Lists compare whatever the order the database returned them in
+def normalise(document):
+    return {
+        key: sorted(value) if isinstance(value, list) else value
+        for key, value in document.items()
+    }
+
+
+read_model_cli = AppGroup(
+    'read-model', help='Maintain the movie and actor documents.')
+
+
+@read_model_cli.command('rebuild')
+def rebuild():
+    """Rebuild every movie and actor document."""
+    for model, (table, key) in DOCUMENTS.items():
+        db.session.execute(table.delete())
+        ids = [row_id for row_id, in db.session.query(model.id)]
+        written = write_documents(model, ids)
+        click.echo('{}: {} documents'.format(table.name, written))
+    db.session.commit()
+
+
+@read_model_cli.command('check')
+def check():
+    """Compare the stored documents with freshly built ones."""
+    failed = False
+    for model, (table, key) in DOCUMENTS.items():
+        missing, stale = [], []
+        ids = [row_id for row_id, in db.session.query(model.id)]
+        for chunk in chunks(ids):
+            expected = build_documents(model, chunk)
+            stored = {
+                row_id: document for row_id, document in db.session.execute(
+                    select([key, table.c.document]).where(key.in_(chunk)))
+            }
+            for row_id, document in expected.items():
+                if row_id not in stored:
+                    missing.append(row_id)
+                elif normalise(stored[row_id]) != normalise(document):
+                    stale.append(row_id)
+        orphans = [
+            row_id for row_id, in db.session.execute(
+                select([key]).where(~key.in_(select([model.id]))))
+        ]
+
+        click.echo('{}: {} missing, {} stale, {} orphans'.format(
+            table.name, len(missing), len(stale), len(orphans)))
+        for name, row_ids in (('missing', missing), ('stale', stale),
+                              ('orphans', orphans)):
+            if row_ids:
+                failed = True
+                click.echo('  {}: {}'.format(
+                    name, ', '.join(str(row_id) for row_id in row_ids[:20])))
+
+    if failed:
+        raise SystemExit(1)
+
+
+read_model = ReadModel()
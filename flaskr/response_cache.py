@@ -0,0 +1,195 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, request
+from models import on_commit, reads_from_replica, replica_staleness
+
+
+class MemoryBackend:
+    '''
+    In-process LRU backend | every gunicorn worker has its own copy, so
+    a write only invalidates the worker that made it until the TTL ends
+    '''
+
+    def __init__(self, maxsize=256, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._generation = 0
+        # The writes committed before the start aren't known | as if
+        # there was one just now
+        self._bumped_at = time.time()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def generation(self):
+        return self._generation
+
+    # Time of the last bump | time.time(), comparable across processes
+    def bumped_at(self):
+        return self._bumped_at
+
+    def bump(self):
+        with self._lock:
+            self._generation += 1
+            self._bumped_at = time.time()
+            # Entries of older generations can't be read anymore
+            self._entries.clear()
+
+
+class RedisBackend:
+    '''
+    Redis backend | shared by every worker, and so is the generation
+    counter, so a write in one worker invalidates them all.
+    Needs the redis package (pip install redis)
+    '''
+
+    def __init__(self, url, ttl=60, prefix='casting:responses:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    # Stored as etag, mimetype and body separated by new lines
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        etag, mimetype, body = value.split(b'\n', 2)
+        return etag.decode(), mimetype.decode(), body
+
+    def set(self, key, value):
+        etag, mimetype, body = value
+        self.client.setex(
+            self.prefix + key, self.ttl,
+            '{}\n{}\n'.format(etag, mimetype).encode() + body)
+
+    def generation(self):
+        return int(self.client.get(self.prefix + 'generation') or 0)
+
+    def bumped_at(self):
+        return float(self.client.get(self.prefix + 'bumped_at') or 0)
+
+    def bump(self):
+        pipeline = self.client.pipeline()
+        pipeline.incr(self.prefix + 'generation')
+        pipeline.set(self.prefix + 'bumped_at', repr(time.time()))
+        pipeline.execute()
+
+
+class ResponseCache:
+    '''
+    Cache of serialised GET responses with a strong ETag
+
+    The cache key holds a generation counter that is bumped whenever a
+    transaction that wrote actors, movies, gender or casting commits.
+    With the Redis backend the counter is shared, so a cached response
+    never outlives the data it was built from. The memory backend has a
+    counter per worker: a write only invalidates the worker that made
+    it, and the other workers may serve their responses built before it
+    for up to RESPONSE_CACHE_TTL seconds. Use redis (or none) with more
+    than one worker when that matters.
+    A request with a matching If-None-Match gets a 304 without touching
+    the database.
+    '''
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        kind = app.config.setdefault(
+            'RESPONSE_CACHE', os.getenv('RESPONSE_CACHE', 'memory'))
+        ttl = int(app.config.setdefault(
+            'RESPONSE_CACHE_TTL', os.getenv('RESPONSE_CACHE_TTL', 60)))
+
+        if kind == 'redis':
+            url = app.config.setdefault(
+                'RESPONSE_CACHE_URL',
+                os.getenv('RESPONSE_CACHE_URL', 'redis://localhost:6379'))
+            self.backend = RedisBackend(url, ttl=ttl)
+        elif kind == 'memory':
+            self.backend = MemoryBackend(
+                int(app.config.setdefault(
+                    'RESPONSE_CACHE_SIZE',
+                    os.getenv('RESPONSE_CACHE_SIZE', 256))),
+                ttl=ttl)
+        else:
+            self.backend = None
+
+    def invalidate(self, changes=None):
+        if self.backend is not None:
+            self.backend.bump()
+
+    def cached(self, view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if self.backend is None:
+                return view(*args, **kwargs)
+
+            # The generation before the read | a write committed during
+            # it leaves the entry under a generation no longer read
+            key = '{}:{}'.format(
+                self.backend.generation(), request.full_path)
+            entry = self.backend.get(key)
+            if entry is None:
+                self.misses += 1
+                response = view(*args, **kwargs)
+                # Only whole successful responses are cached
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                body = response.get_data()
+                entry = (
+                    hashlib.sha1(body).hexdigest(), response.mimetype, body)
+                if not self.replica_may_lag():
+                    self.backend.set(key, entry)
+            else:
+                self.hits += 1
+
+            etag, mimetype, body = entry
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                response = Response(body, mimetype=mimetype)
+            response.set_etag(etag)
+            return response
+
+        return wrapper
+
+    # A replica may not have the writes of the current generation yet,
+    # until replica_staleness() seconds after its bump | what it read
+    # then is served but not stored
+    def replica_may_lag(self):
+        return reads_from_replica() and (
+            time.time() - self.backend.bumped_at() < replica_staleness())
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+response_cache = ResponseCache()
+# Any committed write makes the cached responses stale
+on_commit(response_cache.invalidate)
@@ -0,0 +1,134 @@
+import re
+import threading
+from sqlalchemy import literal, select, union_all
+from models import db, on_commit, Actor, Movie
+
+# Shortest query served | shorter ones have no trigram to match
+MIN_QUERY_LENGTH = 3
+
+# type => model, searched column
+TARGETS = {
+    'movie': (Movie, Movie.title),
+    'actor': (Actor, Actor.name),
+}
+
+
+def search_hits(q, types, limit, offset):
+    '''
+    Ranked hits for q | a list of (type, id, name, score) and whether
+    there are more hits after this page
+    '''
+    if db.session.get_bind().dialect.name == 'postgresql':
+        hits = trigram_search(q, types, limit + offset + 1)
+    else:
+        hits = prefix_trie.search(q, types, limit + offset + 1)
+    return hits[offset:offset + limit], len(hits) > offset + limit
+
+
+# psycopg2 reads % as a placeholder | double it in the operators
+def operator(opstring):
+    if db.session.get_bind().dialect.paramstyle in ('format', 'pyformat'):
+        return opstring.replace('%', '%%')
+    return opstring
+
+
+def trigram_search(q, types, size):
+    # Word similarity: how well q matches the best part of the text.
+    # The GiST trigram indexes serve both the <% match and the <<->
+    # distance order, so only the top rows are read
+    selects = []
+    for kind in types:
+        model, column = TARGETS[kind]
+        distance = literal(q).op('<<->')(column)
+        selects.append(select([
+            literal(kind).label('type'),
+            model.id.label('id'),
+            column.label('name'),
+            (1 - distance).label('score'),
+        ]).where(literal(q).op(operator('<%'))(column)).order_by(
+            distance, model.id).limit(size))
+
+    hits = union_all(*selects).alias('hits')
+    return [tuple(row) for row in db.session.execute(
+        select([hits]).order_by(
+            hits.c.score.desc(), hits.c.type, hits.c.id).limit(size))]
+
+
+class PrefixTrie:
+    '''
+    In-memory search fallback for databases without pg_trgm (SQLite)
+
+    Every word of the titles and names is added to a trie, so a query
+    finds the texts that have a word starting with it. Hits that start
+    with the whole query rank first, then the shorter texts. The trie is
+    rebuilt on the next search after a committed write.
+    '''
+
+    def __init__(self):
+        self._root = None
+        self._texts = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def words(text):
+        return re.findall(r'\w+', text.lower())
+
+    def invalidate(self, changes=None):
+        if changes is None or 'movies' in changes or 'actors' in changes:
+            self._root = None
+
+    def build(self):
+        root, texts = {}, {}
+        for kind, (model, column) in TARGETS.items():
+            for key, text in db.session.query(model.id, column):
+                texts[(kind, key)] = text
+                for word in self.words(text):
+                    node = root
+                    for char in word:
+                        node = node.setdefault(char, {})
+                    node.setdefault('', set()).add((kind, key))
+        with self._lock:
+            self._root, self._texts = root, texts
+        return root, texts
+
+    def search(self, q, types, size):
+        # invalidate() may drop the trie meanwhile | search this one
+        with self._lock:
+            root, texts = self._root, self._texts
+        if root is None:
+            root, texts = self.build()
+
+        # Every query word must start a word of the text
+        matches = None
+        for word in self.words(q):
+            node = root
+            for char in word:
+                node = node.get(char)
+                if node is None:
+                    return []
+            found = set()
+            stack = [node]
+            while stack:
+                node = stack.pop()
+                for char, child in node.items():
+                    if char:
+                        stack.append(child)
+                    else:
+                        found.update(child)
+            matches = found if matches is None else matches & found
+
+        query = q.lower().strip()
+        hits = sorted(
+            (not texts[key].lower().startswith(query), len(texts[key]),
+             key[0], key[1])
+            for key in (matches or ())
+            if key[0] in types
+        )
+        return [
+            (kind, key, texts[(kind, key)], 1.0 if not partial else 0.5)
+            for partial, _, kind, key in hits[:size]
+        ]
+
+
+prefix_trie = PrefixTrie()
+on_commit(prefix_trie.invalidate)
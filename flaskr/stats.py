@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+from sqlalchemy import Integer, cast, desc, extract, func, select
+from models import (
+    db, on_commit, reads_from_replica, replica_staleness, casting, Actor,
+    Gender, Movie)
+
+
+def actors_per_gender():
+    rows = db.session.query(Gender.gender, func.count(Actor.id)).outerjoin(
+        Actor, Actor.gender_id == Gender.id).group_by(
+            Gender.id, Gender.gender).order_by(Gender.gender)
+    return [{'gender': gender, 'actors': actors} for gender, actors in rows]
+
+
+# Cast size of every movie, then their number, sum and largest one
+def cast_sizes():
+    sizes = select([
+        Movie.id, func.count(casting.c.actor_id).label('size'),
+    ]).select_from(Movie.__table__.outerjoin(
+        casting, casting.c.movie_id == Movie.id)).group_by(
+            Movie.id).alias('sizes')
+    movies, castings, largest = db.session.execute(select([
+        func.count(), func.sum(sizes.c.size), func.max(sizes.c.size),
+    ]).select_from(sizes)).first()
+    return {
+        'movies': movies,
+        'castings': castings or 0,
+        'average': round((castings or 0) / movies, 2) if movies else 0,
+        'largest': largest or 0,
+    }
+
+
+def movies_per_year():
+    year = cast(extract('year', Movie.release_date), Integer).label('year')
+    rows = db.session.query(year, func.count(Movie.id)).group_by(
+        year).order_by(year)
+    return [{'year': year, 'movies': movies} for year, movies in rows]
+
+
+# The actors cast in the most movies | counted on the casting index,
+# only the top ones are joined to their names
+def top_actors(limit=10):
+    counts = select([
+        casting.c.actor_id, func.count().label('movies'),
+    ]).group_by(casting.c.actor_id).order_by(
+        desc('movies'), casting.c.actor_id).limit(limit).alias('counts')
+    rows = db.session.query(Actor.id, Actor.name, counts.c.movies).join(
+        counts, counts.c.actor_id == Actor.id).order_by(
+            counts.c.movies.desc(), Actor.id)
+    return [
+        {'id': actor_id, 'name': name, 'movies': movies}
+        for actor_id, name, movies in rows
+    ]
+
+
+# Name => how to compute it, the tables it is computed from
+STATS = {
+    'genders': (actors_per_gender, {'actors', 'gender'}),
+    'cast_size': (cast_sizes, {'movies', 'casting'}),
+    'release_years': (movies_per_year, {'movies'}),
+    'top_actors': (top_actors, {'actors', 'casting'}),
+}
+
+
+class StatsCache:
+    '''
+    Process-local cache of the aggregates of STATS
+
+    A committed write only drops the aggregates computed from the tables
+    it changed (e.g. a new actor leaves the movies per year), so a
+    dashboard polling /stats runs a query only for what changed. Writes
+    committed by another process are seen once STATS_CACHE_TTL seconds
+    have passed.
+    '''
+
+    def __init__(self):
+        self.ttl = 30
+        self.hits = 0
+        self.misses = 0
+        # (name, arguments) => expiry, value
+        self._entries = {}
+        # name => times it was invalidated | a value computed meanwhile
+        # is not stored
+        self._generations = {name: 0 for name in STATS}
+        # name => time.time() of its last invalidation
+        self._invalidated_at = {name: 0.0 for name in STATS}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.ttl = float(app.config.setdefault(
+            'STATS_CACHE_TTL', os.getenv('STATS_CACHE_TTL', 30)))
+
+    def invalidate(self, changes=None):
+        with self._lock:
+            for name, (_, tables) in STATS.items():
+                if changes is None or any(
+                        changes.get(table) for table in tables):
+                    self._generations[name] += 1
+                    self._invalidated_at[name] = time.time()
+                    for key in [key for key in self._entries
+                                if key[0] == name]:
+                        del self._entries[key]
+
+    def get(self, name, *args):
+        key = (name,) + args
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() < entry[0]:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        generation = self._generations[name]
+        value = STATS[name][0](*args)
+        # A replica may not have the writes of the last invalidation yet |
+        # what it computed is returned but not stored
+        if reads_from_replica() and (
+                time.time() - self._invalidated_at[name]
+                < replica_staleness()):
+            return value
+        with self._lock:
+            if self._generations[name] == generation:
+                self._entries[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+stats_cache = StatsCache()
+on_commit(stats_cache.invalidate)
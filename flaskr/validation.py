@@ -0,0 +1,13 @@
+# Checks shared by the bulk import and the batch endpoints | they raise
+# ValueError with the message reported for the row or item
+
+
+def is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def get_text(item, key):
+    value = item.get(key)
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError('{} must be a non-empty string'.format(key))
+    return value.strip()
@@ -0,0 +1,53 @@
+import os
+
+'''
+Gunicorn settings | the Procfile starts the app with them
+
+WEB_WORKER_CLASS sets how a worker serves its requests:
+    sync: one at a time (the default)
+    gthread: up to WEB_THREADS at a time, one thread each
+    gevent: up to WEB_WORKER_CONNECTIONS at a time, one greenlet each.
+        psycopg2 waits on the database through gevent, so a slow query
+        or JWKS fetch doesn't hold the whole worker
+'''
+
+worker_class = os.getenv('WEB_WORKER_CLASS', 'sync')
+# Heroku sets WEB_CONCURRENCY from the size of the dyno
+workers = int(os.getenv('WEB_CONCURRENCY', 1))
+threads = int(os.getenv(
+    'WEB_THREADS', 8 if worker_class == 'gthread' else 1))
+worker_connections = int(os.getenv('WEB_WORKER_CONNECTIONS', 1000))
+timeout = int(os.getenv('WEB_TIMEOUT', 30))
+keepalive = int(os.getenv('WEB_KEEPALIVE', 5))
+
+
+def gevent_wait_callback(connection, timeout=None):
+    '''
+    Wait for psycopg2 in the gevent hub instead of blocking the process,
+    so the other greenlets run while a query is on the wire
+    '''
+    from gevent.socket import wait_read, wait_write
+    from psycopg2 import OperationalError, extensions
+
+    while True:
+        state = connection.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(connection.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(connection.fileno(), timeout=timeout)
+        else:
+            raise OperationalError('Bad result from poll: {}'.format(state))
+
+
+# A gevent worker has patched the standard library by now | patch
+# psycopg2 too, it is a C extension that gevent can't patch
+def post_worker_init(worker):
+    try:
+        from gevent import monkey
+        from psycopg2 import extensions
+    except ImportError:
+        return
+    if monkey.is_module_patched('socket'):
+        extensions.set_wait_callback(gevent_wait_callback)
@@ -0,0 +1,54 @@
+"""add indexes for hot query paths
+
+Revision ID: 8b3e5c1f0a47
+Revises: 0d9a7fde0b9c
+Create Date: 2026-10-18 10:12:41.208113
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8b3e5c1f0a47'
+down_revision = '0d9a7fde0b9c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # actor => movies lookups | the primary key only covers movie => actors
+    op.create_index('ix_casting_actor_id', 'casting', ['actor_id'])
+    op.create_index('ix_actors_gender_id', 'actors', ['gender_id'])
+    # Range filters of GET /actors and GET /movies
+    op.create_index('ix_actors_age', 'actors', ['age'])
+    op.create_index('ix_movies_release_date', 'movies', ['release_date'])
+
+    # Prefix search | LIKE 'prefix%' whatever the database collation
+    op.create_index(
+        'ix_movies_title_prefix', 'movies', ['title'],
+        postgresql_ops={'title': 'text_pattern_ops'})
+    op.create_index(
+        'ix_actors_name_prefix', 'actors', ['name'],
+        postgresql_ops={'name': 'text_pattern_ops'})
+
+    # Substring and similarity search | GiST serves the <% match and the
+    # <<-> nearest-first order of GET /search, so only the top hits are
+    # read. GIN can't order by distance
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index(
+        'ix_movies_title_trgm', 'movies', ['title'],
+        postgresql_using='gist', postgresql_ops={'title': 'gist_trgm_ops'})
+    op.create_index(
+        'ix_actors_name_trgm', 'actors', ['name'],
+        postgresql_using='gist', postgresql_ops={'name': 'gist_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_actors_name_trgm', table_name='actors')
+    op.drop_index('ix_movies_title_trgm', table_name='movies')
+    op.drop_index('ix_actors_name_prefix', table_name='actors')
+    op.drop_index('ix_movies_title_prefix', table_name='movies')
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    op.drop_index('ix_actors_age', table_name='actors')
+    op.drop_index('ix_actors_gender_id', table_name='actors')
+    op.drop_index('ix_casting_actor_id', table_name='casting')
@@ -0,0 +1,41 @@
+"""add movie and actor documents
+
+Revision ID: e5a92c7d41b3
+Revises: 8b3e5c1f0a47
+Create Date: 2026-10-18 17:42:18.204113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a92c7d41b3'
+down_revision = '8b3e5c1f0a47'
+branch_labels = None
+depends_on = None
+
+
+# Read model of the list endpoints | fill it with flask read-model rebuild
+def upgrade():
+    op.create_table(
+        'movie_documents',
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.Column('document', sa.JSON(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ['movie_id'], ['movies.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('movie_id')
+    )
+    op.create_table(
+        'actor_documents',
+        sa.Column('actor_id', sa.Integer(), nullable=False),
+        sa.Column('document', sa.JSON(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ['actor_id'], ['actors.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('actor_id')
+    )
+
+
+def downgrade():
+    op.drop_table('actor_documents')
+    op.drop_table('movie_documents')
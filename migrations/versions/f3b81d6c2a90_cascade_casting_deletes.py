@@ -0,0 +1,37 @@
+"""cascade casting deletes
+
+Revision ID: f3b81d6c2a90
+Revises: e5a92c7d41b3
+Create Date: 2026-10-18 19:05:37.918244
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b81d6c2a90'
+down_revision = 'e5a92c7d41b3'
+branch_labels = None
+depends_on = None
+
+
+# Deleting a movie or an actor deletes its casting rows in the database,
+# the ORM doesn't load them anymore (passive_deletes)
+def upgrade():
+    op.drop_constraint('casting_movie_id_fkey', 'casting', type_='foreignkey')
+    op.drop_constraint('casting_actor_id_fkey', 'casting', type_='foreignkey')
+    op.create_foreign_key(
+        'casting_movie_id_fkey', 'casting', 'movies', ['movie_id'], ['id'],
+        ondelete='CASCADE')
+    op.create_foreign_key(
+        'casting_actor_id_fkey', 'casting', 'actors', ['actor_id'], ['id'],
+        ondelete='CASCADE')
+
+
+def downgrade():
+    op.drop_constraint('casting_actor_id_fkey', 'casting', type_='foreignkey')
+    op.drop_constraint('casting_movie_id_fkey', 'casting', type_='foreignkey')
+    op.create_foreign_key(
+        'casting_actor_id_fkey', 'casting', 'actors', ['actor_id'], ['id'])
+    op.create_foreign_key(
+        'casting_movie_id_fkey', 'casting', 'movies', ['movie_id'], ['id'])
@@ -1,55 +1,603 @@
+import hashlib
+import json
 import os
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import event
+import sqlite3
+import threading
+import time
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import (
+    DDL, bindparam, event, exc, func, orm, text, select, and_)
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.pool import QueuePool, NullPool
 from flask_migrate import Migrate
+from werkzeug.exceptions import InternalServerError, UnprocessableEntity
 from dotenv import load_dotenv, set_key
 
 # Load Environments
 load_dotenv()
 
-db = SQLAlchemy()
+
+class RoutingSession(SignallingSession):
+    '''
+    Session that reads from the replica picked for the request
+    (g.read_replica, see setup_replicas) | flushes, INSERT/UPDATE/DELETE
+    and everything outside a request go to the primary
+    '''
+
+    def get_bind(self, mapper=None, clause=None):
+        if (self._flushing or isinstance(clause, UpdateBase)
+                or self.info.get('pending_commit')
+                or not has_request_context()
+                or g.get('read_replica') is None):
+            return super().get_bind(mapper, clause)
+        return replicas.engine(g.read_replica)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
 migrate = Migrate()
 dev_database_name = os.getenv("DATABASE_NAME", "")
+# Full database uri for development | e.g. sqlite:///capstone.db
+dev_database_uri = os.getenv("DATABASE_URI", "")
 prod_database_name = os.getenv("DATABASE_URL", "")
 is_production = int(os.getenv("ENV", 0))
 
-
-def setup_db(app, path=''):
+# Connection pool | per worker process, so the total number of connections
+# is workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+pool_size = int(os.getenv("DB_POOL_SIZE", 5))
+max_overflow = int(os.getenv("DB_MAX_OVERFLOW", 10))
+pool_timeout = int(os.getenv("DB_POOL_TIMEOUT", 30))
+pool_recycle = int(os.getenv("DB_POOL_RECYCLE", 1800))
+pool_pre_ping = int(os.getenv("DB_POOL_PRE_PING", 1))
+# Milliseconds | 0 => no statement timeout
+statement_timeout = int(os.getenv("DB_STATEMENT_TIMEOUT", 0))
+# 1 => behind PgBouncer in transaction mode, which does the pooling
+external_pooler = int(os.getenv("DB_EXTERNAL_POOLER", 0))
+# Seconds between two reloads of the gender cache on unknown genders
+gender_miss_interval = float(os.getenv("GENDER_CACHE_MISS_INTERVAL", 5))
+# Read replicas | comma separated uris, the GET requests read from them
+replica_uris = os.getenv("DATABASE_REPLICA_URIS", "")
+# Seconds between two health checks of a replica
+replica_check_interval = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", 5))
+# Seconds a PostgreSQL replica may lag behind | 0 => lag isn't checked
+replica_max_lag = float(os.getenv("DB_REPLICA_MAX_LAG", 0))
+# Seconds a client reads from the primary after its own write
+sticky_seconds = float(os.getenv("DB_STICKY_SECONDS", 5))
+STICKY_COOKIE = 'read_primary_until'
+# Sent by a client that wants to read from the primary
+STICKY_HEADER = 'X-Read-Primary'
+
+
+def setup_db(app, path='', replica_path=''):
     # Configure which database to use, Production or Development
     if is_production:
         app.config['SQLALCHEMY_DATABASE_URI'] = prod_database_name
     else:
-        database_path = 'postgres:///{}'.format(dev_database_name)
+        database_path = dev_database_uri or 'postgres:///{}'.format(
+            dev_database_name)
         app.config['SQLALCHEMY_DATABASE_URI'] = path if path else database_path
 
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+        app.config['SQLALCHEMY_DATABASE_URI'])
+    uris = [
+        uri.strip() for uri in (replica_path or replica_uris).split(',')
+        if uri.strip()
+    ]
+    app.config['SQLALCHEMY_BINDS'] = {
+        'replica_{}'.format(number): uri for number, uri in enumerate(uris)
+    }
 
     db.app = app
     db.init_app(app)
     migrate.init_app(app, db)
-    db.create_all()
-
-
-# Casting table | Movie => Casting <= Actor
+    setup_unit_of_work(app)
+    setup_replicas(app, list(app.config['SQLALCHEMY_BINDS']))
+
+    # The schema is created once, not on every start | the engine
+    # connects on the first request that needs the database
+    @app.cli.command('create-schema')
+    def create_schema():
+        """Create the tables that don't exist yet."""
+        db.create_all()
+
+
+def engine_options(uri):
+    # SQLite has no server to pool connections to
+    if uri.startswith('sqlite'):
+        return {}
+
+    # PgBouncer pools the connections | keep none open in the worker.
+    # It doesn't accept startup options, so the statement timeout is set
+    # per transaction (see set_statement_timeout)
+    if external_pooler:
+        return {'poolclass': NullPool}
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': pool_timeout,
+        'pool_recycle': pool_recycle,
+        'pool_pre_ping': bool(pool_pre_ping),
+    }
+    if statement_timeout:
+        options['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(statement_timeout)
+        }
+    return options
+
+
+# SQLite only enforces foreign keys (and their ON DELETE CASCADE) when
+# asked to, on every connection
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys = ON')
+        cursor.close()
+
+
+@event.listens_for(Engine, 'begin')
+def set_statement_timeout(connection):
+    if external_pooler and statement_timeout and (
+            connection.dialect.name == 'postgresql'):
+        connection.execute(
+            'SET LOCAL statement_timeout = {:d}'.format(statement_timeout))
+
+
+class PoolMetrics:
+    '''
+    How long requests wait to check a connection out of the pool
+    '''
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+
+pool_metrics = PoolMetrics()
+
+
+class TimedQueuePool(QueuePool):
+    '''
+    QueuePool that records the checkout wait time in pool_metrics
+    '''
+
+    _local = threading.local()
+
+    def _do_get(self):
+        # QueuePool._do_get calls itself again | time the outer call only
+        if getattr(self._local, 'timing', False):
+            return super()._do_get()
+
+        self._local.timing = True
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self._local.timing = False
+            pool_metrics.observe(time.perf_counter() - start)
+
+
+# A connection is never shared between processes | e.g. gunicorn workers
+# forked after the pool was used. Connections opened by another process
+# are dropped (without closing them) and a new one is opened
+@event.listens_for(TimedQueuePool, 'connect')
+def remember_connection_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(TimedQueuePool, 'checkout')
+def check_connection_pid(dbapi_connection, connection_record, proxy):
+    if connection_record.info['pid'] != os.getpid():
+        connection_record.connection = proxy.connection = None
+        raise exc.DisconnectionError(
+            'Connection belongs to pid {}, not {}'.format(
+                connection_record.info['pid'], os.getpid()))
+
+
+def pool_stats():
+    stats = {
+        'checkouts': pool_metrics.checkouts,
+        'wait_seconds_total': pool_metrics.wait_seconds_total,
+        'wait_seconds_max': pool_metrics.wait_seconds_max,
+    }
+    pool = db.engine.pool
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'in_use': pool.checkedout(),
+            'overflow': pool.overflow(),
+        })
+    return stats
+
+
+class Replicas:
+    '''
+    Round robin over the healthy read replicas
+
+    A replica is checked (a connection and SELECT 1, or its replay lag
+    on PostgreSQL when DB_REPLICA_MAX_LAG is set) at most once every
+    DB_REPLICA_CHECK_INTERVAL seconds, when it is its turn. A replica
+    that fails a check or loses its connection is skipped until the
+    next check. With no healthy replica the reads go to the primary.
+    '''
+
+    def __init__(self):
+        self.names = []
+        self.healthy = {}
+        self.checked = {}
+        self.engines = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def configure(self, names):
+        with self._lock:
+            self.names = list(names)
+            self.healthy = {name: True for name in self.names}
+            self.checked = {}
+            self.engines = {}
+
+    def engine(self, name):
+        engine = db.get_engine(bind=name)
+        self.engines[engine] = name
+        return engine
+
+    def pick(self):
+        with self._lock:
+            names = self.names[self._next:] + self.names[:self._next]
+            self._next = (self._next + 1) % max(len(self.names), 1)
+        for name in names:
+            if self.is_healthy(name):
+                return name
+        return None
+
+    def is_healthy(self, name):
+        now = time.monotonic()
+        if now - self.checked.get(name, -replica_check_interval) >= (
+                replica_check_interval):
+            self.checked[name] = now
+            self.healthy[name] = self.check(name)
+        return self.healthy[name]
+
+    def check(self, name):
+        try:
+            with self.engine(name).connect() as connection:
+                if connection.dialect.name != 'postgresql' or (
+                        not replica_max_lag):
+                    connection.execute(text('SELECT 1'))
+                    return True
+                # No lag when it has replayed all it received | an idle
+                # primary has no new transaction to replay
+                lag = connection.execute(text(
+                    'SELECT CASE WHEN pg_last_wal_receive_lsn() = '
+                    'pg_last_wal_replay_lsn() THEN 0 ELSE EXTRACT(EPOCH '
+                    'FROM now() - pg_last_xact_replay_timestamp()) END'
+                )).scalar()
+                return (lag or 0) <= replica_max_lag
+        except exc.DBAPIError:
+            return False
+
+    def mark_down(self, engine):
+        name = self.engines.get(engine)
+        if name is not None:
+            self.healthy[name] = False
+            self.checked[name] = time.monotonic()
+
+    def stats(self):
+        return dict(self.healthy)
+
+
+replicas = Replicas()
+
+
+@event.listens_for(Engine, 'handle_error')
+def mark_replica_down(context):
+    # Lost connection, or none could be opened
+    if context.is_disconnect or context.connection is None:
+        replicas.mark_down(context.engine)
+
+
+# GET and HEAD requests read from a replica, unless the client wrote in
+# the last DB_STICKY_SECONDS | read your writes. The stickiness is a
+# cookie, so it follows a browser from one worker to another, and the
+# worker also remembers the token of the writer for API clients that
+# drop cookies
+READ_METHODS = ('GET', 'HEAD')
+# Hash of the Authorization header => time its reads leave the primary
+sticky_tokens = {}
+sticky_lock = threading.Lock()
+
+
+def setup_replicas(app, names):
+    replicas.configure(names)
+    if not names:
+        return
+
+    @app.before_request
+    def pick_read_replica():
+        g.read_replica = None
+        if request.method in READ_METHODS and not reads_own_writes():
+            g.read_replica = replicas.pick()
+
+    @app.after_request
+    def stick_to_primary(response):
+        if request.method not in READ_METHODS and (
+                response.status_code < 400) and sticky_seconds:
+            until = time.time() + sticky_seconds
+            response.set_cookie(
+                STICKY_COOKIE, repr(until),
+                max_age=int(sticky_seconds) + 1, httponly=True)
+            stick_token(until)
+        return response
+
+
+# The token itself isn't kept | only its hash
+def token_key():
+    header = request.headers.get('Authorization')
+    if header:
+        return hashlib.sha256(header.encode()).hexdigest()
+    return None
+
+
+def stick_token(until):
+    key = token_key()
+    if key is None:
+        return
+    now = time.time()
+    with sticky_lock:
+        sticky_tokens[key] = until
+        # Forget the expired tokens now and then
+        if len(sticky_tokens) > 1000:
+            for expired in [token for token, value in sticky_tokens.items()
+                            if value <= now]:
+                del sticky_tokens[expired]
+
+
+def reads_own_writes():
+    if request.headers.get(STICKY_HEADER, '').lower() in ('1', 'true'):
+        return True
+    key = token_key()
+    if key is not None and sticky_tokens.get(key, 0) > time.time():
+        return True
+    try:
+        return float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def reads_from_replica():
+    return has_request_context() and g.get('read_replica') is not None
+
+
+# Seconds a replica may be behind the primary | the checked lag, or the
+# read-your-writes window when the lag isn't checked. A replica read may
+# miss the writes committed less than that ago
+def replica_staleness():
+    return replica_max_lag or sticky_seconds
+
+
+# Unit of work | the model methods only stage their changes,
+# the request boundary commits them in one transaction
+def setup_unit_of_work(app):
+    @app.after_request
+    def commit_unit_of_work(response):
+        # Error responses never commit a half-done request
+        if response.status_code >= 400:
+            rollback()
+            return response
+        try:
+            commit()
+        except Exception as e:
+            # The route succeeded but nothing was written | answer with
+            # the JSON error handlers instead of the route's response
+            app.logger.exception(
+                'Cannot commit %s %s', request.method, request.path)
+            error = (
+                UnprocessableEntity() if isinstance(e, exc.IntegrityError)
+                else InternalServerError())
+            return app.make_response(app.handle_http_exception(error))
+        return response
+
+
+def stage(*instances):
+    db.session.add_all(instances)
+    # Flush so constraint errors are raised inside the calling route
+    db.session.flush()
+    db.session.info['pending_commit'] = True
+
+
+def commit():
+    if db.session.info.pop('pending_commit', False):
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+def rollback():
+    if db.session.info.pop('pending_commit', False):
+        db.session.rollback()
+
+
+# Change tracking | the rows a transaction wrote, by table name.
+# The listeners get them once the transaction is committed
+commit_listeners = []
+
+
+def on_commit(listener):
+    commit_listeners.append(listener)
+    return listener
+
+
+# Record rows written behind the ORM | e.g. casting (movie_id, actor_id)
+def record_change(table, *keys):
+    changes = db.session.info.setdefault('changes', {})
+    changes.setdefault(table, set()).update(keys)
+
+
+@event.listens_for(db.session, 'after_flush')
+def record_flushed_changes(session, flush_context):
+    changes = session.info.setdefault('changes', {})
+    for instance in (session.new | session.dirty | session.deleted):
+        if isinstance(instance, (Movie, Actor, Gender)):
+            changes.setdefault(
+                instance.__tablename__, set()).add(instance.id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def notify_commit_listeners(session):
+    # A released savepoint (e.g. a bulk import chunk) | its changes belong
+    # to the outer transaction, which may still roll back: notifying now
+    # would bump the response cache generation before anything is written
+    if session.transaction.nested:
+        return
+    changes = session.info.pop('changes', None)
+    if changes:
+        for listener in commit_listeners:
+            listener(changes)
+
+
+@event.listens_for(db.session, 'after_transaction_end')
+def discard_changes(session, transaction):
+    # Rolled back | nothing was written
+    if transaction.parent is None:
+        session.info.pop('changes', None)
+
+
+# Counts smaller than this are exact | COUNT(*) is cheap enough
+EXACT_COUNT_THRESHOLD = 10000
+
+
+# Return the count, whether it is an estimate
+def count_rows(model, *criteria):
+    # On PostgreSQL a count of many rows (a whole big table, or a filter
+    # like gender that matches half of it) is the planner estimate
+    # instead of a scan of those rows | an exact count otherwise
+    if db.engine.dialect.name == 'postgresql':
+        estimate = estimate_rows(model, *criteria)
+        if estimate is not None and estimate >= EXACT_COUNT_THRESHOLD:
+            return estimate, True
+
+    count = db.session.query(func.count(model.id)).filter(*criteria).scalar()
+    return count, False
+
+
+def estimate_rows(model, *criteria):
+    if not criteria:
+        return db.session.execute(
+            text('SELECT reltuples::bigint FROM pg_class '
+                 'WHERE relname = :table'),
+            {'table': model.__tablename__}
+        ).scalar()
+
+    # The rows the planner expects the filters to match | EXPLAIN only
+    # plans the query, it reads no row
+    statement = db.session.query(model.id).filter(*criteria).statement
+    compiled = statement.compile(dialect=db.engine.dialect)
+    plan = db.session.connection(clause=statement).execute(
+        'EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
+# d/m/y without strftime | it is called for every row of a list
+def format_date(value):
+    return '{:02d}/{:02d}/{:04d}'.format(value.day, value.month, value.year)
+
+
+# Keyset page of column tuples (no ORM objects) | Return the rows as
+# dicts keyed by field, next cursor
+def keyset_rows(model, columns, criteria, after, limit):
+    query = db.session.query(
+        model.id.label('id'),
+        *[column.label(field) for field, column in columns.items()]
+    ).filter(*criteria)
+    if after is not None:
+        query = query.filter(model.id > after)
+    rows = [row._asdict() for row in query.order_by(model.id).limit(
+        limit + 1)]
+
+    # The extra row only tells that there is a next page
+    next_cursor = rows[limit - 1]['id'] if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+# Names linked through casting to the rows in one query | owner => names.
+# The ids are one expanding parameter, so a big page isn't compiled into
+# a bind parameter per id
+def casting_names(owner_key, related_key, name, ids):
+    names = {row_id: [] for row_id in ids}
+    if ids:
+        query = select([owner_key, name]).select_from(casting.join(
+            name.class_, related_key == name.class_.id)).where(
+                owner_key.in_(bindparam('ids', expanding=True)))
+        for owner_id, related_name in db.session.execute(
+                query, {'ids': ids}):
+            names[owner_id].append(related_name)
+    return names
+
+
+# Casting table | Movie => Casting <= Actor. Deleting a movie or an actor
+# deletes its casting rows in the database (ON DELETE CASCADE)
 casting = db.Table(
     'casting',
     db.Column(
-        'movie_id', db.Integer, db.ForeignKey('movies.id'), primary_key=True),
+        'movie_id', db.Integer,
+        db.ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
     db.Column(
-        'actor_id', db.Integer, db.ForeignKey('actors.id'), primary_key=True)
+        'actor_id', db.Integer,
+        db.ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True),
+    # The primary key covers movie => actors, this one actor => movies
+    db.Index('ix_casting_actor_id', 'actor_id')
 )
 
 
+# Indexes for title/name search on PostgreSQL | LIKE 'prefix%' uses the
+# text_pattern_ops one whatever the collation, the GiST trigram one
+# serves the similarity match and its nearest-first order (GET /search)
+def search_indexes(table, column):
+    return (
+        db.Index(
+            'ix_{}_{}_prefix'.format(table, column), column,
+            postgresql_ops={column: 'text_pattern_ops'}),
+        db.Index(
+            'ix_{}_{}_trgm'.format(table, column), column,
+            postgresql_using='gist',
+            postgresql_ops={column: 'gist_trgm_ops'}),
+    )
+
+
 # Movie
 class Movie(db.Model):
     __tablename__ = 'movies'
+    __table_args__ = search_indexes('movies', 'title')
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String, nullable=False, unique=True)
-    release_date = db.Column(db.DateTime, nullable=False)
+    release_date = db.Column(db.DateTime, nullable=False, index=True)
     actors = db.relationship(
         'Actor',
         secondary="casting",
+        # The cast isn't loaded to delete it | ON DELETE CASCADE does
+        passive_deletes=True,
         # lazy=True,
         # backref=db.backref('movies', lazy=True)
     )
@@ -59,46 +607,113 @@ class Movie(db.Model):
         self.release_date = release_date
 
     def insert(self):
-        db.session.add(self)
-        db.session.commit()
+        stage(self)
 
     def insert_actors(self, actors):
-        self.actors.extend(actors)
-        db.session.commit()
+        self._add_casting({actor.id for actor in actors})
+        self._expire_casting(actors)
+        stage()
 
     def update(self):
-        db.session.commit()
+        stage()
 
     def update_actors(self, actors):
-        self.actors.clear()
-        self.actors.extend(actors)
-        db.session.commit()
+        # Diff against the current cast | unchanged links are kept
+        current = {
+            actor_id for actor_id, in db.session.execute(
+                select([casting.c.actor_id]).where(
+                    casting.c.movie_id == self.id))
+        }
+        new = {actor.id for actor in actors}
+
+        if current - new:
+            db.session.execute(casting.delete().where(and_(
+                casting.c.movie_id == self.id,
+                casting.c.actor_id.in_(current - new))))
+            record_change('casting', *[
+                (self.id, actor_id) for actor_id in current - new])
+        self._add_casting(new - current)
+        self._expire_casting(actors)
+        stage()
+
+    # Write the casting rows in a single executemany
+    def _add_casting(self, actor_ids):
+        if not actor_ids:
+            return
+        # The movie needs an id before it can be linked
+        db.session.flush()
+        db.session.execute(casting.insert(), [
+            {'movie_id': self.id, 'actor_id': actor_id}
+            for actor_id in sorted(actor_ids)
+        ])
+        record_change('casting', *[
+            (self.id, actor_id) for actor_id in actor_ids])
+
+    # The casting rows were written behind the ORM | reload on next access
+    def _expire_casting(self, actors):
+        db.session.expire(self, ['actors'])
+        for actor in actors:
+            db.session.expire(actor, ['movies'])
 
     def delete(self):
+        # The database deletes the casting rows | record them first
+        record_change('casting', *casting_pairs(casting.c.movie_id, [self.id]))
         db.session.delete(self)
-        db.session.commit()
+        stage()
 
-    def format(self):
+    # Field name => how to format it | used for fields= projection
+    formatters = {
+        'id': lambda movie: movie.id,
+        'title': lambda movie: movie.title,
+        'release_date': lambda movie: format_date(movie.release_date),
+        'actors': lambda movie: [actor.name for actor in movie.actors],
+    }
+
+    def format(self, fields=None):
         return {
-            'id': self.id,
-            'title': self.title,
-            'release_date': self.release_date.strftime("%d/%m/%Y"),
-            'actors': [actor.name for actor in self.actors]
+            field: self.formatters[field](self)
+            for field in (fields or self.formatters)
         }
 
+    # A page of formatted movies for the list endpoint | Return the
+    # movies, next cursor
+    @classmethod
+    def page(cls, fields, criteria=(), after=None, limit=100):
+        columns = {'title': cls.title, 'release_date': cls.release_date}
+        rows, next_cursor = keyset_rows(cls, {
+            field: column for field, column in columns.items()
+            if field in fields
+        }, criteria, after, limit)
+
+        if 'actors' in fields:
+            actors = casting_names(
+                casting.c.movie_id, casting.c.actor_id, Actor.name,
+                [row['id'] for row in rows])
+            for row in rows:
+                row['actors'] = actors[row['id']]
+        if 'release_date' in fields:
+            for row in rows:
+                row['release_date'] = format_date(row['release_date'])
+
+        return [
+            {field: row[field] for field in fields} for row in rows
+        ], next_cursor
+
 
 # Actor
 class Actor(db.Model):
     __tablename__ = 'actors'
+    __table_args__ = search_indexes('actors', 'name')
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False, unique=True)
-    age = db.Column(db.Integer, nullable=False)
+    age = db.Column(db.Integer, nullable=False, index=True)
     gender_id = db.Column(
-        db.Integer, db.ForeignKey('gender.id'), nullable=False)
+        db.Integer, db.ForeignKey('gender.id'), nullable=False, index=True)
     movies = db.relationship(
         "Movie",
-        secondary="casting"
+        secondary="casting",
+        passive_deletes=True
     )
 
     def __init__(self, name, age):
@@ -106,25 +721,166 @@ class Actor(db.Model):
         self.age = age
 
     def insert(self):
-        db.session.add(self)
-        db.session.commit()
+        stage(self)
 
     def update(self):
-        db.session.commit()
+        stage()
 
     def delete(self):
+        # The database deletes the casting rows | record them first
+        record_change('casting', *casting_pairs(casting.c.actor_id, [self.id]))
         db.session.delete(self)
-        db.session.commit()
-
-    def format(self):
+        stage()
+
+    # Field name => how to format it | used for fields= projection
+    formatters = {
+        'id': lambda actor: actor.id,
+        'name': lambda actor: actor.name,
+        'age': lambda actor: actor.age,
+        'gender': lambda actor: gender_cache.get_name(actor.gender_id),
+        'movies': lambda actor: [movie.title for movie in actor.movies],
+    }
+
+    def format(self, fields=None):
         return {
-            'id': self.id,
-            'name': self.name,
-            'age': self.age,
-            'gender': self.gender.gender,
-            'movies': [movie.title for movie in self.movies]
+            field: self.formatters[field](self)
+            for field in (fields or self.formatters)
         }
 
+    # A page of formatted actors for the list endpoint | Return the
+    # actors, next cursor
+    @classmethod
+    def page(cls, fields, criteria=(), after=None, limit=100):
+        columns = {'name': cls.name, 'age': cls.age, 'gender': cls.gender_id}
+        rows, next_cursor = keyset_rows(cls, {
+            field: column for field, column in columns.items()
+            if field in fields
+        }, criteria, after, limit)
+
+        if 'movies' in fields:
+            movies = casting_names(
+                casting.c.actor_id, casting.c.movie_id, Movie.title,
+                [row['id'] for row in rows])
+            for row in rows:
+                row['movies'] = movies[row['id']]
+        if 'gender' in fields:
+            for row in rows:
+                row['gender'] = gender_cache.get_name(row['gender'])
+
+        return [
+            {field: row[field] for field in fields} for row in rows
+        ], next_cursor
+
+
+# The trigram indexes need the pg_trgm extension
+for searchable_table in (Movie.__table__, Actor.__table__):
+    event.listen(searchable_table, 'before_create', DDL(
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(
+            dialect='postgresql'))
+
+
+# Batch writes | set-based statements for many movies or actors at once.
+# The writes go behind the ORM, so each one records its changes itself
+
+# The ids among these that exist
+def existing_ids(model, ids):
+    return {
+        row_id for row_id, in db.session.query(model.id).filter(
+            model.id.in_(list(ids)))
+    } if ids else set()
+
+
+# Casting rows of some movies or actors | (movie_id, actor_id) pairs
+def casting_pairs(key, ids):
+    return {
+        (movie_id, actor_id) for movie_id, actor_id in db.session.execute(
+            select([casting.c.movie_id, casting.c.actor_id]).where(
+                key.in_(list(ids))))
+    }
+
+
+# Delete rows in one statement | their casting goes with them
+# (ON DELETE CASCADE), only its pairs are read to record them
+def delete_rows(model, ids):
+    key = casting.c.movie_id if model is Movie else casting.c.actor_id
+    record_change('casting', *casting_pairs(key, ids))
+    db.session.execute(
+        model.__table__.delete().where(model.id.in_(list(ids))))
+    record_change(model.__tablename__, *ids)
+    stage()
+
+
+# id => values to set | rows that get the same values share one
+# UPDATE ... WHERE id IN, the others share one executemany per columns
+def update_rows(model, values_by_id):
+    table = model.__table__
+    groups = {}
+    for row_id, values in values_by_id.items():
+        groups.setdefault(tuple(sorted(values.items())), []).append(row_id)
+
+    singles = {}
+    for values, ids in groups.items():
+        if len(ids) > 1:
+            db.session.execute(
+                table.update().where(table.c.id.in_(ids)).values(
+                    dict(values)))
+        else:
+            columns = tuple(column for column, _ in values)
+            singles.setdefault(columns, []).append(dict(
+                {'new_' + column: value for column, value in values},
+                row_id=ids[0]))
+    for columns, rows in singles.items():
+        db.session.execute(
+            table.update().where(table.c.id == bindparam('row_id')).values({
+                column: bindparam('new_' + column) for column in columns
+            }), rows)
+
+    record_change(model.__tablename__, *values_by_id)
+    stage()
+
+
+# movie id => actor ids | replace the cast of many movies, only the links
+# that change are written
+def replace_casts(casts):
+    current = casting_pairs(casting.c.movie_id, casts)
+    wanted = {
+        (movie_id, actor_id)
+        for movie_id, actor_ids in casts.items() for actor_id in actor_ids
+    }
+    if current - wanted:
+        db.session.execute(
+            casting.delete().where(and_(
+                casting.c.movie_id == bindparam('old_movie_id'),
+                casting.c.actor_id == bindparam('old_actor_id'))),
+            [{'old_movie_id': movie_id, 'old_actor_id': actor_id}
+             for movie_id, actor_id in sorted(current - wanted)])
+    if wanted - current:
+        db.session.execute(casting.insert(), [
+            {'movie_id': movie_id, 'actor_id': actor_id}
+            for movie_id, actor_id in sorted(wanted - current)
+        ])
+    record_change('casting', *(current ^ wanted))
+    stage()
+
+
+# Read model | the formatted movie and actor of the list endpoints as one
+# document per row, kept up to date by flaskr/read_model.py
+movie_documents = db.Table(
+    'movie_documents',
+    db.Column(
+        'movie_id', db.Integer,
+        db.ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('document', db.JSON, nullable=False)
+)
+
+actor_documents = db.Table(
+    'actor_documents',
+    db.Column(
+        'actor_id', db.Integer,
+        db.ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('document', db.JSON, nullable=False)
+)
+
 
 class Gender(db.Model):
     __tablename__ = 'gender'
@@ -137,12 +893,89 @@ class Gender(db.Model):
         self.gender = gender
 
     def insert(self):
-        db.session.add(self)
-        db.session.commit()
+        stage(self)
 
     def update(self):
-        db.session.commit()
+        stage()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        stage()
+
+
+class GenderCache:
+    '''
+    Process-local, read-through cache of the gender table
+
+    Maps the normalised gender name to its id (and back), so actor writes
+    and formatting need no lookup query. It is loaded once, reloaded on a
+    miss (the gender may have been added by another process) at most
+    every GENDER_CACHE_MISS_INTERVAL seconds, so unknown genders don't
+    reload it on every request, and cleared once a transaction that
+    wrote the gender table is committed.
+    '''
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.miss_interval = gender_miss_interval
+        self._ids = None
+        self._names = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalise(gender):
+        return gender.replace(' ', '').lower()
+
+    # Return the loaded mappings | name => id, id => name
+    def load(self):
+        rows = db.session.query(Gender.id, Gender.gender).all()
+        ids = {gender: gender_id for gender_id, gender in rows}
+        names = {gender_id: gender for gender_id, gender in rows}
+        with self._lock:
+            self._ids, self._names = ids, names
+            self._loaded_at = time.monotonic()
+            self.loads += 1
+        return {'_ids': ids, '_names': names}
+
+    def invalidate(self, changes=None):
+        # Commits that didn't write the gender table | the cache is kept
+        if changes is not None and not changes.get('gender'):
+            return
+        with self._lock:
+            self._ids = None
+            self._names = None
+
+    def _lookup(self, table, key):
+        with self._lock:
+            mapping, loaded_at = getattr(self, table), self._loaded_at
+        if mapping is not None and key in mapping:
+            self.hits += 1
+            return mapping[key]
+        self.misses += 1
+        # A miss right after a load is an unknown gender | not reloaded
+        if mapping is not None and (
+                time.monotonic() - loaded_at < self.miss_interval):
+            return None
+        # The mapping of this load | invalidate() may drop the cache's
+        return self.load()[table].get(key)
+
+    def get_id(self, gender):
+        return self._lookup('_ids', self.normalise(gender))
+
+    def get_name(self, gender_id):
+        return self._lookup('_names', gender_id)
+
+    def stats(self):
+        return {
+            'size': len(self._ids or ()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'loads': self.loads,
+        }
+
+
+gender_cache = GenderCache()
+on_commit(gender_cache.invalidate)
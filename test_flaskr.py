@@ -0,0 +1,1383 @@
+'''
+Tests of the Casting Agency API
+
+    python3 test_flaskr.py
+
+Authentication is turned off and every test case uses a SQLite database
+of its own. The index checks need a big PostgreSQL catalogue, they are
+skipped unless EXPLAIN_DATABASE_URI points to one (see ExplainTestCase).
+'''
+import csv
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+# Development settings without Auth0 | read when the app is imported
+os.environ['ENV'] = '0'
+os.environ['AUTH_STATUS'] = '0'
+os.environ.setdefault('DATABASE_URI', 'sqlite:///' + os.path.join(
+    tempfile.mkdtemp(), 'capstone_test.db'))
+
+from flask import Flask  # noqa: E402
+from sqlalchemy import event, exc  # noqa: E402
+from auth import auth  # noqa: E402
+from auth.jwks import JWKSStore, JWKSFetchError  # noqa: E402
+from auth.token_cache import TokenCache  # noqa: E402
+from flaskr import create_app  # noqa: E402
+from flaskr.bulk import (  # noqa: E402
+    CatalogueImporter, read_rows, split_names)
+from flaskr.costars import CostarGraph, costar_graph  # noqa: E402
+from flaskr.json_provider import (  # noqa: E402
+    orjson, orjson_dumps, stdlib_dumps)
+from flaskr.response_cache import response_cache  # noqa: E402
+from flaskr.search import prefix_trie  # noqa: E402
+from flaskr.stats import stats_cache  # noqa: E402
+import models  # noqa: E402
+from models import (  # noqa: E402
+    db, casting, commit, gender_cache, Actor, Gender, Movie)
+
+
+EXPLAIN_DATABASE_URI = os.getenv('EXPLAIN_DATABASE_URI', '')
+
+# Seeded with set-based SQL, so a big catalogue only takes seconds.
+# Literal % are doubled | the statements are run with parameters
+EXPLAIN_SEED = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "INSERT INTO gender (gender) VALUES ('male'), ('female') "
+    "ON CONFLICT DO NOTHING",
+    "INSERT INTO actors (name, age, gender_id) "
+    "SELECT 'Actor ' || n, 18 + n %% 60, "
+    "(ARRAY(SELECT id FROM gender ORDER BY id))[1 + n %% 2] "
+    "FROM generate_series(1, %(actors)s) n",
+    "INSERT INTO movies (title, release_date) "
+    "SELECT 'Movie ' || n, DATE '1950-01-01' + n %% 25000 "
+    "FROM generate_series(1, %(movies)s) n",
+    "INSERT INTO casting (movie_id, actor_id) "
+    "SELECT m.id, a.first + (m.id * 7919 + k * 104729) %% %(actors)s "
+    "FROM movies m, generate_series(0, %(cast)s - 1) k, "
+    "(SELECT min(id) AS first FROM actors) a "
+    "ON CONFLICT DO NOTHING",
+    "ANALYZE",
+]
+EXPLAIN_SIZES = {'actors': 200000, 'movies': 50000, 'cast': 5}
+
+# A gender matches half of the actors | its total is the planner estimate
+EXPLAIN_ENDPOINTS = [
+    '/actors?limit=50',
+    '/actors?limit=50&after=100000',
+    '/actors?limit=50&min_age=30&max_age=31',
+    '/actors?limit=50&gender=female',
+    '/actors?limit=50&name=Actor%20123',
+    '/actors?limit=50&fields=id,name',
+    '/movies?limit=50',
+    '/movies?limit=50&released_after=1/1/2000&released_before=31/1/2000',
+    '/movies?limit=50&title=Movie%20777',
+]
+
+CATALOGUE = {'actors', 'movies', 'casting'}
+
+
+# (node type, table) of every table a plan reads
+def scans(plan):
+    if 'Relation Name' in plan:
+        yield plan['Node Type'], plan['Relation Name']
+    for child in plan.get('Plans', []):
+        yield from scans(child)
+
+
+# A key of the JSON Web Key Set | only the fields the store keeps
+def jwk(kid):
+    return {'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'n-' + kid,
+            'e': 'AQAB'}
+
+
+class JWKSStoreTestCase(unittest.TestCase):
+    '''The signing keys are read from a file:// key set'''
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'jwks.json')
+        self.write_keys('first')
+
+    def write_keys(self, *kids):
+        with open(self.path, 'w') as jwks_file:
+            json.dump({'keys': [jwk(kid) for kid in kids]}, jwks_file)
+
+    # A store that counts its fetches
+    def store(self, **kwargs):
+        store = JWKSStore('file://' + self.path, **kwargs)
+        store.fetches = 0
+        fetch = store._fetch
+
+        def counting_fetch():
+            store.fetches += 1
+            return fetch()
+
+        store._fetch = counting_fetch
+        return store
+
+    def test_keys_are_fetched_once(self):
+        store = self.store()
+        self.assertEqual(store.get_key('first'), jwk('first'))
+        self.assertEqual(store.get_key('first'), jwk('first'))
+        self.assertEqual(store.fetches, 1)
+
+    def test_unknown_kid_forces_a_refresh(self):
+        store = self.store(min_refresh_interval=0)
+        store.get_key('first')
+        # Auth0 rotated its keys
+        self.write_keys('first', 'second')
+        self.assertEqual(store.get_key('second'), jwk('second'))
+        self.assertEqual(store.fetches, 2)
+
+    def test_unknown_kid_refreshes_are_rate_limited(self):
+        store = self.store(min_refresh_interval=30)
+        store.get_key('first')
+        self.write_keys('first', 'second')
+        for _ in range(5):
+            self.assertIsNone(store.get_key('second'))
+        self.assertEqual(store.fetches, 1)
+
+        # Once the interval has passed, an unknown kid refreshes again
+        store._last_attempt -= 30
+        self.assertEqual(store.get_key('second'), jwk('second'))
+        self.assertEqual(store.fetches, 2)
+
+    def test_one_thread_refreshes(self):
+        store = self.store()
+        fetch = store._fetch
+
+        def slow_fetch():
+            time.sleep(0.2)
+            return fetch()
+
+        store._fetch = slow_fetch
+        keys = []
+        threads = [
+            threading.Thread(target=lambda: keys.append(
+                store.get_key('first')))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(keys, [jwk('first')] * 8)
+        self.assertEqual(store.fetches, 1)
+
+    def test_stale_keys_are_served_when_a_fetch_fails(self):
+        store = self.store(ttl=0, min_refresh_interval=0)
+        store.get_key('first')
+        os.remove(self.path)
+        self.assertEqual(store.get_key('first'), jwk('first'))
+        self.assertEqual(store.fetches, 2)
+
+    def test_fetch_error_without_keys(self):
+        os.remove(self.path)
+        with self.assertRaises(JWKSFetchError):
+            self.store().get_key('first')
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    '''Verified payloads are kept until their exp claim'''
+
+    def test_entry_expires_at_exp(self):
+        cache = TokenCache()
+        exp = time.time() + 60
+        cache.set('token', {'sub': 'user', 'exp': exp})
+        self.assertEqual(cache.get('token'), {'sub': 'user', 'exp': exp})
+        with mock.patch('auth.token_cache.time.time', return_value=exp):
+            self.assertIsNone(cache.get('token'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_token_without_exp_is_not_cached(self):
+        cache = TokenCache()
+        cache.set('token', {'sub': 'user'})
+        cache.set('other', {'sub': 'user', 'exp': 'soon'})
+        self.assertIsNone(cache.get('token'))
+        self.assertIsNone(cache.get('other'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TokenCache(maxsize=2)
+        exp = time.time() + 60
+        cache.set('first', {'exp': exp})
+        cache.set('second', {'exp': exp})
+        cache.get('first')
+        cache.set('third', {'exp': exp})
+        self.assertIsNone(cache.get('second'))
+        self.assertIsNotNone(cache.get('first'))
+        self.assertIsNotNone(cache.get('third'))
+
+    def test_cached_payload_is_checked_for_permissions(self):
+        auth.token_cache.set('cached-token', {
+            'permissions': ['get:actors'], 'exp': time.time() + 60})
+        app = Flask(__name__)
+        headers = {'Authorization': 'Bearer cached-token'}
+        with app.test_request_context(headers=headers):
+            auth.is_authenticated('get:actors')
+            with self.assertRaises(auth.AuthError):
+                auth.is_authenticated('post:actors')
+
+
+class RequiresAuthTestCase(unittest.TestCase):
+    '''A route needing several permissions verifies the token once'''
+
+    def test_permissions_share_one_verification(self):
+        payload = {'permissions': ['get:actors', 'get:movies']}
+        view = auth.requires_auth(permission=('get:actors', 'get:movies'))(
+            lambda: 'ok')
+        headers = {'Authorization': 'Bearer token'}
+        with Flask(__name__).test_request_context(headers=headers), \
+                mock.patch.object(auth, 'AUTH_STATUS', 1), \
+                mock.patch.object(
+                    auth, 'verify_decode_jwt',
+                    return_value=payload) as verify:
+            self.assertEqual(view(), 'ok')
+            self.assertEqual(verify.call_count, 1)
+
+            payload['permissions'] = ['get:actors']
+            with self.assertRaises(auth.AuthError):
+                auth.is_authenticated(('get:actors', 'get:movies'))
+
+
+@unittest.skipUnless(orjson, 'orjson is not installed')
+class JSONProviderTestCase(unittest.TestCase):
+    '''Both JSON backends write the same bytes'''
+
+    def test_backends_write_the_same_bytes(self):
+        payload = {
+            'movies': [{'title': 'Zoë', 'id': 1, 'actors': ['Ł', '日本']}],
+            'total_movies': 1, 'next_cursor': None, 'success': True,
+            'average': 2.5,
+        }
+        self.assertEqual(
+            stdlib_dumps(payload), orjson_dumps(payload))
+
+
+class CastingAgencyTestCase(unittest.TestCase):
+    '''A new app and SQLite database, with the male and female genders'''
+
+    config = {}
+
+    def setUp(self):
+        path = os.path.join(tempfile.mkdtemp(), 'test.db')
+        self.app = create_app(dict(
+            {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path}, **self.config))
+        self.client = self.app.test_client()
+        self.seeded = 0
+        with self.app.app_context():
+            db.create_all()
+            db.session.add_all([Gender('male'), Gender('female')])
+            db.session.commit()
+        # The caches belong to the process | every test starts empty
+        for cache in (gender_cache, response_cache, stats_cache,
+                      costar_graph, prefix_trie):
+            cache.invalidate()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.get_engine(self.app).dispose()
+
+    # Add actors, and movies that cast `cast` of them | Return their ids
+    def seed(self, actors, movies, cast):
+        with self.app.app_context():
+            genders = Gender.query.order_by(Gender.id).all()
+            new_actors = []
+            for number in range(self.seeded, self.seeded + actors):
+                actor = Actor('Actor {}'.format(number), 20 + number % 50)
+                actor.gender_id = genders[number % 2].id
+                new_actors.append(actor)
+            db.session.add_all(new_actors)
+            new_movies = []
+            for number in range(movies):
+                movie = Movie(
+                    'Movie {}'.format(self.seeded + number),
+                    datetime.datetime(2000 + number % 20, 1, 1))
+                movie.actors = [
+                    new_actors[(number + position) % actors]
+                    for position in range(cast)
+                ]
+                new_movies.append(movie)
+            db.session.add_all(new_movies)
+            db.session.commit()
+            self.seeded += max(actors, movies)
+            return ([actor.id for actor in new_actors],
+                    [movie.id for movie in new_movies])
+
+    # Run a request | Return the response, SQL statements it ran
+    def counting(self, method, path, **kwargs):
+        with self.app.app_context():
+            engine = db.engine
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, many):
+            statements.append((statement, parameters))
+
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            response = self.client.open(path, method=method, **kwargs)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        return response, statements
+
+    def get_counting(self, path, **kwargs):
+        return self.counting('GET', path, **kwargs)
+
+
+class StatementCountTestCase(CastingAgencyTestCase):
+    '''The list endpoints run a fixed number of statements | no N+1'''
+
+    paths = [
+        '/actors', '/actors?gender=female', '/actors?fields=name,movies',
+        '/movies', '/movies?fields=title,actors',
+    ]
+
+    def count_statements(self):
+        # The first request loads the process caches
+        self.client.get(self.paths[0])
+        counts = {}
+        for path in self.paths:
+            # Count the statements of a cache miss
+            response_cache.invalidate()
+            response, statements = self.get_counting(path)
+            self.assertEqual(response.status_code, 200, path)
+            counts[path] = len(statements)
+        return counts
+
+    def test_statements_dont_grow_with_the_catalogue(self):
+        self.seed(5, 5, 2)
+        small = self.count_statements()
+        self.seed(60, 60, 4)
+        self.assertEqual(self.count_statements(), small)
+
+    def test_list_has_every_actor_and_movie(self):
+        self.seed(30, 20, 3)
+        actors = self.client.get('/actors').get_json()
+        self.assertEqual(actors['total_actors'], 30)
+        self.assertEqual(len(actors['actors']), 30)
+        movies = self.client.get('/movies').get_json()
+        self.assertEqual(movies['total_movies'], 20)
+        self.assertTrue(all(
+            len(movie['actors']) == 3 for movie in movies['movies']))
+
+
+class PaginationTestCase(CastingAgencyTestCase):
+    '''Keyset pages, fields projection and filters of the list endpoints'''
+
+    def add_actors(self, *names):
+        with self.app.app_context():
+            gender = Gender.query.first()
+            for name in names:
+                actor = Actor(name, 30)
+                actor.gender_id = gender.id
+                db.session.add(actor)
+            db.session.commit()
+
+    def test_keyset_pages(self):
+        actor_ids, _ = self.seed(7, 0, 0)
+        seen, after = [], None
+        while True:
+            path = '/actors?limit=3' + (
+                '&after={}'.format(after) if after else '')
+            page = self.client.get(path).get_json()
+            self.assertEqual(page['total_actors'], 7)
+            self.assertLessEqual(len(page['actors']), 3)
+            seen.extend(actor['id'] for actor in page['actors'])
+            after = page['next_cursor']
+            if after is None:
+                break
+            self.assertEqual(after, seen[-1])
+        self.assertEqual(seen, actor_ids)
+
+    def test_page_arguments_are_checked(self):
+        for path in ('/actors?limit=0', '/actors?limit=x',
+                     '/actors?after=x', '/movies?limit=100000'):
+            self.assertEqual(self.client.get(path).status_code, 400, path)
+
+    def test_fields_projection(self):
+        self.seed(2, 2, 1)
+        actors = self.client.get('/actors?fields=name,age').get_json()
+        self.assertEqual(
+            [set(actor) for actor in actors['actors']], [{'name', 'age'}] * 2)
+        movies = self.client.get('/movies?fields=id, title').get_json()
+        self.assertEqual(
+            [set(movie) for movie in movies['movies']], [{'id', 'title'}] * 2)
+        self.assertEqual(
+            self.client.get('/actors?fields=name,salary').status_code, 400)
+
+    def test_filters(self):
+        self.seed(6, 4, 1)
+        actors = self.client.get(
+            '/actors?gender=Female&min_age=21&max_age=23').get_json()
+        self.assertEqual(
+            [actor['name'] for actor in actors['actors']],
+            ['Actor 1', 'Actor 3'])
+        self.assertEqual(actors['total_actors'], 2)
+        movies = self.client.get(
+            '/movies?released_after=1/1/2001&released_before=1/1/2002'
+            '&fields=title').get_json()
+        self.assertEqual(
+            movies['movies'], [{'title': 'Movie 1'}, {'title': 'Movie 2'}])
+        movies = self.client.get('/movies?title=movie 3').get_json()
+        self.assertEqual(
+            [movie['title'] for movie in movies['movies']], ['Movie 3'])
+
+    def test_prefix_filter_escapes_like_wildcards(self):
+        self.add_actors('Ann_a', 'Annxa', '100% Actor', '1000 Actor')
+        for prefix, names in (('Ann_', ['Ann_a']),
+                              ('100%', ['100% Actor']),
+                              ('Ann', ['Ann_a', 'Annxa'])):
+            actors = self.client.get(
+                '/actors?fields=name&name=' + prefix.replace('%', '%25'))
+            self.assertEqual(
+                [actor['name'] for actor in actors.get_json()['actors']],
+                names, prefix)
+
+    def test_large_counts_are_estimated(self):
+        self.seed(4, 0, 0)
+        page = self.client.get('/actors').get_json()
+        self.assertEqual(
+            (page['total_actors'], page['total_estimated']), (4, False))
+
+        # The planner estimate of PostgreSQL | stubbed on SQLite
+        with self.app.app_context():
+            young = Actor.age < 22
+            with mock.patch.object(db.engine.dialect, 'name', 'postgresql'):
+                for estimate, total in ((None, (2, False)),
+                                        (9999, (2, False)),
+                                        (10000, (10000, True))):
+                    with mock.patch.object(
+                            models, 'estimate_rows', return_value=estimate):
+                        self.assertEqual(
+                            models.count_rows(Actor, young), total, estimate)
+            self.assertEqual(models.count_rows(Actor, young), (2, False))
+
+
+class CastingTestCase(CastingAgencyTestCase):
+    '''The cast of a movie is resolved in one query and written as a diff'''
+
+    def test_missing_actors_are_reported(self):
+        (first, second), _ = self.seed(2, 0, 0)
+        response = self.client.post('/movies', json={
+            'title': 'Cast', 'release_date': '1/1/2020',
+            'actors': [second, 999, second, first]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['missing_actors'], [999])
+        movie = self.client.get('/movies?title=Cast').get_json()['movies']
+        self.assertEqual(
+            sorted(movie[0]['actors']), ['Actor 0', 'Actor 1'])
+
+    def test_every_actor_missing(self):
+        _, (movie_id,) = self.seed(2, 1, 2)
+        response = self.client.post('/movies', json={
+            'title': 'Nobody', 'release_date': '1/1/2020', 'actors': [999]})
+        self.assertEqual(response.status_code, 400)
+
+        # The cast is left alone rather than emptied
+        response = self.client.patch(
+            '/movies/{}'.format(movie_id), json={'actors': [998, 999]})
+        self.assertEqual(response.status_code, 422)
+        movie = self.client.get('/movies').get_json()['movies'][0]
+        self.assertEqual(len(movie['actors']), 2)
+
+    def test_update_writes_only_the_changed_links(self):
+        (first, second, third), (movie_id,) = self.seed(3, 1, 2)
+        response, statements = self.counting(
+            'PATCH', '/movies/{}'.format(movie_id),
+            json={'actors': [second, third]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            sorted(response.get_json()['movie']['actors']),
+            ['Actor 1', 'Actor 2'])
+
+        # The link to the second actor is kept | one DELETE, one INSERT
+        writes = [
+            statement.split()[0] for statement, _ in statements
+            if 'casting' in statement.split()[:3]
+        ]
+        self.assertEqual(writes, ['DELETE', 'INSERT'])
+        with self.app.app_context():
+            self.assertEqual(
+                sorted(db.session.execute(
+                    'SELECT actor_id FROM casting WHERE movie_id = :id',
+                    {'id': movie_id})),
+                [(second,), (third,)])
+
+class UnitOfWorkTestCase(CastingAgencyTestCase):
+    '''A request commits once, and an error response writes nothing'''
+
+    def count_movies(self):
+        with self.app.app_context():
+            return Movie.query.count()
+
+    def test_successful_request_is_committed(self):
+        self.seed(1, 0, 0)
+        response = self.client.post('/movies', json={
+            'title': 'Kept', 'release_date': '1/1/2020', 'actors': [1]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.count_movies(), 1)
+
+    def test_failed_request_is_rolled_back(self):
+        self.seed(1, 0, 0)
+        # The movie row is staged before the cast fails
+        with mock.patch.object(
+                Movie, 'insert_actors', side_effect=Exception('cast')):
+            response = self.client.post('/movies', json={
+                'title': 'Lost', 'release_date': '1/1/2020', 'actors': [1]})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(self.count_movies(), 0)
+
+    def test_failed_commit_answers_with_an_error(self):
+        self.seed(1, 0, 0)
+        for error, status in ((exc.IntegrityError('', {}, None), 422),
+                              (exc.OperationalError('', {}, None), 500)):
+            with mock.patch.object(
+                    db.session, 'commit', side_effect=error):
+                response = self.client.post('/movies', json={
+                    'title': 'Lost', 'release_date': '1/1/2020',
+                    'actors': [1]})
+            self.assertEqual(response.status_code, status)
+            self.assertEqual(response.get_json()['status_code'], status)
+            self.assertFalse(response.get_json()['success'])
+        self.assertEqual(self.count_movies(), 0)
+
+
+class BulkImportTestCase(CastingAgencyTestCase):
+    '''POST /bulk and CatalogueImporter'''
+
+    def test_import_ndjson(self):
+        self.seed(1, 0, 0)
+        lines = [
+            {'type': 'actor', 'name': 'A1', 'age': 30, 'gender': 'Male'},
+            {'type': 'actor', 'name': 'A2', 'age': 'x', 'gender': 'male'},
+            {'type': 'actor', 'name': 'Actor 0', 'age': 30,
+             'gender': 'male'},
+            {'type': 'movie', 'title': 'M1', 'release_date': '1/2/2000',
+             'actors': ['A1', 'Actor 0']},
+            {'type': 'movie', 'title': 'M2', 'release_date': '1/2/2000',
+             'actors': ['ghost']},
+            {'type': 'alien'},
+        ]
+        response = self.client.post('/bulk', data='\n'.join(
+            json.dumps(line) for line in lines) + '\nnope\n')
+        report = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(report['inserted'],
+                         {'actors': 1, 'movies': 1, 'castings': 2})
+        self.assertEqual(report['skipped'],
+                         {'actors': 1, 'movies': 0, 'castings': 0})
+        self.assertEqual(
+            [error['line'] for error in report['errors']], [2, 5, 6, 7])
+
+        movies = self.client.get('/movies?fields=title,actors').get_json()
+        self.assertEqual(movies['movies'], [
+            {'title': 'M1', 'actors': ['Actor 0', 'A1']}])
+
+    def test_import_csv(self):
+        rows = [
+            'type,name,age,gender,title,release_date,actors,movie,actor',
+            'actor,C1,40,female,,,,,',
+            'actor,C2,41,male,,,,,',
+            'movie,,,,CSV,2/3/2001,C1;C2,,',
+            'movie,,,,Solo,2/3/2001,,,',
+            'casting,,,,,,,Solo,C2',
+            'casting,,,,,,,Solo,ghost',
+        ]
+        response = self.client.post(
+            '/bulk?format=csv', data='\n'.join(rows) + '\n')
+        report = response.get_json()
+        self.assertEqual(report['inserted'],
+                         {'actors': 2, 'movies': 2, 'castings': 3})
+        self.assertEqual(
+            [error['line'] for error in report['errors']], [7])
+
+        movies = self.client.get('/movies?fields=title,actors').get_json()
+        self.assertEqual(movies['movies'], [
+            {'title': 'CSV', 'actors': ['C1', 'C2']},
+            {'title': 'Solo', 'actors': ['C2']}])
+
+    def test_ages_must_be_integers(self):
+        lines = [
+            {'type': 'actor', 'name': 'Int', 'age': 30, 'gender': 'male'},
+            {'type': 'actor', 'name': 'Float', 'age': 30.5,
+             'gender': 'male'},
+            {'type': 'actor', 'name': 'Bool', 'age': True, 'gender': 'male'},
+            {'type': 'actor', 'name': 'Text', 'age': '30', 'gender': 'male'},
+        ]
+        report = self.client.post('/bulk', data='\n'.join(
+            json.dumps(line) for line in lines)).get_json()
+        self.assertEqual(report['inserted']['actors'], 2)
+        self.assertEqual(report['errors'], [
+            {'line': 2, 'error': 'age must be an integer'},
+            {'line': 3, 'error': 'age must be an integer'},
+        ])
+
+    def test_csv_names_with_separators(self):
+        names = ['Quo"te', 'Semi;Colon']
+        lines = [
+            {'type': 'actor', 'name': name, 'age': 30, 'gender': 'male'}
+            for name in names
+        ] + [{'type': 'movie', 'title': 'First', 'release_date': '1/2/2000',
+              'actors': names}]
+        self.client.post('/bulk', data='\n'.join(
+            json.dumps(line) for line in lines))
+
+        # The CSV export is read back with the same cast
+        exported = self.client.get('/export/movies?format=csv')
+        movies = list(csv.DictReader(
+            exported.get_data(as_text=True).splitlines()))
+        self.assertEqual(sorted(split_names(movies[0]['actors'])), names)
+        movies[0]['title'] = 'Second'
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, list(movies[0]))
+        writer.writeheader()
+        writer.writerow(movies[0])
+        report = self.client.post(
+            '/bulk?format=csv', data=buffer.getvalue()).get_json()
+        self.assertEqual(report['errors'], [])
+
+        movies = self.client.get('/movies?fields=title,actors').get_json()
+        self.assertEqual(
+            [sorted(movie['actors']) for movie in movies['movies']],
+            [names] * 2)
+
+    def test_failed_chunk_leaves_no_state(self):
+        lines = [
+            {'type': 'actor', 'name': 'New', 'age': 30, 'gender': 'male'},
+            {'type': 'movie', 'title': 'Lost', 'release_date': '1/2/2000',
+             'actors': ['New']},
+            {'type': 'movie', 'title': 'Kept', 'release_date': '1/2/2000',
+             'actors': ['New']},
+            {'type': 'actor', 'name': 'Other', 'age': 30, 'gender': 'male'},
+        ]
+        write_castings = CatalogueImporter._write_castings
+        calls = []
+
+        # The castings of the first chunk fail in the database
+        def fail_once(importer, *args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise RuntimeError('boom')
+            return write_castings(importer, *args)
+
+        with self.app.app_context(), mock.patch.object(
+                CatalogueImporter, '_write_castings', autospec=True,
+                side_effect=fail_once):
+            importer = CatalogueImporter(chunk_size=2)
+            report = importer.run(read_rows(
+                json.dumps(line) for line in lines))
+            db.session.commit()
+            self.assertEqual(
+                sorted(name for name, in db.session.query(Actor.name)),
+                ['Other'])
+            self.assertEqual(Movie.query.count(), 0)
+            self.assertNotIn('New', importer.actors)
+
+        self.assertEqual(report['inserted'],
+                         {'actors': 1, 'movies': 0, 'castings': 0})
+        self.assertEqual(report['errors'], [
+            {'line': 1, 'error': 'not imported: boom'},
+            {'line': 2, 'error': 'not imported: boom'},
+            {'line': 3, 'error': 'unknown actor New'},
+        ])
+
+
+class ExportTestCase(CastingAgencyTestCase):
+    '''GET /export/actors and GET /export/movies'''
+
+    def test_ndjson_export(self):
+        actor_ids, movie_ids = self.seed(3, 2, 2)
+        response = self.client.get('/export/movies')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        movies = [json.loads(line) for line in response.data.splitlines()]
+        for movie in movies:
+            movie['actors'].sort()
+        self.assertEqual(movies, [
+            {'type': 'movie', 'id': movie_ids[0], 'title': 'Movie 0',
+             'release_date': '01/01/2000', 'actors': ['Actor 0', 'Actor 1']},
+            {'type': 'movie', 'id': movie_ids[1], 'title': 'Movie 1',
+             'release_date': '01/01/2001', 'actors': ['Actor 1', 'Actor 2']},
+        ])
+
+    def test_csv_export(self):
+        actor_ids, _ = self.seed(3, 1, 2)
+        response = self.client.get('/export/actors?format=csv')
+        self.assertEqual(response.mimetype, 'text/csv')
+        actors = list(csv.DictReader(
+            response.get_data(as_text=True).splitlines()))
+        self.assertEqual(actors, [
+            {'type': 'actor', 'id': str(actor_ids[0]), 'name': 'Actor 0',
+             'age': '20', 'gender': 'male', 'movies': 'Movie 0'},
+            {'type': 'actor', 'id': str(actor_ids[1]), 'name': 'Actor 1',
+             'age': '21', 'gender': 'female', 'movies': 'Movie 0'},
+            {'type': 'actor', 'id': str(actor_ids[2]), 'name': 'Actor 2',
+             'age': '22', 'gender': 'male', 'movies': ''},
+        ])
+
+    def test_unknown_format(self):
+        response = self.client.get('/export/movies?format=xml')
+        self.assertEqual(response.status_code, 400)
+
+
+class GenderCacheTestCase(CastingAgencyTestCase):
+    '''Gender names and ids come from the process cache'''
+
+    def gender_queries(self, method, path, **kwargs):
+        response, statements = self.counting(method, path, **kwargs)
+        self.assertLess(response.status_code, 400, path)
+        return [
+            statement for statement, _ in statements
+            if 'FROM gender' in statement
+        ]
+
+    def test_actor_reads_and_writes_skip_the_gender_table(self):
+        self.seed(4, 2, 2)
+        self.client.get('/actors')
+        self.assertEqual(self.gender_queries('GET', '/actors'), [])
+        self.assertEqual(
+            self.gender_queries('GET', '/actors?gender=female'), [])
+        self.assertEqual(self.gender_queries('POST', '/actors', json={
+            'name': 'Cached', 'age': 30, 'gender': 'Fe male'}), [])
+
+    def test_new_gender_is_seen(self):
+        with self.app.app_context():
+            Gender('robot').insert()
+            commit()
+        response = self.client.post('/actors', json={
+            'name': 'Robot', 'age': 3, 'gender': 'Robot'})
+        self.assertEqual(response.status_code, 200)
+        actors = self.client.get('/actors?fields=name,gender').get_json()
+        self.assertEqual(
+            actors['actors'], [{'name': 'Robot', 'gender': 'robot'}])
+
+    def test_unknown_gender(self):
+        response = self.client.post('/actors', json={
+            'name': 'Nobody', 'age': 3, 'gender': 'alien'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_unknown_gender_doesnt_reload(self):
+        with self.app.app_context():
+            self.assertTrue(gender_cache.get_id('Male'))
+            loads = gender_cache.loads
+            for _ in range(5):
+                self.assertIsNone(gender_cache.get_id('unknown'))
+            self.assertEqual(gender_cache.loads, loads)
+
+            # A new gender drops the cache
+            db.session.add(Gender('other'))
+            db.session.commit()
+            self.assertTrue(gender_cache.get_id('other'))
+
+    def test_cache_is_dropped_at_commit(self):
+        with self.app.app_context():
+            gender_cache.get_id('Male')
+            # A flushed gender may still be rolled back
+            db.session.add(Gender('pending'))
+            db.session.flush()
+            self.assertEqual(gender_cache.stats()['size'], 2)
+            db.session.rollback()
+            self.assertEqual(gender_cache.stats()['size'], 2)
+
+            # Commits of other tables keep the cache
+            self.seed(1, 1, 1)
+            self.assertEqual(gender_cache.stats()['size'], 2)
+            db.session.add(Gender('other'))
+            db.session.commit()
+            self.assertEqual(gender_cache.stats()['size'], 0)
+
+
+class CacheTestCase(CastingAgencyTestCase):
+    '''The response cache sees the writes'''
+
+    config = {'RESPONSE_CACHE': 'memory'}
+
+    def test_response_cache_is_invalidated_by_a_write(self):
+        self.seed(2, 1, 1)
+        first = self.client.get('/actors')
+        hits = response_cache.hits
+        second, statements = self.get_counting('/actors')
+        self.assertEqual(response_cache.hits, hits + 1)
+        self.assertEqual(statements, [])
+        self.assertEqual(first.get_data(), second.get_data())
+        self.assertEqual(self.client.get('/actors', headers={
+            'If-None-Match': second.headers['ETag']}).status_code, 304)
+
+        response = self.client.post('/actors', json={
+            'name': 'New actor', 'age': 30, 'gender': 'female'})
+        self.assertEqual(response.status_code, 200)
+        actors = self.client.get('/actors').get_json()
+        self.assertEqual(actors['total_actors'], 3)
+        self.assertIn(
+            'New actor', [actor['name'] for actor in actors['actors']])
+
+    def test_released_savepoint_doesnt_invalidate(self):
+        generation = response_cache.backend.generation()
+        with self.app.app_context():
+            db.session.begin_nested()
+            db.session.add(Movie('Nested', datetime.datetime(2000, 1, 1)))
+            db.session.commit()
+            self.assertEqual(
+                response_cache.backend.generation(), generation)
+            # The outer commit writes the movie
+            db.session.commit()
+        self.assertEqual(
+            response_cache.backend.generation(), generation + 1)
+
+
+class SearchTestCase(CastingAgencyTestCase):
+    '''GET /search with the prefix trie of the SQLite runs'''
+
+    def setUp(self):
+        super().setUp()
+        self.add_movies('Star Wars', 'Lone Star', 'Starship Troopers')
+        with self.app.app_context():
+            actor = Actor('Ringo Starr', 40)
+            actor.gender_id = Gender.query.first().id
+            db.session.add(actor)
+            db.session.commit()
+
+    def add_movies(self, *titles):
+        with self.app.app_context():
+            db.session.add_all([
+                Movie(title, datetime.datetime(2000, 1, 1))
+                for title in titles
+            ])
+            db.session.commit()
+
+    def search(self, query):
+        response = self.client.get('/search?' + query)
+        self.assertEqual(response.status_code, 200, query)
+        return response.get_json()
+
+    def names(self, query):
+        return [hit['name'] for hit in self.search(query)['hits']]
+
+    def test_ranking(self):
+        # Texts starting with the query first, then the shorter texts
+        self.assertEqual(self.names('q=star'), [
+            'Star Wars', 'Starship Troopers', 'Lone Star', 'Ringo Starr'])
+        hits = self.search('q=star')['hits']
+        self.assertEqual(
+            [(hit['type'], hit['score']) for hit in hits],
+            [('movie', 1.0), ('movie', 1.0), ('movie', 0.5),
+             ('actor', 0.5)])
+
+    def test_every_word_must_match(self):
+        self.assertEqual(self.names('q=wars star'), ['Star Wars'])
+        self.assertEqual(self.names('q=star trek'), [])
+
+    def test_type_and_pages(self):
+        self.assertEqual(self.names('q=star&type=actor'), ['Ringo Starr'])
+        first = self.search('q=star&limit=3')
+        self.assertEqual(first['next_offset'], 3)
+        last = self.search('q=star&limit=3&offset=3')
+        self.assertEqual(
+            [hit['name'] for hit in last['hits']], ['Ringo Starr'])
+        self.assertIsNone(last['next_offset'])
+
+    def test_trie_follows_the_writes(self):
+        self.assertEqual(self.names('q=stardust'), [])
+        self.add_movies('Stardust')
+        self.assertEqual(self.names('q=stardust'), ['Stardust'])
+
+    def test_bad_arguments(self):
+        for query in ('q=st', 'q=star&type=genre', 'q=star&limit=0',
+                      'q=star&offset=-1'):
+            self.assertEqual(
+                self.client.get('/search?' + query).status_code, 400, query)
+
+
+class ReadModelTestCase(CastingAgencyTestCase):
+    '''The movie and actor documents follow every write'''
+
+    config = {'READ_MODEL_ENABLED': '1'}
+
+    def read_model(self, command):
+        return self.app.test_cli_runner().invoke(
+            args=['read-model', command])
+
+    def assertDocumentsMatch(self):
+        result = self.read_model('check')
+        self.assertEqual(result.exit_code, 0, result.output)
+
+    def test_documents_follow_the_writes(self):
+        actor_ids, movie_ids = self.seed(4, 2, 2)
+        self.assertDocumentsMatch()
+
+        response = self.client.post('/movies', json={
+            'title': 'New movie', 'release_date': '1/2/2003',
+            'actors': [actor_ids[0], actor_ids[3]]})
+        self.assertEqual(response.status_code, 200)
+        self.assertDocumentsMatch()
+
+        self.client.patch('/movies/{}'.format(movie_ids[0]), json={
+            'title': 'Renamed', 'actors': [actor_ids[2]]})
+        self.client.patch('/actors/{}'.format(actor_ids[1]), json={
+            'name': 'Renamed actor'})
+        self.assertDocumentsMatch()
+        movies = self.client.get('/movies?fields=title,actors').get_json()
+        self.assertEqual(movies['movies'][1], {
+            'title': 'Movie 1', 'actors': ['Renamed actor', 'Actor 2']})
+
+        self.client.delete('/actors/{}'.format(actor_ids[2]))
+        self.client.delete('/movies/{}'.format(movie_ids[1]))
+        self.assertDocumentsMatch()
+        movies = self.client.get('/movies?fields=title,actors').get_json()
+        self.assertEqual(movies['movies'], [
+            {'title': 'Renamed', 'actors': []},
+            {'title': 'New movie', 'actors': ['Actor 0', 'Actor 3']}])
+
+    def test_check_finds_stale_documents(self):
+        self.seed(2, 1, 2)
+        with self.app.app_context():
+            db.session.execute("UPDATE movie_documents SET document = '{}'")
+            db.session.commit()
+        result = self.read_model('check')
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('movie_documents: 0 missing, 1 stale', result.output)
+
+        self.assertEqual(self.read_model('rebuild').exit_code, 0)
+        self.assertDocumentsMatch()
+
+
+class ReplicaTestCase(CastingAgencyTestCase):
+    '''GET requests read from a second SQLite database, the replica'''
+
+    def setUp(self):
+        self.replica_dir = tempfile.mkdtemp()
+        self.replica_uri = 'sqlite:///' + os.path.join(
+            self.replica_dir, 'replica.db')
+        self.config = {
+            'DATABASE_REPLICA_URIS': self.replica_uri,
+            'RESPONSE_CACHE': 'none',
+            'METRICS_ENABLED': '1',
+        }
+        super().setUp()
+        self.seed(1, 1, 1)
+        # The replica isn't replicated | it has a movie of its own
+        self.make_replica()
+
+    def make_replica(self):
+        os.makedirs(self.replica_dir, exist_ok=True)
+        with self.app.app_context():
+            engine = db.get_engine(self.app, bind='replica_0')
+        db.Model.metadata.create_all(engine)
+        engine.execute(Gender.__table__.insert(), [
+            {'gender': 'male'}, {'gender': 'female'}])
+        engine.execute(Actor.__table__.insert(), [
+            {'name': 'Actor 0', 'age': 20, 'gender_id': 1}])
+        engine.execute(Movie.__table__.insert(), [
+            {'title': 'Replica', 'release_date': datetime.datetime(2001, 1, 1)}
+        ])
+
+    def titles(self, client=None, **kwargs):
+        response = (client or self.client).get(
+            '/movies?fields=title', **kwargs)
+        self.assertEqual(response.status_code, 200)
+        return [movie['title'] for movie in response.get_json()['movies']]
+
+    def test_reads_go_to_the_replica(self):
+        self.assertEqual(self.titles(), ['Replica'])
+        response = self.client.post('/movies', json={
+            'title': 'Written', 'release_date': '1/2/2003', 'actors': [1]})
+        self.assertEqual(response.status_code, 200)
+        with self.app.app_context():
+            self.assertEqual(
+                sorted(title for title, in db.session.query(Movie.title)),
+                ['Movie 0', 'Written'])
+
+    def test_client_reads_its_writes_from_the_primary(self):
+        response = self.client.patch('/movies/1', json={'title': 'Mine'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(models.STICKY_COOKIE, response.headers['Set-Cookie'])
+        self.assertEqual(self.titles(), ['Mine'])
+
+        # Once the cookie has expired, the replica again
+        self.client.set_cookie('localhost', models.STICKY_COOKIE, '0')
+        self.assertEqual(self.titles(), ['Replica'])
+
+    def test_token_and_header_stickiness(self):
+        # A client that drops cookies | its token is remembered
+        headers = {'Authorization': 'Bearer writer'}
+        response = self.app.test_client(use_cookies=False).patch(
+            '/movies/1', json={'title': 'Mine'}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        client = self.app.test_client(use_cookies=False)
+        self.assertEqual(
+            self.titles(client=client, headers=headers), ['Mine'])
+        self.assertEqual(self.titles(client=client), ['Replica'])
+        self.assertEqual(self.titles(
+            client=client, headers={'Authorization': 'Bearer other'}),
+            ['Replica'])
+        self.assertEqual(self.titles(
+            client=client, headers={models.STICKY_HEADER: '1'}), ['Mine'])
+
+    def test_reads_fall_back_to_the_primary(self):
+        with mock.patch.object(models, 'replica_check_interval', 0):
+            self.assertEqual(self.titles(), ['Replica'])
+
+            shutil.rmtree(self.replica_dir)
+            self.assertEqual(self.titles(), ['Movie 0'])
+            self.assertEqual(models.replicas.stats(), {'replica_0': False})
+            metrics = self.client.get('/metrics').get_data(as_text=True)
+            self.assertIn(
+                'casting_db_replica_healthy{replica="replica_0"} 0', metrics)
+
+            # Back once a check succeeds
+            self.make_replica()
+            self.assertEqual(self.titles(), ['Replica'])
+
+    def test_cache_misses_read_from_the_replica(self):
+        # The same databases with the response cache on
+        client = create_app(dict(
+            self.config, RESPONSE_CACHE='memory')).test_client()
+        hits = response_cache.hits
+        # The replica may lag behind the write of setUp | nothing stored
+        for _ in range(2):
+            self.assertEqual(self.titles(client=client), ['Replica'])
+        self.assertEqual(response_cache.hits, hits)
+
+        with mock.patch.object(models, 'sticky_seconds', 0):
+            self.assertEqual(self.titles(client=client), ['Replica'])
+            self.assertEqual(self.titles(client=client), ['Replica'])
+        self.assertEqual(response_cache.hits, hits + 1)
+
+    def test_stats_misses_read_from_the_replica(self):
+        for _ in range(2):
+            cast_size = self.client.get('/stats/cast-size').get_json()
+            self.assertEqual(cast_size['cast_size']['castings'], 0)
+        self.assertEqual(stats_cache.stats()['size'], 0)
+
+        with mock.patch.object(models, 'sticky_seconds', 0):
+            self.client.get('/stats/cast-size')
+        self.assertEqual(stats_cache.stats()['size'], 1)
+
+    def test_costar_changes_wait_for_the_replica(self):
+        self.assertEqual(self.client.get('/actors/1/costars').get_json()[
+            'costars'], [])
+        # A write of another client
+        self.app.test_client().post('/movies', json={
+            'title': 'Written', 'release_date': '1/2/2003', 'actors': [1]})
+        self.client.get('/actors/1/costars')
+        self.assertIn((2, 1), costar_graph._pending)
+
+        with mock.patch.object(models, 'sticky_seconds', 0):
+            self.client.get('/actors/1/costars')
+        self.assertNotIn((2, 1), costar_graph._pending)
+
+
+class BatchTestCase(CastingAgencyTestCase):
+    '''PATCH and DELETE of many actors or movies'''
+
+    def test_update_actors(self):
+        actor_ids, _ = self.seed(3, 0, 0)
+        response = self.client.patch('/actors', json={'actors': [
+            {'id': actor_ids[0], 'age': 40},
+            {'id': 999, 'age': 41},
+            {'id': actor_ids[1], 'age': 'x'},
+            {'id': actor_ids[2], 'name': 'Actor 0'},
+            {'id': actor_ids[0], 'age': 42},
+        ]})
+        report = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [result['status'] for result in report['results']],
+            [200, 404, 400, 409, 400])
+        self.assertEqual(report['updated'], 1)
+        self.assertEqual(report['total_errors'], 4)
+        with self.app.app_context():
+            self.assertEqual(Actor.query.get(actor_ids[0]).age, 40)
+            self.assertEqual(
+                Actor.query.get(actor_ids[2]).name, 'Actor 2')
+
+    def test_update_movie_actors(self):
+        actor_ids, movie_ids = self.seed(3, 1, 1)
+        response = self.client.patch('/movies', json={'movies': [
+            {'id': movie_ids[0], 'actors': [actor_ids[1], 999]},
+        ]})
+        report = response.get_json()
+        self.assertEqual(report['results'][0]['missing_actors'], [999])
+        movie = self.client.get('/movies?fields=actors').get_json()
+        self.assertEqual(movie['movies'][0]['actors'], ['Actor 1'])
+
+    def test_delete_movies(self):
+        _, movie_ids = self.seed(3, 2, 2)
+        response = self.client.delete('/movies', json={
+            'ids': [movie_ids[0], movie_ids[0], 999, 'x']})
+        report = response.get_json()
+        self.assertEqual(
+            [result['status'] for result in report['results']],
+            [200, 400, 404, 400])
+        self.assertEqual(report['deleted'], 1)
+        with self.app.app_context():
+            self.assertEqual(
+                [movie.id for movie in Movie.query.all()], [movie_ids[1]])
+            # The casting rows went with the movie
+            self.assertFalse(db.session.execute(casting.select().where(
+                casting.c.movie_id == movie_ids[0])).first())
+
+    def test_empty_batch(self):
+        self.assertEqual(
+            self.client.delete('/actors', json={'ids': []}).status_code, 400)
+
+
+class CascadeTestCase(CastingAgencyTestCase):
+    '''The database deletes the casting rows of a deleted movie or actor'''
+
+    def setUp(self):
+        super().setUp()
+        self.changes = []
+        models.commit_listeners.append(self.changes.append)
+
+    def tearDown(self):
+        models.commit_listeners.remove(self.changes.append)
+        super().tearDown()
+
+    def castings(self):
+        with self.app.app_context():
+            return sorted(
+                tuple(row) for row in db.session.execute(casting.select()))
+
+    def delete(self, path):
+        response, statements = self.counting('DELETE', path)
+        self.assertEqual(response.status_code, 200, path)
+        # No casting row is deleted one by one
+        self.assertFalse([
+            statement for statement, _ in statements
+            if statement.startswith('DELETE FROM casting')
+        ])
+        return self.changes[-1]
+
+    def test_delete_actor(self):
+        actor_ids, movie_ids = self.seed(3, 2, 2)
+        changes = self.delete('/actors/{}'.format(actor_ids[1]))
+        self.assertEqual(changes['casting'], {
+            (movie_ids[0], actor_ids[1]), (movie_ids[1], actor_ids[1])})
+        self.assertEqual(self.castings(), [
+            (movie_ids[0], actor_ids[0]), (movie_ids[1], actor_ids[2])])
+
+    def test_delete_movie(self):
+        actor_ids, movie_ids = self.seed(3, 2, 2)
+        changes = self.delete('/movies/{}'.format(movie_ids[0]))
+        self.assertEqual(changes['casting'], {
+            (movie_ids[0], actor_ids[0]), (movie_ids[0], actor_ids[1])})
+        self.assertEqual(self.castings(), [
+            (movie_ids[1], actor_ids[1]), (movie_ids[1], actor_ids[2])])
+        with self.app.app_context():
+            self.assertEqual(Actor.query.count(), 3)
+
+
+class StatsTestCase(CastingAgencyTestCase):
+    '''GET /stats and the aggregates cache'''
+
+    config = {'RESPONSE_CACHE': 'none'}
+
+    def test_aggregates(self):
+        actor_ids, _ = self.seed(4, 3, 2)
+        stats = self.client.get('/stats').get_json()
+        self.assertEqual(stats['genders'], [
+            {'gender': 'female', 'actors': 2},
+            {'gender': 'male', 'actors': 2}])
+        self.assertEqual(stats['cast_size'], {
+            'movies': 3, 'castings': 6, 'average': 2.0, 'largest': 2})
+        self.assertEqual(
+            [(row['year'], row['movies']) for row in stats['release_years']],
+            [(2000, 1), (2001, 1), (2002, 1)])
+        top = self.client.get('/stats/top-actors?limit=2').get_json()
+        self.assertEqual(
+            [(row['id'], row['movies']) for row in top['top_actors']],
+            [(actor_ids[1], 2), (actor_ids[2], 2)])
+        self.assertEqual(
+            self.client.get('/stats/top-actors?limit=0').status_code, 400)
+
+    def test_write_drops_only_its_aggregates(self):
+        self.seed(4, 2, 2)
+        self.client.get('/stats')
+        response, statements = self.get_counting('/stats')
+        self.assertEqual(statements, [])
+
+        # A new actor leaves the movies per year and the cast sizes
+        self.client.post('/actors', json={
+            'name': 'New actor', 'age': 30, 'gender': 'female'})
+        response, statements = self.get_counting('/stats')
+        self.assertEqual(len(statements), 2)
+        genders = response.get_json()['genders']
+        self.assertEqual(
+            {row['gender']: row['actors'] for row in genders},
+            {'male': 2, 'female': 3})
+
+
+class CostarGraphTestCase(unittest.TestCase):
+    '''Bidirectional BFS on a graph built from (actor, movie) pairs'''
+
+    def setUp(self):
+        # 1 - 10 - 2 - 11 - 3 - 12 - 4, and 5 alone in 13
+        self.graph = CostarGraph()
+        self.graph.build([
+            (1, 10), (2, 10), (2, 11), (3, 11), (3, 12), (4, 12), (5, 13)])
+
+    def test_costars(self):
+        self.assertEqual(dict(self.graph.costars(2)), {1: 1, 3: 1})
+        self.assertEqual(dict(self.graph.costars(5)), {})
+
+    def test_shortest_path(self):
+        self.assertEqual(self.graph.path(1, 3), [1, 10, 2, 11, 3])
+        self.assertEqual(self.graph.path(4, 1), [4, 12, 3, 11, 2, 10, 1])
+        self.assertEqual(self.graph.path(2, 2), [2])
+
+    def test_no_path(self):
+        self.assertIsNone(self.graph.path(1, 5))
+        self.assertIsNone(self.graph.path(1, 4, max_degrees=2))
+        self.assertIsNone(self.graph.path(1, 99))
+
+    def test_stale_graph_is_served_during_a_rebuild(self):
+        self.graph._built_at -= self.graph.ttl
+        # Another request is rebuilding
+        with self.graph._build_lock:
+            done = threading.Event()
+            thread = threading.Thread(
+                target=lambda: (self.graph.path(1, 3), done.set()))
+            thread.start()
+            self.assertTrue(done.wait(5))
+            thread.join()
+        self.assertEqual(self.graph.builds, 1)
+
+
+class CostarRouteTestCase(CastingAgencyTestCase):
+    '''GET /actors/<id>/costars and GET /actors/<id>/path/<other>'''
+
+    def costars(self, actor_id):
+        response = self.client.get('/actors/{}/costars'.format(actor_id))
+        self.assertEqual(response.status_code, 200)
+        return [
+            (costar['id'], costar['shared_movies'])
+            for costar in response.get_json()['costars']
+        ]
+
+    def test_costars(self):
+        actor_ids, _ = self.seed(3, 3, 2)
+        self.client.post('/movies', json={
+            'title': 'Again', 'release_date': '1/2/2003',
+            'actors': [actor_ids[0], actor_ids[1]]})
+        # Most shared movies first
+        self.assertEqual(self.costars(actor_ids[0]), [
+            (actor_ids[1], 2), (actor_ids[2], 1)])
+        self.assertEqual(self.client.get(
+            '/actors/999/costars').status_code, 404)
+
+    def test_costars_follow_the_writes(self):
+        actor_ids, movie_ids = self.seed(4, 1, 2)
+        self.assertEqual(self.costars(actor_ids[0]), [(actor_ids[1], 1)])
+        builds = costar_graph.builds
+
+        response = self.client.post('/movies', json={
+            'title': 'New movie', 'release_date': '1/2/2003',
+            'actors': [actor_ids[0], actor_ids[3]]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.costars(actor_ids[0]), [
+            (actor_ids[1], 1), (actor_ids[3], 1)])
+        self.client.delete('/movies/{}'.format(movie_ids[0]))
+        self.assertEqual(self.costars(actor_ids[0]), [(actor_ids[3], 1)])
+        # The changes were caught up with | not rebuilt
+        self.assertEqual(costar_graph.builds, builds)
+
+    def test_path(self):
+        actor_ids, movie_ids = self.seed(4, 3, 2)
+        response = self.client.get('/actors/{}/path/{}'.format(
+            actor_ids[0], actor_ids[3]))
+        path = response.get_json()
+        self.assertEqual(path['degrees'], 3)
+        self.assertEqual(path['path'][0], {
+            'type': 'actor', 'id': actor_ids[0], 'name': 'Actor 0'})
+        self.assertEqual(path['path'][1], {
+            'type': 'movie', 'id': movie_ids[0], 'title': 'Movie 0'})
+
+    def test_not_connected_and_unknown(self):
+        actor_ids, _ = self.seed(3, 1, 2)
+        path = self.client.get('/actors/{}/path/{}'.format(
+            actor_ids[0], actor_ids[2])).get_json()
+        self.assertIsNone(path['path'])
+        self.assertEqual(self.client.get('/actors/{}/path/999'.format(
+            actor_ids[0])).status_code, 404)
+        self.assertEqual(self.client.get(
+            '/actors/{}/path/{}?max_degrees=13'.format(
+                actor_ids[0], actor_ids[1])).status_code, 400)
+
+
+@unittest.skipUnless(EXPLAIN_DATABASE_URI, 'EXPLAIN_DATABASE_URI is not set')
+class ExplainTestCase(unittest.TestCase):
+    '''
+    Every statement of the list endpoints uses an index on a big catalogue:
+    they are captured, EXPLAINed, and none may scan a whole table. Use a
+    database of its own, it is seeded when it is empty:
+
+        createdb capstone_explain
+        EXPLAIN_DATABASE_URI=postgresql:///capstone_explain \\
+            python3 test_flaskr.py ExplainTestCase
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': EXPLAIN_DATABASE_URI,
+            'RESPONSE_CACHE': 'none',
+        })
+        with cls.app.app_context():
+            db.create_all()
+            if not Actor.query.first():
+                connection = db.engine.raw_connection()
+                cursor = connection.cursor()
+                for statement in EXPLAIN_SEED:
+                    cursor.execute(statement, EXPLAIN_SIZES)
+                connection.commit()
+                connection.close()
+
+    def test_list_endpoints_use_indexes(self):
+        with self.app.app_context():
+            engine = db.engine
+        captured = []
+
+        def capture(conn, cursor, statement, parameters, context, many):
+            if statement.lstrip().upper().startswith('SELECT'):
+                captured.append((statement, parameters))
+
+        client = self.app.test_client()
+        for endpoint in EXPLAIN_ENDPOINTS:
+            del captured[:]
+            event.listen(engine, 'before_cursor_execute', capture)
+            try:
+                response = client.get(endpoint)
+            finally:
+                event.remove(engine, 'before_cursor_execute', capture)
+            self.assertEqual(response.status_code, 200, endpoint)
+
+            connection = engine.raw_connection()
+            try:
+                cursor = connection.cursor()
+                for statement, parameters in captured:
+                    cursor.execute(
+                        'EXPLAIN (FORMAT JSON) ' + statement, parameters)
+                    plan = cursor.fetchone()[0]
+                    if isinstance(plan, str):
+                        plan = json.loads(plan)
+                    seq_scans = [
+                        relation for node, relation in scans(plan[0]['Plan'])
+                        if node == 'Seq Scan' and relation in CATALOGUE
+                    ]
+                    with self.subTest(endpoint=endpoint,
+                                      statement=' '.join(statement.split())):
+                        self.assertEqual(seq_scans, [])
+            finally:
+                connection.close()
+
+
+if __name__ == '__main__':
+    unittest.main()